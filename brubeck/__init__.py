@@ -4,13 +4,19 @@
 
 version = "0.4.0"
 version_info = (0, 4, 0)
-__all__ = ['auth',
+__all__ = ['accesslog',
+           'auth',
            'autoapi',
+           'cachestats',
            'caching',
+           'cookies',
            'datamosh',
            'models',
            'mongrel2',
            'queryset',
+           'redispool',
            'request_handling',
+           'sessions',
+           'staticfiles',
            'templating',
            'timekeeping']
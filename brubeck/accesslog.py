@@ -0,0 +1,120 @@
+"""Access logging kept off the request path.
+
+Handlers record each response as a tuple in a ring buffer. A coroutine
+started by `Brubeck.run()` turns the buffered tuples into dicts and hands them
+to a sink in batches. Formatting and log I/O happen there rather than while
+the response is being built.
+
+Whatever is still buffered is flushed when `Brubeck.run()` returns and again
+when the interpreter exits, so apps that never call `run()` don't lose their
+last entries either.
+"""
+
+import time
+import atexit
+import random
+import logging
+import weakref
+from collections import deque
+
+
+###
+### Sinks
+###
+
+def logging_sink(entries):
+    """Writes each entry to Python's `logging` at INFO level.
+    """
+    for entry in entries:
+        logging.info('%(status_code)s %(method)s %(path)s (%(remote_addr)s) '
+                     '%(duration)dms' % entry)
+
+
+###
+### Access log
+###
+
+_live_access_logs = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit():
+    """Flushes every access log still alive when the interpreter exits.
+    """
+    for access_log in list(_live_access_logs):
+        access_log.flush()
+
+
+class AccessLog(object):
+    """Buffers access log entries and writes them in batches.
+
+    `buffer_size` bounds the ring buffer. If the writer falls behind, the
+    oldest entries are overwritten and counted in `dropped`.
+
+    `sample_rate` is the fraction of responses to record. Responses with a
+    status code of 400 or more are always recorded unless `sample_errors` is
+    True.
+
+    `sink` is called with a list of dicts, one per response, with the keys in
+    `FIELDS`.
+    """
+    FIELDS = ('timestamp', 'status_code', 'method', 'path', 'remote_addr',
+              'duration')
+
+    def __init__(self, sink=logging_sink, buffer_size=8192, batch_size=512,
+                 flush_interval=1.0, sample_rate=1.0, sample_errors=False):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.sample_errors = sample_errors
+        self.dropped = 0
+        self._buffer = deque(maxlen=buffer_size)
+        _live_access_logs.add(self)
+
+    def record(self, handler, status_code):
+        """Adds the response produced by `handler` to the buffer. This is
+        the only part of access logging that runs during a request.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            if self.sample_errors or status_code < 400:
+                return
+        message = handler.message
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((time.time(), status_code, message.method,
+                             message.path, message.remote_addr,
+                             handler.timestamp))
+
+    def _to_entry(self, record):
+        (timestamp, status_code, method, path, remote_addr, started) = record
+        duration = max(timestamp * 1000 - started, 0)
+        return dict(zip(self.FIELDS, (timestamp, status_code, method, path,
+                                      remote_addr, duration)))
+
+    def flush(self):
+        """Hands everything in the buffer to the sink, `batch_size` entries
+        at a time.
+        """
+        buffer = self._buffer
+        while buffer:
+            batch_size = min(self.batch_size, len(buffer))
+            batch = [self._to_entry(buffer.popleft())
+                     for i in xrange(batch_size)]
+            try:
+                self.sink(batch)
+            except Exception, e:
+                logging.error('Access log sink failed: %s' % e)
+
+    def run_writer(self):
+        """Flushes the buffer every `flush_interval` seconds, forever.
+        """
+        from request_handling import coro_sleep
+        while True:
+            coro_sleep(self.flush_interval)
+            self.flush()
+
+    def start(self, pool):
+        """Spawns the writer coroutine on `pool`.
+        """
+        return pool.spawn(self.run_writer)
@@ -1,18 +1,25 @@
 from request_handling import JSONMessageHandler, FourOhFourException
+from datamosh import StreamedHandlerMixin
+from queryset.base import FILTER_OPERATORS
 
 from dictshield.base import ShieldException
 
 import ujson as json
 
 
-class AutoAPIBase(JSONMessageHandler):
+class AutoAPIBase(JSONMessageHandler, StreamedHandlerMixin):
     """AutoAPIBase generates a JSON REST API for you. *high five!*
     I also read this link for help in propertly defining the behavior of HTTP
     PUT and POST: http://stackoverflow.com/questions/630453/put-vs-post-in-rest
+
+    Listing the collection returns a page of `default_count` items, up to
+    `max_count` if the client asks for more.
     """
     
     model = None
     queries = None
+    default_count = 25
+    max_count = 100
 
     _PAYLOAD_DATA = 'data'
 
@@ -229,20 +236,67 @@ class AutoAPIBase(JSONMessageHandler):
     ### For URLs we handle 0 IDs, 1 ID, and N IDs. Zero, One, Infinity.
     ### For data we handle 0 datums, 1 datum and N datums. ZOI, again.
     ###
-    ### Paging and authentication will be offered soon.
+    ### Authentication will be offered soon.
+
+    def get_filter_arguments(self):
+        """Returns the filters in the arguments, for each field the queryset
+        can filter on. Arguments are named after the field, for equality, or
+        the field and an operator, eg. `created_at__gte=1325376000000`. Values
+        are converted with the model's fields.
+        """
+        fields = self.queries.filterable_fields()
+        if fields is None:
+            fields = self.model._fields.keys()
+        filters = dict()
+        for name in self.message.arguments:
+            (field, sep, op) = name.partition('__')
+            if field not in fields or (op and op not in FILTER_OPERATORS):
+                continue
+            value = self.get_argument(name)
+            if field in self.model._fields:
+                value = self.model._fields[field].for_python(value)
+            filters[name] = value
+        return filters
+
+    def get_page(self):
+        """Reads one page of the collection. The paging arguments are `count`,
+        `page` or `skip`, `cursor` and `order_by`. Filters are read by
+        `get_filter_arguments`. The cursor for the next page is added to the
+        payload as `cursor`.
+        """
+        (page, count, skip) = self.get_paging_arguments(
+            default_count=self.default_count, max_count=self.max_count)
+        if count < 1 or skip < 0:
+            return self.render(status_code=self._FAILED_CODE)
+        cursor = self.get_cursor_argument()
+        order_by = self.get_argument('order_by')
+
+        try:
+            filters = self.get_filter_arguments()
+            (items, next_cursor) = self.queries.read_page(count, cursor=cursor,
+                                                          offset=skip,
+                                                          order_by=order_by,
+                                                          filters=filters)
+        except ValueError:
+            return self.render(status_code=self._FAILED_CODE)
+
+        self.add_to_payload('cursor', next_cursor)
+        return self._generate_response(items)
 
     def get(self, ids=""):
         """HTTP GET implementation.
 
         IDs:
-          * 0 IDs: produces a list of items presented. Paging will be available
-            soon.
+          * 0 IDs: produces a page of items presented. See `get_page`.
           * 1 ID: This produces the corresponding document.
           * N IDs: This produces a list of corresponding documents.
 
         Data: N/A
         """
         
+        if not ids:
+            return self.get_page()
+
         try:
             ### Setup environment
             is_list = isinstance(ids, list)
@@ -0,0 +1,35 @@
+"""A handler that reports how the caches are behaving.
+
+Route it like any other handler, ideally somewhere only operators can reach:
+
+    handler_tuples = [(r'^/_cache$', CacheStatsHandler)]
+
+It reports every `caching.InstrumentedCacheStore`, the app's cache store if
+it isn't instrumented, the app's fragment cache and the pools of every
+`redispool.RedisConnectionManager`.
+"""
+
+from caching import InstrumentedCacheStore, instrumented_stores
+from redispool import connection_managers
+from request_handling import JSONMessageHandler
+
+
+class CacheStatsHandler(JSONMessageHandler):
+    """Responds to GET with cache stats as JSON.
+    """
+    def get(self):
+        stores = dict((name, store.stats())
+                      for name, store in instrumented_stores().items())
+
+        cache_store = self.application.cache_store
+        if (cache_store is not None and
+            not isinstance(cache_store, InstrumentedCacheStore)):
+            stores['cache_store'] = cache_store.stats()
+
+        self.add_to_payload('cache_stores', stores)
+        self.add_to_payload('fragments',
+                            self.application.fragment_cache.stats())
+        self.add_to_payload('connections',
+                            dict((name, manager.stats()) for name, manager
+                                 in connection_managers().items()))
+        return self.render(status_code=200)
@@ -1,5 +1,21 @@
 import os
+import sys
+import mmap
+import zlib
+import fcntl
+import struct
 import time
+import math
+import heapq
+import random
+import sqlite3
+import inspect
+import logging
+import weakref
+import functools
+import itertools
+import cPickle as pickle
+from collections import OrderedDict
 from exceptions import NotImplementedError
 
 
@@ -17,13 +33,58 @@ def generate_session_id():
 ### Cache storage
 ###
 
+def approximate_memory(mapping, sample_size=64):
+    """Estimates the bytes used by a dict of cache items by measuring up to
+    `sample_size` of them with `sys.getsizeof`.
+    """
+    count = len(mapping)
+    memory = sys.getsizeof(mapping)
+    if not count:
+        return memory
+    sampled = 0
+    total = 0
+    for key, item in itertools.islice(mapping.iteritems(), sample_size):
+        parts = item.values() if isinstance(item, dict) else item
+        total += sys.getsizeof(key) + sys.getsizeof(item)
+        total += sum(sys.getsizeof(part) for part in parts)
+        sampled += 1
+    return memory + total * count // sampled
+
+
 class BaseCacheStore(object):
     """Ram based cache storage. Essentially uses a dictionary stored in
     the app to store cache id => serialized cache data
+
+    Expiration times are kept in a min-heap so `delete_expired` can purge
+    expired entries without scanning the whole store.
+
+    `stores_objects` is True for stores that keep Python objects as they
+    are. Others need strings.
     """
+    stores_objects = True
+
     def __init__(self, **kwargs):
         super(BaseCacheStore, self).__init__(**kwargs)
         self._cache_store = dict()
+        self._expire_heap = list()
+
+    def _compact_heap(self):
+        """Drops heap entries for keys that were deleted, saved again or
+        touched.
+        """
+        self._expire_heap = [(item['expire'], key)
+                             for key, item in self._cache_store.items()
+                             if item['expire']]
+        heapq.heapify(self._expire_heap)
+
+    def _push_expire(self, expire, key):
+        """Adds an expiration time to the heap. Entries that no longer
+        match their key's expiration are left in place until they outnumber
+        the live ones, then the heap is rebuilt.
+        """
+        heapq.heappush(self._expire_heap, (expire, key))
+        if len(self._expire_heap) > 2 * len(self._cache_store) + 64:
+            self._compact_heap()
 
     def save(self, key, data, expire=None):
         """Save the cache data and metadata to the backend storage
@@ -35,6 +96,8 @@ class BaseCacheStore(object):
             'expire': expire,
         }
         self._cache_store[key] = cache_item
+        if expire:
+            self._push_expire(expire, key)
 
     def load(self, key):
         """Load the stored data from storage backend or return None if the
@@ -57,14 +120,750 @@ class BaseCacheStore(object):
         if key in self._cache_store:
             del self._cache_store[key]
 
-    def delete_expired(self):
-        """Deletes sessions with timestamps in the past from storage.
+    def touch(self, key, expire=None):
+        """Changes the expiration time of `key` without saving its data
+        again.
+        """
+        item = self._cache_store.get(key)
+        if item is None:
+            return
+        item['expire'] = expire
+        if expire:
+            self._push_expire(expire, key)
+
+    def load_many(self, keys):
+        """Returns a list with the data stored for each key in `keys`, with
+        None for keys that were not found or have expired.
+        """
+        now = time.time()
+        get = self._cache_store.get
+        values = list()
+        for key in keys:
+            item = get(key)
+            if item is None or (item['expire'] and item['expire'] <= now):
+                values.append(None)
+            else:
+                values.append(item['data'])
+        return values
+
+    def save_many(self, mapping, expire=None):
+        """Saves each key => data pair in `mapping` with the same `expire`.
+        """
+        for key, data in mapping.iteritems():
+            self.save(key, data, expire=expire)
+
+    def delete_many(self, keys):
+        """Removes every key in `keys` from storage.
+        """
+        for key in keys:
+            self.delete(key)
+
+    def memory_footprint(self):
+        """Returns the approximate number of bytes used by the entries and
+        the expiration heap.
+        """
+        heap = self._expire_heap
+        return (approximate_memory(self._cache_store) + sys.getsizeof(heap) +
+                len(heap) * sys.getsizeof((0.0, '')))
+
+    def stats(self):
+        """Returns a dict describing what's in the store.
+        """
+        return {
+            'entries': len(self._cache_store),
+            'memory_bytes': self.memory_footprint(),
+        }
+
+    def delete_expired(self, max_items=None):
+        """Deletes sessions with timestamps in the past from storage. At most
+        `max_items` heap entries are examined if it's given. Returns the
+        number of entries deleted.
+        """
+        now = time.time()
+        heap = self._expire_heap
+        examined = 0
+        deleted = 0
+        while heap and heap[0][0] <= now:
+            if max_items is not None and examined >= max_items:
+                break
+            (expire, key) = heapq.heappop(heap)
+            examined += 1
+            item = self._cache_store.get(key)
+            ### Skip heap entries for keys deleted or saved since
+            if item is not None and item['expire'] == expire:
+                del self._cache_store[key]
+                deleted += 1
+        return deleted
+
+    def has_expired(self):
+        """Returns True if `delete_expired` has entries left to examine.
+        """
+        heap = self._expire_heap
+        return bool(heap) and heap[0][0] <= time.time()
+
+###
+### Bounded Cache Store
+###
+
+class LRUCacheStore(BaseCacheStore):
+    """Ram based cache storage with a limit on the number of entries and/or
+    the approximate number of bytes stored. The least recently used entries
+    are evicted to stay within the limits.
+
+    Expiration times are kept in a min-heap, so `delete_expired` only looks
+    at entries that have actually expired. It accepts `max_items` to purge
+    in small increments.
+
+    `evictions` and `expirations` count the entries removed for each reason.
+    A value bigger than `max_bytes` on its own is not stored, since it
+    would push every other entry out. `rejected` counts those.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, **kwargs):
+        super(LRUCacheStore, self).__init__(**kwargs)
+        self._cache_store = OrderedDict()
+        self._expire_heap = list()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+    def _sizeof(self, key, data):
+        if isinstance(data, basestring):
+            return len(key) + len(data)
+        return len(key) + sys.getsizeof(data)
+
+    def _remove(self, key):
+        (data, expire, size) = self._cache_store.pop(key)
+        self.size_bytes -= size
+
+    def _evict(self):
+        while self._cache_store and (
+            (self.max_entries is not None and
+             len(self._cache_store) > self.max_entries) or
+            (self.max_bytes is not None and self.size_bytes > self.max_bytes)):
+            key = next(iter(self._cache_store))
+            self._remove(key)
+            self.evictions += 1
+
+    def _compact_heap(self):
+        self._expire_heap = [(item[1], key)
+                             for key, item in self._cache_store.items()
+                             if item[1]]
+        heapq.heapify(self._expire_heap)
+
+    def save(self, key, data, expire=None):
+        if key in self._cache_store:
+            self._remove(key)
+        size = self._sizeof(key, data)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.rejected += 1
+            return
+        self._cache_store[key] = (data, expire, size)
+        self.size_bytes += size
+        if expire:
+            self._push_expire(expire, key)
+        self._evict()
+
+    def load(self, key):
+        item = self._cache_store.get(key)
+        if item is None:
+            return None
+        (data, expire, size) = item
+        if expire and expire <= time.time():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        ### Move to the most recently used end
+        del self._cache_store[key]
+        self._cache_store[key] = item
+        return data
+
+    def delete(self, key):
+        if key in self._cache_store:
+            self._remove(key)
+
+    def touch(self, key, expire=None):
+        item = self._cache_store.get(key)
+        if item is None:
+            return
+        self._cache_store[key] = (item[0], expire, item[2])
+        if expire:
+            self._push_expire(expire, key)
+
+    def load_many(self, keys):
+        now = time.time()
+        cache_store = self._cache_store
+        values = list()
+        for key in keys:
+            item = cache_store.get(key)
+            if item is None:
+                values.append(None)
+                continue
+            if item[1] and item[1] <= now:
+                self._remove(key)
+                self.expirations += 1
+                values.append(None)
+                continue
+            del cache_store[key]
+            cache_store[key] = item
+            values.append(item[0])
+        return values
+
+    def delete_expired(self, max_items=None):
+        """Deletes entries whose expiration time has passed, oldest first.
+        At most `max_items` heap entries are examined if it's given. Returns
+        the number of entries deleted.
+        """
+        now = time.time()
+        heap = self._expire_heap
+        examined = 0
+        deleted = 0
+        while heap and heap[0][0] <= now:
+            if max_items is not None and examined >= max_items:
+                break
+            (expire, key) = heapq.heappop(heap)
+            examined += 1
+            item = self._cache_store.get(key)
+            ### Skip heap entries for keys deleted or saved since
+            if item is not None and item[1] == expire:
+                self._remove(key)
+                self.expirations += 1
+                deleted += 1
+        return deleted
+
+    def stats(self):
+        stats = super(LRUCacheStore, self).stats()
+        stats.update({
+            'size_bytes': self.size_bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'rejected': self.rejected,
+        })
+        return stats
+
+    def __len__(self):
+        return len(self._cache_store)
+
+
+###
+### SQLite Cache Store
+###
+
+class SQLiteCacheStore(BaseCacheStore):
+    """Cache storage in a local SQLite database in WAL mode, for working sets
+    too large for RAM. Entries survive restarts, so new workers start warm,
+    and several processes can share one file.
+
+    `max_bytes` bounds the size of the stored data, counting unicode as
+    UTF-8. The least recently used entries are evicted until it's under
+    `evict_ratio` of the limit, so eviction doesn't run on every save. The
+    pages they free are then given back to the filesystem, and the WAL is
+    truncated to `JOURNAL_SIZE_LIMIT` after checkpoints, so the file stays
+    near `max_bytes` plus SQLite's own overhead. Databases created before
+    incremental vacuuming was turned on need one `VACUUM` to pick it up.
+
+    Access times are buffered in memory and written in batches of
+    `access_batch_size`, so reads don't each cost a write. Eviction is
+    therefore approximately LRU.
+
+    Data must be a `str` or `unicode`.
+    """
+    stores_objects = False
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache ('
+        '  key TEXT PRIMARY KEY,'
+        '  data BLOB,'
+        '  expire REAL,'
+        '  size INTEGER,'
+        '  accessed REAL)',
+        'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+        'CREATE INDEX IF NOT EXISTS cache_expire ON cache (expire)',
+    )
+    MAX_VARIABLES = 500
+    JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, path, max_bytes=None, evict_ratio=0.9,
+                 access_batch_size=256, **kwargs):
+        super(SQLiteCacheStore, self).__init__(**kwargs)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_ratio = evict_ratio
+        self.access_batch_size = access_batch_size
+        self.evictions = 0
+        self.expirations = 0
+        self._accessed = dict()
+
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False)
+        ### auto_vacuum only takes effect before the first table is created
+        self._conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA journal_size_limit=%d' %
+                           self.JOURNAL_SIZE_LIMIT)
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+        self.size_bytes = self._total_size()
+
+    def _total_size(self):
+        return self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def _to_db(self, data):
+        if isinstance(data, str):
+            return buffer(data)
+        return data
+
+    def _from_db(self, data):
+        if isinstance(data, buffer):
+            return str(data)
+        return data
+
+    def _size(self, data):
+        """Returns the bytes `data` takes in the database. SQLite stores
+        text as UTF-8.
+        """
+        if isinstance(data, unicode):
+            return len(data.encode('utf-8'))
+        return len(data)
+
+    def _flush_accessed(self):
+        if not self._accessed:
+            return
+        with self._conn:
+            self._conn.executemany(
+                'UPDATE cache SET accessed = ? WHERE key = ?',
+                [(accessed, key) for key, accessed in self._accessed.items()])
+        self._accessed.clear()
+
+    def _note_access(self, key, now):
+        self._accessed[key] = now
+        if len(self._accessed) >= self.access_batch_size:
+            self._flush_accessed()
+
+    def _evict(self):
+        if self.max_bytes is None or self.size_bytes <= self.max_bytes:
+            return
+        ### Other processes may have written too, so count what's there
+        self._flush_accessed()
+        self.size_bytes = self._total_size()
+        target = self.max_bytes * self.evict_ratio
+        while self.size_bytes > target:
+            rows = self._conn.execute(
+                'SELECT key, size FROM cache ORDER BY accessed LIMIT ?',
+                (self.MAX_VARIABLES,)).fetchall()
+            if not rows:
+                break
+            keys = list()
+            for key, size in rows:
+                keys.append(key)
+                self.size_bytes -= size
+                if self.size_bytes <= target:
+                    break
+            self._delete_rows(keys)
+            self.evictions += len(keys)
+        ### Each result row is one freed page, so step through all of them
+        self._conn.execute('PRAGMA incremental_vacuum').fetchall()
+
+    def _delete_rows(self, keys):
+        with self._conn:
+            for i in xrange(0, len(keys), self.MAX_VARIABLES):
+                chunk = keys[i:i + self.MAX_VARIABLES]
+                self._conn.execute(
+                    'DELETE FROM cache WHERE key IN (%s)' %
+                    ','.join('?' * len(chunk)), chunk)
+
+    def _rows(self, data_pairs, expire):
+        now = time.time()
+        for key, data in data_pairs:
+            yield (key, self._to_db(data), expire, self._size(data), now)
+
+    def save(self, key, data, expire=None):
+        self.save_many({key: data}, expire=expire)
+
+    def save_many(self, mapping, expire=None):
+        if not mapping:
+            return
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, data, expire, size, '
+                'accessed) VALUES (?, ?, ?, ?, ?)',
+                self._rows(mapping.iteritems(), expire))
+        self.size_bytes += sum(self._size(data)
+                               for data in mapping.itervalues())
+        for key in mapping:
+            self._accessed.pop(key, None)
+        self._evict()
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def load_many(self, keys):
+        now = time.time()
+        found = dict()
+        expired = list()
+        for i in xrange(0, len(keys), self.MAX_VARIABLES):
+            chunk = keys[i:i + self.MAX_VARIABLES]
+            rows = self._conn.execute(
+                'SELECT key, data, expire FROM cache WHERE key IN (%s)' %
+                ','.join('?' * len(chunk)), chunk)
+            for key, data, expire in rows:
+                if expire and expire <= now:
+                    expired.append(key)
+                    continue
+                found[key] = self._from_db(data)
+                self._note_access(key, now)
+        if expired:
+            self.delete_many(expired)
+            self.expirations += len(expired)
+        return [found.get(key) for key in keys]
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        self._delete_rows(list(keys))
+        for key in keys:
+            self._accessed.pop(key, None)
+
+    def touch(self, key, expire=None):
+        with self._conn:
+            self._conn.execute('UPDATE cache SET expire = ? WHERE key = ?',
+                               (expire, key))
+
+    def delete_expired(self, max_items=None):
+        """Deletes up to `max_items` entries whose expiration time has
+        passed. Returns the number of entries deleted.
         """
-        del_keys = list()
-        for key, data in self._cache_store.items():
-            if data.get('expire', None) and data['expire'] < time.time():
-                del_keys.append(key)
-        map(self.delete, del_keys)
+        limit = -1 if max_items is None else max_items
+        with self._conn:
+            cursor = self._conn.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                'WHERE expire IS NOT NULL AND expire <= ? LIMIT ?)',
+                (time.time(), limit))
+        self.expirations += cursor.rowcount
+        return cursor.rowcount
+
+    def has_expired(self):
+        return self._conn.execute(
+            'SELECT 1 FROM cache WHERE expire IS NOT NULL AND expire <= ? '
+            'LIMIT 1', (time.time(),)).fetchone() is not None
+
+    def disk_footprint(self):
+        """Returns the bytes used by the database file and its WAL.
+        """
+        total = 0
+        for path in (self.path, self.path + '-wal'):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def stats(self):
+        return {
+            'entries': self._conn.execute(
+                'SELECT COUNT(*) FROM cache').fetchone()[0],
+            'size_bytes': self.size_bytes,
+            'disk_bytes': self.disk_footprint(),
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def close(self):
+        self._flush_accessed()
+        self._conn.close()
+
+
+###
+### Shared Memory Cache Store
+###
+
+class SharedMemoryCacheStore(BaseCacheStore):
+    """Cache storage in a memory mapped file shared by every process on a
+    host that opens the same `path`, eg. one under `/dev/shm`.
+
+    The file is a fixed size hash table of `slot_count` slots of
+    `slot_size` bytes. A key lives in one of the `max_probes` slots after
+    the slot its hash points to. When they're all taken, the oldest write
+    is evicted. Entries whose key and data don't fit in a slot aren't
+    cached and are counted in `rejected`.
+
+    Writers take `fcntl` locks, one for the key's home slot and one for the
+    slot they write. Readers don't lock. Every slot starts with a sequence
+    number that writers make odd while they write and even again when
+    they're done, and readers retry if it changed under them.
+
+    Data must be a `str` or `unicode`. `delete_expired` scans slots, so
+    expired entries are mostly reclaimed by saves and loads.
+    """
+    stores_objects = False
+
+    MAGIC = 'BRUBECK-SHM-1'
+    FILE_HEADER = struct.Struct('<16sII')
+    SLOT_HEADER = struct.Struct('<QIBHIdd')
+    SEQ = struct.Struct('<Q')
+    EMPTY, BYTES, TEXT = 0, 1, 2
+    READ_RETRIES = 16
+
+    def __init__(self, path, slot_count=16384, slot_size=1024, max_probes=8,
+                 **kwargs):
+        super(SharedMemoryCacheStore, self).__init__(**kwargs)
+        self.path = path
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.max_probes = min(max_probes, slot_count)
+        self.capacity = slot_size - self.SLOT_HEADER.size
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+        self.read_retries = 0
+        self._sweep_cursor = 0
+        self._sweep_remaining = slot_count
+
+        self._offset = self.FILE_HEADER.size
+        size = self._offset + slot_count * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._lock(2 * slot_count)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.write(self._fd, self.FILE_HEADER.pack(self.MAGIC,
+                                                         slot_count,
+                                                         slot_size))
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            header = os.read(self._fd, self.FILE_HEADER.size)
+        finally:
+            self._unlock(2 * slot_count)
+        (magic, file_slot_count, file_slot_size) = \
+            self.FILE_HEADER.unpack(header)
+        if (magic.rstrip('\0') != self.MAGIC or
+            (file_slot_count, file_slot_size) != (slot_count, slot_size)):
+            raise ValueError('%s is not a cache with %d slots of %d bytes' %
+                             (path, slot_count, slot_size))
+        self._mm = mmap.mmap(self._fd, size, mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE)
+
+    ### Locks are on byte offsets of the file, but they don't protect the
+    ### bytes at those offsets. Offsets below `slot_count` lock home slots,
+    ### the next `slot_count` lock the slots being written.
+
+    def _lock(self, offset):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+
+    def _unlock(self, offset):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+    def _encode_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
+    def _home(self, key):
+        key_hash = zlib.crc32(key) & 0xffffffff
+        return (key_hash, key_hash % self.slot_count)
+
+    def _slot_offset(self, index):
+        return self._offset + index * self.slot_size
+
+    def _read_slot(self, index):
+        """Returns a consistent copy of a slot's header and payload."""
+        offset = self._slot_offset(index)
+        end = offset + self.slot_size
+        mm = self._mm
+        for attempt in xrange(self.READ_RETRIES):
+            raw = mm[offset:end]
+            seq = self.SEQ.unpack_from(raw)[0]
+            if seq % 2 == 0 and self.SEQ.unpack_from(mm, offset)[0] == seq:
+                return (self.SLOT_HEADER.unpack_from(raw), raw)
+            self.read_retries += 1
+        return (None, None)
+
+    def _write_slot(self, index, key_hash, state, key, data, expire,
+                    written):
+        offset = self._slot_offset(index)
+        lock = self.slot_count + index
+        self._lock(lock)
+        try:
+            mm = self._mm
+            seq = self.SEQ.unpack_from(mm, offset)[0]
+            self.SEQ.pack_into(mm, offset, seq + 1)
+            header = self.SLOT_HEADER.pack(seq + 1, key_hash, state, len(key),
+                                           len(data), expire or 0.0, written)
+            body_start = offset + self.SLOT_HEADER.size
+            mm[offset + self.SEQ.size:body_start] = header[self.SEQ.size:]
+            payload = key + data
+            mm[body_start:body_start + len(payload)] = payload
+            self.SEQ.pack_into(mm, offset, seq + 2)
+        finally:
+            self._unlock(lock)
+
+    def _probe(self, home):
+        for i in xrange(self.max_probes):
+            yield (home + i) % self.slot_count
+
+    def _find(self, key, key_hash, home):
+        """Returns the slot index, header and raw copy for `key`, or None."""
+        for index in self._probe(home):
+            (header, raw) = self._read_slot(index)
+            if header is None or header[2] == self.EMPTY:
+                continue
+            (seq, slot_hash, state, key_len, data_len, expire, written) = header
+            if slot_hash != key_hash:
+                continue
+            start = self.SLOT_HEADER.size
+            if raw[start:start + key_len] != key:
+                continue
+            return (index, header, raw)
+        return None
+
+    def save(self, key, data, expire=None):
+        key = self._encode_key(key)
+        state = self.BYTES
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+            state = self.TEXT
+        if len(key) + len(data) > self.capacity:
+            self.rejected += 1
+            self.delete(key)
+            return
+
+        (key_hash, home) = self._home(key)
+        now = time.time()
+        self._lock(home)
+        try:
+            found = self._find(key, key_hash, home)
+            if found is not None:
+                index = found[0]
+            else:
+                index = None
+                oldest = None
+                for candidate in self._probe(home):
+                    (header, raw) = self._read_slot(candidate)
+                    if header is None:
+                        continue
+                    if header[2] == self.EMPTY or (header[5] and
+                                                   header[5] <= now):
+                        index = candidate
+                        break
+                    if oldest is None or header[6] < oldest[1]:
+                        oldest = (candidate, header[6])
+                if index is None:
+                    if oldest is None:
+                        self.rejected += 1
+                        return
+                    index = oldest[0]
+                    self.evictions += 1
+            self._write_slot(index, key_hash, state, key, data, expire, now)
+        finally:
+            self._unlock(home)
+
+    def load(self, key):
+        key = self._encode_key(key)
+        (key_hash, home) = self._home(key)
+        found = self._find(key, key_hash, home)
+        if found is None:
+            return None
+        (index, header, raw) = found
+        (seq, slot_hash, state, key_len, data_len, expire, written) = header
+        if expire and expire <= time.time():
+            self.delete(key)
+            self.expirations += 1
+            return None
+        start = self.SLOT_HEADER.size + key_len
+        data = raw[start:start + data_len]
+        if state == self.TEXT:
+            data = data.decode('utf-8')
+        return data
+
+    def load_many(self, keys):
+        return [self.load(key) for key in keys]
+
+    def _update(self, key, change):
+        key = self._encode_key(key)
+        (key_hash, home) = self._home(key)
+        self._lock(home)
+        try:
+            found = self._find(key, key_hash, home)
+            if found is None:
+                return False
+            (index, header, raw) = found
+            (seq, slot_hash, state, key_len, data_len, expire, written) = header
+            start = self.SLOT_HEADER.size
+            payload = raw[start:start + key_len + data_len]
+            (state, expire) = change(state, expire)
+            self._write_slot(index, key_hash, state, payload[:key_len],
+                             payload[key_len:], expire, written)
+            return True
+        finally:
+            self._unlock(home)
+
+    def delete(self, key):
+        self._update(key, lambda state, expire: (self.EMPTY, expire))
+
+    def touch(self, key, expire=None):
+        self._update(key, lambda state, old_expire: (state, expire))
+
+    def delete_expired(self, max_items=None):
+        """Examines up to `max_items` slots, continuing where the last call
+        stopped, and deletes entries that have expired. Returns the number
+        of entries deleted.
+        """
+        if max_items is None:
+            max_items = self.slot_count
+        now = time.time()
+        deleted = 0
+        examined = min(max_items, self.slot_count)
+        self._sweep_remaining = max(self._sweep_remaining - examined, 0)
+        for i in xrange(examined):
+            index = self._sweep_cursor
+            self._sweep_cursor = (index + 1) % self.slot_count
+            (header, raw) = self._read_slot(index)
+            if header is None or header[2] == self.EMPTY:
+                continue
+            if header[5] and header[5] <= now:
+                key = raw[self.SLOT_HEADER.size:
+                          self.SLOT_HEADER.size + header[3]]
+                if self._update(key, lambda state, expire:
+                                (self.EMPTY, expire)):
+                    deleted += 1
+        self.expirations += deleted
+        return deleted
+
+    def has_expired(self):
+        """Returns True until `delete_expired` has examined every slot once,
+        then False and starts counting the next lap.
+        """
+        if self._sweep_remaining:
+            return True
+        self._sweep_remaining = self.slot_count
+        return False
+
+    def stats(self):
+        entries = 0
+        for index in xrange(self.slot_count):
+            offset = self._slot_offset(index) + self.SEQ.size + 4
+            if self._mm[offset] != '\0':
+                entries += 1
+        return {
+            'entries': entries,
+            'slots': self.slot_count,
+            'memory_bytes': len(self._mm),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'rejected': self.rejected,
+            'read_retries': self.read_retries,
+        }
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
 
 ###
 ### Redis Cache Store
@@ -89,6 +888,8 @@ class RedisCacheStore(BaseCacheStore):
     https://github.com/andymccurdy/redis-py
     """
     
+    stores_objects = False
+
     def __init__(self, redis_connection=None, **kwargs):
         super(RedisCacheStore, self).__init__(**kwargs)
         self._cache_store = redis_connection
@@ -115,6 +916,868 @@ class RedisCacheStore(BaseCacheStore):
     
     def delete(self, key):
         self._cache_store.delete(key)
+
+    def touch(self, key, expire=None):
+        """Sets a new EXPIRE without sending the data again."""
+        if expire:
+            self._cache_store.expireat(key, int(expire))
+        else:
+            self._cache_store.persist(key)
+
+    def load_many(self, keys):
+        """Loads every key with a single MGET."""
+        if not keys:
+            return list()
+        return self._cache_store.mget(keys)
+
+    def save_many(self, mapping, expire=None):
+        """Sets every key, and its EXPIRE, in one pipeline."""
+        if not mapping:
+            return
+        pipe = self._cache_store.pipeline()
+        if expire:
+            expire_seconds = expire - time.time()
+            assert(expire_seconds > 0)
+        for key, data in mapping.iteritems():
+            pipe.set(key, data)
+            if expire:
+                pipe.expire(key, int(expire_seconds))
+        pipe.execute()
+
+    def delete_many(self, keys):
+        if keys:
+            self._cache_store.delete(*keys)
+
+    def stats(self):
+        """Entries and memory live in Redis. See `INFO` there."""
+        return dict()
         
-    def delete_expired(self):
+    def delete_expired(self, max_items=None):
+        raise NotImplementedError
+
+    def has_expired(self):
         raise NotImplementedError
+
+
+###
+### Tiered Cache Store
+###
+
+class RedisInvalidator(object):
+    """Sends and receives cache invalidations over Redis pub/sub on
+    `channel`. Pass the Redis connection instance as `redis_connection`.
+
+    The listener blocks on the pub/sub socket, so the socket module must be
+    monkey patched for it to cooperate with other coroutines.
+    """
+    def __init__(self, redis_connection, channel='brubeck:invalidate'):
+        self.redis_connection = redis_connection
+        self.channel = channel
+
+    def publish(self, message):
+        self.redis_connection.publish(self.channel, message)
+
+    def listen(self, callback):
+        """Calls `callback` with every message published on `channel`,
+        forever.
+        """
+        pubsub = self.redis_connection.pubsub()
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                callback(message['data'])
+
+
+class ZMQInvalidator(object):
+    """Sends cache invalidations on a zmq PUB socket and receives them on a
+    SUB socket. How the sockets are connected is up to the deployment, eg.
+    every worker connecting both to a forwarder device.
+    """
+    def __init__(self, pub_socket, sub_socket):
+        from connections import load_zmq
+        zmq = load_zmq()
+        self.pub_socket = pub_socket
+        self.sub_socket = sub_socket
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, '')
+
+    def publish(self, message):
+        self.pub_socket.send(message)
+
+    def listen(self, callback):
+        while True:
+            callback(self.sub_socket.recv())
+
+
+class TieredCacheStore(BaseCacheStore):
+    """Keeps recently read entries of a shared cache store, like
+    `RedisCacheStore`, in a bounded in-process `LRUCacheStore`.
+
+    Entries are kept in the L1 for at most `l1_ttl` seconds. Writes and
+    deletes go to both tiers and are announced through `invalidator`, a
+    `RedisInvalidator` or `ZMQInvalidator`, so other processes drop the key
+    from their L1 too. Without an invalidator, other processes may serve a
+    stale entry for up to `l1_ttl` seconds.
+
+    `Brubeck.run()` calls `start()` to listen for invalidations. `l1_hits`,
+    `l2_hits` and `misses` count where each load was answered.
+    """
+    def __init__(self, l2_store, invalidator=None, l1_max_entries=4096,
+                 l1_ttl=1.0, **kwargs):
+        super(TieredCacheStore, self).__init__(**kwargs)
+        self.l1_store = LRUCacheStore(max_entries=l1_max_entries)
+        self.l2_store = l2_store
+        self.invalidator = invalidator
+        self.l1_ttl = l1_ttl
+        self.origin = os.urandom(8).encode('hex')
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+
+    @property
+    def stores_objects(self):
+        return self.l2_store.stores_objects
+
+    def _l1_save(self, key, data, expire=None):
+        l1_expire = time.time() + self.l1_ttl
+        if expire:
+            l1_expire = min(expire, l1_expire)
+        self.l1_store.save(key, data, expire=l1_expire)
+
+    def _announce(self, *keys):
+        if self.invalidator is not None and keys:
+            self.invalidator.publish('%s %s' % (self.origin, '\n'.join(keys)))
+
+    def save(self, key, data, expire=None):
+        self.l2_store.save(key, data, expire=expire)
+        self._l1_save(key, data, expire)
+        self._announce(key)
+
+    def load(self, key):
+        data = self.l1_store.load(key)
+        if data is not None:
+            self.l1_hits += 1
+            return data
+        data = self.l2_store.load(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.l2_hits += 1
+        self._l1_save(key, data)
+        return data
+
+    def delete(self, key):
+        self.l2_store.delete(key)
+        self.l1_store.delete(key)
+        self._announce(key)
+
+    def touch(self, key, expire=None):
+        """Extends the entry in the L2. The L1 copy keeps its short TTL."""
+        self.l2_store.touch(key, expire=expire)
+
+    def load_many(self, keys):
+        """Loads what it can from the L1 and the rest from the L2 in one
+        `load_many` call.
+        """
+        values = self.l1_store.load_many(keys)
+        missing = [i for i, value in enumerate(values) if value is None]
+        self.l1_hits += len(keys) - len(missing)
+        if not missing:
+            return values
+        l2_values = self.l2_store.load_many([keys[i] for i in missing])
+        for i, data in zip(missing, l2_values):
+            if data is None:
+                self.misses += 1
+                continue
+            self.l2_hits += 1
+            self._l1_save(keys[i], data)
+            values[i] = data
+        return values
+
+    def save_many(self, mapping, expire=None):
+        self.l2_store.save_many(mapping, expire=expire)
+        for key, data in mapping.iteritems():
+            self._l1_save(key, data, expire)
+        self._announce(*mapping.keys())
+
+    def delete_many(self, keys):
+        self.l2_store.delete_many(keys)
+        self.l1_store.delete_many(keys)
+        self._announce(*keys)
+
+    def delete_expired(self, max_items=None):
+        """Purges expired entries from the L1. The L2 manages its own
+        expiration.
+        """
+        return self.l1_store.delete_expired(max_items=max_items)
+
+    def has_expired(self):
+        return self.l1_store.has_expired()
+
+    def stats(self):
+        return {
+            'l1_hits': self.l1_hits,
+            'l2_hits': self.l2_hits,
+            'misses': self.misses,
+            'l1': self.l1_store.stats(),
+            'l2': self.l2_store.stats(),
+        }
+
+    def handle_invalidation(self, message):
+        """Drops the keys named in an invalidation `message` from the L1,
+        unless this store sent it. Keys are separated by newlines.
+        """
+        (origin, sep, keys) = message.partition(' ')
+        if origin != self.origin:
+            self.l1_store.delete_many(keys.split('\n'))
+
+    def start(self, pool):
+        """Spawns the invalidation listener on `pool`.
+        """
+        if self.invalidator is not None:
+            return pool.spawn(self.invalidator.listen,
+                              self.handle_invalidation)
+
+
+###
+### Instrumentation
+###
+
+class LatencyHistogram(object):
+    """Counts durations in power of two buckets of microseconds, from under
+    1us to over 16s.
+    """
+    BUCKETS = 26
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = int(seconds * 1000000)
+        bucket = min(micros.bit_length(), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Returns the upper bound, in seconds, of the bucket that holds the
+        `fraction` quantile, eg. 0.99.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return (1 << bucket) / 1000000.0
+        return self.max
+
+    def to_dict(self):
+        mean = 0.0
+        if self.count:
+            mean = self.total / self.count
+        return {
+            'count': self.count,
+            'mean': mean,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+_instrumented_stores = weakref.WeakValueDictionary()
+
+
+def instrumented_stores():
+    """Returns a dict mapping names to every live `InstrumentedCacheStore`.
+    """
+    return dict(_instrumented_stores.items())
+
+
+class InstrumentedCacheStore(BaseCacheStore):
+    """Wraps another cache store to count hits and misses and time every
+    call. `stats()` combines those with the wrapped store's own stats.
+
+    Instrumented stores are registered under `name`, which defaults to the
+    wrapped store's class name, so `cachestats.CacheStatsHandler` can
+    report on them. A name can only be taken by one live store at a time,
+    unless it wraps the same store. `close()` gives the name up.
+    """
+    OPERATIONS = ('load', 'save', 'delete', 'touch', 'load_many',
+                  'save_many', 'delete_many', 'delete_expired')
+
+    def __init__(self, cache_store, name=None, **kwargs):
+        super(InstrumentedCacheStore, self).__init__(**kwargs)
+        self.cache_store = cache_store
+        if name is None:
+            name = cache_store.__class__.__name__
+        registered = _instrumented_stores.get(name)
+        if (registered is not None and
+            registered.cache_store is not cache_store):
+            raise ValueError('A cache store is already instrumented as %r. '
+                             'Pass a different name.' % name)
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.latencies = dict((op, LatencyHistogram())
+                              for op in self.OPERATIONS)
+        _instrumented_stores[name] = self
+
+    @property
+    def stores_objects(self):
+        return self.cache_store.stores_objects
+
+    def _timed(self, op, *args, **kwargs):
+        start = time.time()
+        try:
+            return getattr(self.cache_store, op)(*args, **kwargs)
+        finally:
+            self.latencies[op].record(time.time() - start)
+
+    def save(self, key, data, expire=None):
+        self._timed('save', key, data, expire=expire)
+
+    def load(self, key):
+        data = self._timed('load', key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def delete(self, key):
+        self._timed('delete', key)
+
+    def touch(self, key, expire=None):
+        self._timed('touch', key, expire=expire)
+
+    def load_many(self, keys):
+        values = self._timed('load_many', keys)
+        found = len([value for value in values if value is not None])
+        self.hits += found
+        self.misses += len(values) - found
+        return values
+
+    def save_many(self, mapping, expire=None):
+        self._timed('save_many', mapping, expire=expire)
+
+    def delete_many(self, keys):
+        self._timed('delete_many', keys)
+
+    def delete_expired(self, max_items=None):
+        return self._timed('delete_expired', max_items=max_items)
+
+    def has_expired(self):
+        return self.cache_store.has_expired()
+
+    def close(self):
+        if _instrumented_stores.get(self.name) is self:
+            del _instrumented_stores[self.name]
+        if hasattr(self.cache_store, 'close'):
+            self.cache_store.close()
+
+    def start(self, pool):
+        if hasattr(self.cache_store, 'start'):
+            return self.cache_store.start(pool)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        stats = {
+            'store': self.cache_store.__class__.__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate,
+            'latency': dict((op, histogram.to_dict())
+                            for op, histogram in self.latencies.items()
+                            if histogram.count),
+        }
+        stats.update(self.cache_store.stats())
+        return stats
+
+
+###
+### Expiry sweeping
+###
+
+class ExpirySweeper(object):
+    """Purges expired entries from in-memory cache stores in the background.
+    `Brubeck.run()` spawns it on the app's pool.
+
+    Every `interval` seconds the sweeper calls `delete_expired` on each store
+    with `batch_size` entries at a time, until `has_expired` says nothing is
+    left to examine. It yields to other coroutines as
+    soon as it has been running for `max_pause` seconds, so a large backlog
+    of expired entries is purged in slices rather than in one long stall.
+
+    `max_rate` caps the number of entries purged per second. The default of
+    None purges everything that has expired on each pass.
+
+    Stores that can't be swept, like `RedisCacheStore`, are dropped with a
+    warning the first time they're tried.
+    """
+    def __init__(self, cache_stores, interval=1.0, batch_size=100,
+                 max_pause=0.005, max_rate=None):
+        if isinstance(cache_stores, BaseCacheStore):
+            cache_stores = [cache_stores]
+        self.cache_stores = list(cache_stores)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pause = max_pause
+        self.max_rate = max_rate
+        self.purged = 0
+        self.longest_pause = 0.0
+
+    def sweep_store(self, cache_store, budget=None):
+        """Purges up to `budget` expired entries from `cache_store`, yielding
+        every `max_pause` seconds. Returns the number of entries purged.
+        """
+        from request_handling import coro_sleep
+        purged = 0
+        slice_start = time.time()
+        while budget is None or purged < budget:
+            batch_size = self.batch_size
+            if budget is not None:
+                batch_size = min(batch_size, budget - purged)
+            purged += cache_store.delete_expired(max_items=batch_size)
+
+            now = time.time()
+            self.longest_pause = max(self.longest_pause, now - slice_start)
+            if not cache_store.has_expired():
+                break
+            if now - slice_start >= self.max_pause:
+                coro_sleep(0)
+                slice_start = time.time()
+        self.purged += purged
+        return purged
+
+    def sweep(self):
+        """Runs one pass over every store. Returns the number of entries
+        purged.
+        """
+        budget = None
+        if self.max_rate is not None:
+            budget = max(int(self.max_rate * self.interval), 1)
+        purged = 0
+        for cache_store in list(self.cache_stores):
+            try:
+                count = self.sweep_store(cache_store, budget)
+            except NotImplementedError:
+                logging.warning('%s can\'t be swept for expired entries' %
+                                cache_store.__class__.__name__)
+                self.cache_stores.remove(cache_store)
+                continue
+            purged += count
+            if budget is not None:
+                budget -= count
+                if budget <= 0:
+                    break
+        return purged
+
+    def run_sweeper(self):
+        """Sweeps every `interval` seconds, forever.
+        """
+        from request_handling import coro_sleep
+        while True:
+            coro_sleep(self.interval)
+            self.sweep()
+
+    def start(self, pool):
+        """Spawns the sweeper coroutine on `pool`.
+        """
+        return pool.spawn(self.run_sweeper)
+
+
+###
+### Fragment caching
+###
+
+class FragmentCache(object):
+    """Caches rendered fragments of a page, like a sidebar or navigation,
+    under an explicit key. Fragments are stored in any `BaseCacheStore`.
+
+    Hits, misses and render times are tracked per key. See `stats()`.
+    """
+    def __init__(self, cache_store=None, key_prefix='fragment:',
+                 default_ttl=None):
+        if cache_store is None:
+            cache_store = BaseCacheStore()
+        self.cache_store = cache_store
+        self.key_prefix = key_prefix
+        self.default_ttl = default_ttl
+        self._stats = dict()
+
+    def _key_stats(self, key):
+        if key not in self._stats:
+            self._stats[key] = {
+                'hits': 0,
+                'misses': 0,
+                'render_time': 0.0,
+            }
+        return self._stats[key]
+
+    def get_or_render(self, key, render_fun, ttl=None):
+        """Returns the fragment stored as `key`. On a miss `render_fun` is
+        called without arguments and its output is saved for `ttl` seconds.
+        A `ttl` of None uses `default_ttl`, which never expires by default.
+        """
+        key_stats = self._key_stats(key)
+        store_key = self.key_prefix + key
+
+        fragment = self.cache_store.load(store_key)
+        if fragment is not None:
+            key_stats['hits'] += 1
+            return fragment
+
+        key_stats['misses'] += 1
+        start = time.time()
+        fragment = render_fun()
+        key_stats['render_time'] += time.time() - start
+
+        if ttl is None:
+            ttl = self.default_ttl
+        expire = None
+        if ttl:
+            expire = time.time() + ttl
+        self.cache_store.save(store_key, fragment, expire=expire)
+        return fragment
+
+    def invalidate(self, key):
+        """Removes the fragment stored as `key`.
+        """
+        self.cache_store.delete(self.key_prefix + key)
+
+    def stats(self):
+        """Returns a dict mapping each fragment key to its hits, misses, hit
+        rate and the average time spent rendering it.
+        """
+        report = dict()
+        for key, key_stats in self._stats.items():
+            lookups = key_stats['hits'] + key_stats['misses']
+            hit_rate = 0.0
+            if lookups:
+                hit_rate = float(key_stats['hits']) / lookups
+            avg_render_time = 0.0
+            if key_stats['misses']:
+                avg_render_time = key_stats['render_time'] / key_stats['misses']
+            report[key] = {
+                'hits': key_stats['hits'],
+                'misses': key_stats['misses'],
+                'hit_rate': hit_rate,
+                'avg_render_time': avg_render_time,
+            }
+        return report
+
+
+###
+### Memoization
+###
+
+class Memoizer(object):
+    """Caches the results of function calls in a cache store.
+
+    Only one coroutine computes a missing key at a time. Others asking for
+    the same key wait for that result instead of computing it again.
+
+    Results are fresh for `ttl` seconds. For `stale_ttl` seconds after that
+    the stale result is still returned while one caller refreshes it. The
+    refresh runs on `pool` if one is given, otherwise in the caller that
+    found the stale entry.
+
+    `early_refresh` scales the chance of refreshing a fresh entry before it
+    expires. The chance grows as expiration approaches and with the time
+    the last computation took, so slow results are refreshed well before
+    they expire. 0 turns early refreshes off.
+    """
+    def __init__(self, cache_store=None, key_prefix='memo:', ttl=60,
+                 stale_ttl=0, early_refresh=1.0, pool=None):
+        if cache_store is None:
+            cache_store = BaseCacheStore()
+        self.cache_store = cache_store
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.early_refresh = early_refresh
+        self.pool = pool
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.early_refreshes = 0
+        self.waits = 0
+        self._in_flight = dict()
+
+    def _pack(self, entry):
+        if self.cache_store.stores_objects:
+            return entry
+        return pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+
+    def _unpack(self, data):
+        if self.cache_store.stores_objects:
+            return data
+        return pickle.loads(data)
+
+    def _compute(self, key, fun, args, kwargs, ttl, stale_ttl):
+        start = time.time()
+        value = fun(*args, **kwargs)
+        now = time.time()
+        fresh_until = now + ttl
+        entry = (value, fresh_until, now - start)
+        self.cache_store.save(key, self._pack(entry),
+                              expire=fresh_until + stale_ttl)
+        return value
+
+    def _subscribe(self, key):
+        """Returns a queue that receives the result of the computation in
+        flight for `key`.
+        """
+        from request_handling import coro_queue
+        queue = coro_queue()
+        self._in_flight[key].append(queue)
+        self.waits += 1
+        return queue
+
+    def _receive(self, queue):
+        (ok, value) = queue.get()
+        if not ok:
+            raise value
+        return value
+
+    def _release(self, key, ok, value):
+        for queue in self._in_flight.pop(key):
+            queue.put((ok, value))
+
+    def _interrupted(self, key):
+        return RuntimeError('Computing %s was interrupted' % key)
+
+    def _single_flight(self, key, fun, args, kwargs, ttl, stale_ttl):
+        if key in self._in_flight:
+            return self._receive(self._subscribe(key))
+
+        ### Waiters are released even if a BaseException, eg. a timeout or
+        ### a killed coroutine, interrupts the computation
+        self._in_flight[key] = list()
+        result = None
+        try:
+            value = self._compute(key, fun, args, kwargs, ttl, stale_ttl)
+            result = (True, value)
+        except Exception, e:
+            result = (False, e)
+            raise
+        finally:
+            if result is None:
+                result = (False, self._interrupted(key))
+            self._release(key, *result)
+        return value
+
+    def _compute_many(self, keys, store_keys, fun_many, ttl, stale_ttl):
+        """Computes `keys` with one call to `fun_many` and saves them with
+        one call to `save_many`.
+        """
+        for store_key in store_keys:
+            self._in_flight[store_key] = list()
+        results = None
+        try:
+            start = time.time()
+            values = list(fun_many(keys))
+            if len(values) != len(keys):
+                raise ValueError('Expected %d values, got %d' %
+                                 (len(keys), len(values)))
+            now = time.time()
+            fresh_until = now + ttl
+            delta = now - start
+            entries = dict((store_key, self._pack((value, fresh_until, delta)))
+                           for store_key, value in zip(store_keys, values))
+            self.cache_store.save_many(entries, expire=fresh_until + stale_ttl)
+            results = [(True, value) for value in values]
+        except Exception, e:
+            results = [(False, e)] * len(store_keys)
+            raise
+        finally:
+            if results is None:
+                error = self._interrupted(', '.join(store_keys))
+                results = [(False, error)] * len(store_keys)
+            for store_key, (ok, value) in zip(store_keys, results):
+                self._release(store_key, ok, value)
+        return values
+
+    def _background_refresh(self, key, fun, args, kwargs, ttl, stale_ttl):
+        try:
+            self._single_flight(key, fun, args, kwargs, ttl, stale_ttl)
+        except Exception, e:
+            logging.error('Refreshing %s failed: %s' % (key, e))
+
+    def _background_refresh_many(self, keys, store_keys, fun_many, ttl,
+                                 stale_ttl):
+        pairs = [(key, store_key) for key, store_key in zip(keys, store_keys)
+                 if store_key not in self._in_flight]
+        if not pairs:
+            return
+        try:
+            self._compute_many([p[0] for p in pairs], [p[1] for p in pairs],
+                               fun_many, ttl, stale_ttl)
+        except Exception, e:
+            logging.error('Refreshing %d keys failed: %s' % (len(pairs), e))
+
+    def _refresh(self, key, value, fun, args, kwargs, ttl, stale_ttl):
+        """Refreshes `key` unless it's already being computed. Returns the
+        new value if it was computed here, otherwise `value`.
+        """
+        if key in self._in_flight:
+            return value
+        if self.pool is not None:
+            self.pool.spawn(self._background_refresh, key, fun, args, kwargs,
+                            ttl, stale_ttl)
+            return value
+        return self._single_flight(key, fun, args, kwargs, ttl, stale_ttl)
+
+    def get(self, key, fun, args=(), kwargs=None, ttl=None, stale_ttl=None):
+        """Returns the result cached as `key`, calling `fun` with `args` and
+        `kwargs` to compute it if necessary.
+        """
+        if kwargs is None:
+            kwargs = dict()
+        if ttl is None:
+            ttl = self.ttl
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+        key = self.key_prefix + key
+
+        data = self.cache_store.load(key)
+        if data is None:
+            self.misses += 1
+            return self._single_flight(key, fun, args, kwargs, ttl, stale_ttl)
+
+        (value, fresh_until, delta) = self._unpack(data)
+        now = time.time()
+        if now >= fresh_until:
+            self.stale_hits += 1
+            return self._refresh(key, value, fun, args, kwargs, ttl,
+                                 stale_ttl)
+
+        self.hits += 1
+        if self.early_refresh and key not in self._in_flight:
+            ### Refresh with a probability that grows as expiration nears
+            gap = -delta * self.early_refresh * math.log(1.0 - random.random())
+            if now + gap >= fresh_until:
+                self.early_refreshes += 1
+                return self._refresh(key, value, fun, args, kwargs, ttl,
+                                     stale_ttl)
+        return value
+
+    def get_many(self, keys, fun_many, ttl=None, stale_ttl=None):
+        """Returns a list with the result cached as each key in `keys`.
+
+        Entries are read with one `load_many` call. Keys that are missing
+        are computed together by calling `fun_many` with a list of them,
+        which must return a list of values in the same order, and saved with
+        one `save_many` call. Stale entries are refreshed the same way, on
+        `pool` if one is given. Entries are not refreshed early.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+
+        unique_keys = list(OrderedDict.fromkeys(keys))
+        if len(unique_keys) != len(keys):
+            found = dict(zip(unique_keys, self.get_many(unique_keys, fun_many,
+                                                        ttl, stale_ttl)))
+            return [found[key] for key in keys]
+
+        store_keys = [self.key_prefix + key for key in keys]
+        values = list()
+        missing = list()
+        stale = list()
+        waiting = list()
+        now = time.time()
+        for i, data in enumerate(self.cache_store.load_many(store_keys)):
+            if data is None:
+                self.misses += 1
+                values.append(None)
+                if store_keys[i] in self._in_flight:
+                    waiting.append((i, self._subscribe(store_keys[i])))
+                else:
+                    missing.append(i)
+                continue
+            (value, fresh_until, delta) = self._unpack(data)
+            values.append(value)
+            if now < fresh_until:
+                self.hits += 1
+                continue
+            self.stale_hits += 1
+            if store_keys[i] not in self._in_flight:
+                stale.append(i)
+
+        if stale and self.pool is not None:
+            self.pool.spawn(self._background_refresh_many,
+                            [keys[i] for i in stale],
+                            [store_keys[i] for i in stale],
+                            fun_many, ttl, stale_ttl)
+        else:
+            missing.extend(stale)
+
+        if missing:
+            computed = self._compute_many([keys[i] for i in missing],
+                                          [store_keys[i] for i in missing],
+                                          fun_many, ttl, stale_ttl)
+            for i, value in zip(missing, computed):
+                values[i] = value
+        for i, queue in waiting:
+            values[i] = self._receive(queue)
+        return values
+
+    def invalidate(self, key):
+        self.cache_store.delete(self.key_prefix + key)
+
+    def invalidate_many(self, keys):
+        self.cache_store.delete_many([self.key_prefix + key for key in keys])
+
+    def memoize(self, key=None, ttl=None, stale_ttl=None):
+        """Decorator that caches the results of a function.
+
+        `key` is called with the function's arguments to build the cache
+        key. By default the key is built from the function's name and the
+        repr of its arguments, leaving out `self` for methods.
+
+        The decorated function gets an `invalidate` function that takes the
+        same arguments.
+        """
+        def decorator(fun):
+            if key is None:
+                name = '%s.%s' % (fun.__module__, fun.__name__)
+                argnames = inspect.getargspec(fun).args
+                skip = 1 if argnames and argnames[0] == 'self' else 0
+
+                def make_key(*args, **kwargs):
+                    return '%s%r%r' % (name, args[skip:],
+                                       sorted(kwargs.items()))
+            else:
+                make_key = key
+
+            @functools.wraps(fun)
+            def wrapper(*args, **kwargs):
+                return self.get(make_key(*args, **kwargs), fun, args, kwargs,
+                                ttl=ttl, stale_ttl=stale_ttl)
+
+            def invalidate(*args, **kwargs):
+                self.invalidate(make_key(*args, **kwargs))
+
+            wrapper.invalidate = invalidate
+            return wrapper
+        return decorator
+
+
+def memoize(cache_store=None, key=None, ttl=60, **kwargs):
+    """Decorator that caches a function's results in `cache_store`. Other
+    keyword arguments are passed to `Memoizer`.
+    """
+    memoizer = Memoizer(cache_store, ttl=ttl, **kwargs)
+    return memoizer.memoize(key=key)
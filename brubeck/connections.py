@@ -3,10 +3,11 @@ from uuid import uuid4
 import cgi
 import re
 import logging
-import Cookie
 
 from request import to_bytes, to_unicode, parse_netstring, Request
-from request_handling import http_response, coro_spawn
+from request_handling import (http_response, http_response_head,
+                              http_response_headers, http_chunk, is_streamed, file_blocks,
+                              HTTP_LAST_CHUNK, coro_spawn)
 
 
 ###
@@ -165,11 +166,76 @@ class Mongrel2Connection(Connection):
         handler = application.route_message(request)
         result = handler()
 
+        if request.method == 'HEAD':
+            self.reply_head(request, result)
+            return
+
+        if hasattr(result['body'], 'read'):
+            result['body'] = file_blocks(result['body'])
+
+        if is_streamed(result['body']):
+            self.reply_streamed(request, result)
+            return
+
         http_content = http_response(result['body'], result['status_code'],
                                      result['status_msg'], result['headers'])
 
         application.msg_conn.reply(request, http_content)
 
+    def reply_head(self, req, result):
+        """Sends the status line and headers only. A handler that knows the
+        length of the body a GET would return sets `Content-Length` itself,
+        otherwise it's the length of the body it rendered.
+        """
+        body = result['body']
+        headers = result['headers']
+        if hasattr(body, 'close'):
+            body.close()
+        if 'Content-Length' not in headers and isinstance(body, basestring):
+            headers['Content-Length'] = len(to_bytes(body))
+        self.reply(req, http_response_headers(result['status_code'],
+                                              result['status_msg'], headers))
+
+    def reply_streamed(self, req, result):
+        """Sends a response with an iterable body using chunked transfer
+        encoding. The headers go out first and each chunk is sent as soon as
+        the body produces it.
+
+        HTTP/1.0 clients can't read chunked responses, so they get the whole
+        body in one buffered response instead.
+
+        If the body raises part way through, the error is logged and the
+        client's connection is closed, since the response can't be finished.
+        """
+        if req.version == 'HTTP/1.0':
+            try:
+                body = ''.join(to_bytes(chunk) for chunk in result['body']
+                               if chunk)
+            except Exception, e:
+                logging.error('Streamed response failed: %s' % e,
+                              exc_info=True)
+                self.reply(req, '')
+                return
+            self.reply(req, http_response(body, result['status_code'],
+                                          result['status_msg'],
+                                          result['headers']))
+            return
+
+        http_head = http_response_head(result['status_code'],
+                                       result['status_msg'],
+                                       result['headers'])
+        self.reply(req, http_head)
+        try:
+            for chunk in result['body']:
+                if chunk:
+                    self.reply(req, http_chunk(chunk))
+        except Exception, e:
+            logging.error('Streamed response failed: %s' % e, exc_info=True)
+            ### An empty message tells Mongrel2 to close the connection
+            self.reply(req, '')
+            return
+        self.reply(req, HTTP_LAST_CHUNK)
+
     def recv(self):
         """Receives a raw mongrel2.handler.Request object that you from the
         zeromq socket and return whatever is found.
@@ -238,9 +304,25 @@ class WSGIConnection(Connection):
         result = handler()
         
         wsgi_status = ' '.join([str(result['status_code']), result['status_msg']])
-        headers = [(k, v) for k,v in result['headers'].items()]
+        headers = list()
+        for k, v in result['headers'].items():
+            if isinstance(v, list):
+                headers.extend((k, str(item)) for item in v)
+            else:
+                headers.append((k, v))
         callback(str(wsgi_status), headers)
 
+        ### Files go to the server's file_wrapper if it has one
+        if hasattr(result['body'], 'read'):
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(result['body'])
+            return file_blocks(result['body'])
+
+        ### Streamed bodies are handed to the server chunk by chunk
+        if is_streamed(result['body']):
+            return (to_bytes(chunk) for chunk in result['body'] if chunk)
+
         return [to_bytes(result['body'])]
 
     def recv_forever_ever(self, application):
@@ -0,0 +1,217 @@
+"""Cookie parsing and serialization without `Cookie.SimpleCookie`.
+
+`RequestCookies` wraps the raw `Cookie` header and only looks for a name
+when it's asked for. `ResponseCookies` collects outgoing cookies and renders
+each as its own `Set-Cookie` header value.
+
+Both hand out `CookieMorsel` instances, which keep the parts of the
+`Cookie.Morsel` API that Brubeck uses: `key`, `value`, item assignment for
+attributes and `OutputString()`.
+"""
+
+import time
+import string
+import Cookie
+from email.utils import formatdate
+
+
+###
+### Quoting
+###
+
+_LEGAL_CHARS = string.ascii_letters + string.digits + "!#$%&'*+-.^_`|~:"
+
+
+def quote_value(value):
+    """Quotes a cookie value the way `SimpleCookie` does, but only when it
+    contains characters that need it.
+    """
+    if not value.translate(None, _LEGAL_CHARS):
+        return value
+    return Cookie._quote(value)
+
+
+def unquote_value(value):
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return Cookie._unquote(value)
+    return value
+
+
+###
+### Morsels
+###
+
+class CookieMorsel(object):
+    """A single cookie and its attributes.
+    """
+    _reserved = {
+        'expires': 'expires',
+        'path': 'Path',
+        'comment': 'Comment',
+        'domain': 'Domain',
+        'max-age': 'Max-Age',
+        'secure': 'secure',
+        'httponly': 'httponly',
+        'version': 'Version',
+    }
+    _flags = ('secure', 'httponly')
+
+    __slots__ = ('key', 'value', 'attributes')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.attributes = dict()
+
+    def __setitem__(self, attr, value):
+        attr = attr.lower()
+        if attr not in self._reserved:
+            raise Cookie.CookieError('Invalid attribute %r' % attr)
+        self.attributes[attr] = value
+
+    def __getitem__(self, attr):
+        return self.attributes.get(attr.lower(), '')
+
+    def OutputString(self):
+        """Renders the cookie as the value of a `Set-Cookie` header.
+        """
+        parts = ['%s=%s' % (self.key, quote_value(str(self.value)))]
+        attributes = self.attributes
+        for attr in ('expires', 'path', 'comment', 'domain', 'max-age',
+                     'version'):
+            if attr not in attributes or attributes[attr] == '':
+                continue
+            value = attributes[attr]
+            if attr == 'expires' and isinstance(value, (int, long)):
+                ### Same as Morsel: a number is seconds from now
+                value = formatdate(time.time() + value, usegmt=True)
+            elif attr == 'expires' and hasattr(value, 'strftime'):
+                value = value.strftime('%a, %d %b %Y %H:%M:%S GMT')
+            elif attr == 'max-age' and isinstance(value, (int, long)):
+                value = '%d' % value
+            parts.append('%s=%s' % (self._reserved[attr], value))
+        for attr in self._flags:
+            if attributes.get(attr):
+                parts.append(self._reserved[attr])
+        return '; '.join(parts)
+
+
+###
+### Incoming cookies
+###
+
+class RequestCookies(object):
+    """Read-only mapping of cookie names to `CookieMorsel`s, backed by the
+    raw `Cookie` request header.
+
+    Looking up a name scans the header for that name only. The full header
+    is parsed only when the cookies are iterated. If a name appears more than
+    once, the last value wins, as it does with `SimpleCookie`.
+    """
+    def __init__(self, header=None):
+        self._header = header or ''
+        self._morsels = dict()
+        self._parsed = False
+
+    def _find(self, name):
+        """Returns the value of the last `name` cookie in the header, or None.
+        Pairs are split on `;` like `_parse_all` does, so a name inside
+        another cookie's value doesn't match.
+        """
+        header = self._header
+        end = len(header)
+        while True:
+            i = header.rfind(name, 0, end)
+            if i == -1:
+                return None
+            start = header.rfind(';', 0, i) + 1
+            if not header[start:i].strip():
+                value_end = header.find(';', i)
+                if value_end == -1:
+                    value_end = len(header)
+                key, sep, value = header[i:value_end].partition('=')
+                if sep and key.rstrip() == name:
+                    return unquote_value(value.strip())
+            end = i
+
+    def _lookup(self, name):
+        if name not in self._morsels and not self._parsed:
+            value = self._find(name)
+            if value is not None:
+                self._morsels[name] = CookieMorsel(name, value)
+            else:
+                self._morsels[name] = None
+        return self._morsels.get(name)
+
+    def _parse_all(self):
+        if self._parsed:
+            return
+        morsels = dict()
+        for pair in self._header.split(';'):
+            name, sep, value = pair.partition('=')
+            name = name.strip()
+            if not sep or not name or name.startswith('$'):
+                continue
+            morsels[name] = CookieMorsel(name, unquote_value(value.strip()))
+        self._morsels = morsels
+        self._parsed = True
+
+    def __contains__(self, name):
+        return self._lookup(name) is not None
+
+    def __getitem__(self, name):
+        morsel = self._lookup(name)
+        if morsel is None:
+            raise KeyError(name)
+        return morsel
+
+    def get(self, name, default=None):
+        morsel = self._lookup(name)
+        if morsel is None:
+            return default
+        return morsel
+
+    def keys(self):
+        self._parse_all()
+        return self._morsels.keys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def values(self):
+        self._parse_all()
+        return self._morsels.values()
+
+    def items(self):
+        self._parse_all()
+        return self._morsels.items()
+
+    def __len__(self):
+        self._parse_all()
+        return len(self._morsels)
+
+
+###
+### Outgoing cookies
+###
+
+class ResponseCookies(dict):
+    """Mapping of cookie names to `CookieMorsel`s for the response. Assigning
+    a plain value creates the morsel.
+    """
+    def __setitem__(self, key, value):
+        if not isinstance(value, CookieMorsel):
+            morsel = self.get(key)
+            if morsel is None:
+                value = CookieMorsel(key, value)
+            else:
+                morsel.value = value
+                value = morsel
+        dict.__setitem__(self, key, value)
+
+    def output_headers(self):
+        """Returns a list with one `Set-Cookie` header value per cookie.
+        """
+        return [morsel.OutputString() for morsel in self.values()]
@@ -94,3 +94,9 @@ class StreamedHandlerMixin:
         skip = get_typed_argument('skip', default_skip, self, int)
 
         return (page, count, skip)
+
+    def get_cursor_argument(self, default_cursor=None):
+        """Returns the `cursor` argument, an opaque string produced by a
+        queryset's `read_page` to continue where the last page ended.
+        """
+        return self.get_argument('cursor', default_cursor)
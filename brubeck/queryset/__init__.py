@@ -1,4 +1,5 @@
 from brubeck.queryset.base import AbstractQueryset
 from brubeck.queryset.dict import DictQueryset
-from brubeck.queryset.redis import RedisQueryset
+from brubeck.queryset.redis import RedisQueryset, ShardedRedisQueryset
 
+from brubeck.queryset.sqlite import SQLiteQueryset
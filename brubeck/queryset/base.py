@@ -1,4 +1,141 @@
-from brubeck.request_handling import FourOhFourException
+import operator
+
+from brubeck.request_handling import (FourOhFourException, coro_pool,
+                                      coro_queue, coro_sleep)
+
+
+###
+### Filters
+###
+
+FILTER_OPERATORS = {
+    'eq': operator.eq,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+
+
+def parse_filters(filters):
+    """Turns a dict of filters into a list of (field, operator, value)
+    conditions. Keys are field names, for equality, or a field name and an
+    operator from `FILTER_OPERATORS` joined by `__`, eg. `created_at__gte`.
+    """
+    conditions = list()
+    if not filters:
+        return conditions
+    for key, value in filters.items():
+        (field, sep, op) = key.partition('__')
+        if not op:
+            op = 'eq'
+        if op not in FILTER_OPERATORS:
+            raise ValueError('Unknown filter operator: %s' % op)
+        conditions.append((field, op, value))
+    return conditions
+
+
+def matches(datum, conditions):
+    """Checks a dict representation of an item against every condition.
+    """
+    for field, op, value in conditions:
+        if not FILTER_OPERATORS[op](datum.get(field), value):
+            return False
+    return True
+
+
+###
+### Batching
+###
+
+class BatchLoader(object):
+    """Collects single reads from concurrent coroutines and does them with
+    one call to `load_many`.
+
+    The first coroutine to call `load` in a batch yields for `window` seconds,
+    or one pass through the hub when `window` is 0, while the others add
+    their keys. It then calls `load_many` with every key once and hands each
+    waiting coroutine its value. A batch holding `max_batch_size` keys is
+    loaded right away by the coroutine that filled it.
+
+    `load_many` takes a list of keys and returns their values in the same
+    order. If it raises, every coroutine in the batch gets the exception,
+    and keys it returns no value for get a ValueError. If the first
+    coroutine is killed while it waits, another coroutine loads the batch.
+    """
+    def __init__(self, load_many, window=0, max_batch_size=256):
+        self.load_many = load_many
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.loads = 0
+        self.batches = 0
+        self._batch = None
+
+    def _dispatch(self, batch):
+        """Loads the keys in `batch` and answers their queues. Queues still
+        unanswered at the end, whatever the reason, get an error.
+        """
+        keys = batch.keys()
+        self.batches += 1
+        error = None
+        try:
+            values = self.load_many(keys)
+            for key, value in zip(keys, values):
+                for queue in batch.pop(key):
+                    queue.put((True, value))
+            if batch:
+                error = ValueError('Expected %d values, got %d' %
+                                   (len(keys), len(values)))
+        except Exception, e:
+            error = e
+        finally:
+            if batch and error is None:
+                error = RuntimeError('Loading the batch was interrupted')
+            for queues in batch.itervalues():
+                for queue in queues:
+                    queue.put((False, error))
+
+    def load(self, key):
+        """Returns the value for `key`, loaded with the rest of its batch.
+        """
+        queue = coro_queue()
+        self.loads += 1
+        batch = self._batch
+        leader = batch is None
+        if leader:
+            batch = self._batch = dict()
+        batch.setdefault(key, list()).append(queue)
+
+        if len(batch) >= self.max_batch_size:
+            self._batch = None
+            self._dispatch(batch)
+        elif leader:
+            try:
+                coro_sleep(self.window)
+                if self._batch is batch:
+                    self._batch = None
+                    self._dispatch(batch)
+            finally:
+                ### Killed while waiting, so hand the batch to a new coroutine
+                if self._batch is batch:
+                    self._batch = None
+                    coro_pool().spawn(self._dispatch, batch)
+
+        (ok, value) = queue.get()
+        if not ok:
+            raise value
+        return value
+
+    def stats(self):
+        """Returns the number of loads, the number of batches they were done
+        in and the mean batch size.
+        """
+        mean = 0.0
+        if self.batches:
+            mean = float(self.loads) / self.batches
+        return {'loads': self.loads, 'batches': self.batches,
+                'mean_batch_size': mean}
+
 
 class AbstractQueryset(object):
     """The design of the `AbstractQueryset` attempts to map RESTful calls
@@ -35,7 +172,6 @@ class AbstractQueryset(object):
     ###
 
     ### Section TODO:
-    ### * Pagination
     ### * Hook in authentication
     ### * Key filtering (owner / public)
     ### * Make model instantiation an option
@@ -101,6 +237,40 @@ class AbstractQueryset(object):
         """
         raise NotImplementedError
 
+    def read_page(self, limit, cursor=None, offset=0, order_by=None,
+                  filters=None):
+        """Returns a tuple with a list of up to `limit` objects from the db and
+        the cursor for the next page, which is None after the last page.
+
+        Pass the cursor back to read the next page. `offset` skips that many
+        objects first. `order_by` names a field to sort by, prefixed with `-`
+        for descending order. `filters` limits the page to objects that match,
+        see `parse_filters`. Querysets raise ValueError for orderings and
+        filters they don't support and for cursors they didn't produce.
+
+        This implementation reads everything with `read_all`, filters it and
+        slices it. Querysets should override it to read only the page.
+        """
+        if order_by is not None:
+            raise ValueError('Ordering by %s is not supported' % order_by)
+        if cursor is not None:
+            offset = int(cursor)
+        items = self.read_all()
+        conditions = parse_filters(filters)
+        if conditions:
+            items = [item for item in items if matches(item[1], conditions)]
+        end = offset + limit
+        next_cursor = None
+        if end < len(items):
+            next_cursor = str(end)
+        return (items[offset:end], next_cursor)
+
+    def filterable_fields(self):
+        """Returns the fields `read_page` can filter on, or None if it can
+        filter on any field.
+        """
+        return None
+
     ### Update Functions
 
     def update_one(self, shield):
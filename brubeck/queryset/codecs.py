@@ -0,0 +1,114 @@
+"""Value codecs for querysets that store items as bytes.
+
+A `ValueCodec` serializes a shield, compresses the result if it's at least
+`min_compress_size` bytes and smaller for it, and puts a header byte in front
+that records both choices. Values written with other settings, or without a
+codec at all, are still read correctly.
+"""
+
+import zlib
+
+import ujson as json
+
+
+###
+### Serializers
+###
+
+class JSONSerializer(object):
+    """Stores the shield's `to_json()` output.
+    """
+    code = 0
+
+    def serialize(self, shield):
+        return shield.to_json()
+
+    def deserialize(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(object):
+    """Stores the shield's `to_python()` output with msgpack, which is smaller
+    than JSON and quicker to read. Requires the `msgpack` package.
+    """
+    code = 1
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def serialize(self, shield):
+        return self.msgpack.packb(shield.to_python())
+
+    def deserialize(self, data):
+        return self.msgpack.unpackb(data)
+
+
+SERIALIZERS = {
+    JSONSerializer.code: JSONSerializer,
+    MsgpackSerializer.code: MsgpackSerializer,
+}
+
+
+###
+### Codec
+###
+
+### The header byte is HEADER_MARK, the serializer code in the low two bits
+### and COMPRESSED if the rest is zlib data. Nothing written without a header
+### starts with 0xF_: JSON starts with an ASCII character and zlib streams
+### with 0x78.
+HEADER_MARK = 0xF0
+COMPRESSED = 0x04
+SERIALIZER_BITS = 0x03
+
+
+class ValueCodec(object):
+    """Encodes shields to bytes and decodes them to dicts.
+
+    `min_compress_size` is the smallest serialized value worth compressing.
+    Compressing small documents costs CPU and often makes them bigger, and a
+    compressed value is only kept when it is smaller. None turns compression
+    off.
+    """
+    def __init__(self, serializer=None, compress_level=1,
+                 min_compress_size=512):
+        if serializer is None:
+            serializer = JSONSerializer()
+        self.serializer = serializer
+        self.compress_level = compress_level
+        self.min_compress_size = min_compress_size
+        self._serializers = {serializer.code: serializer}
+
+    def _get_serializer(self, code):
+        if code not in self._serializers:
+            self._serializers[code] = SERIALIZERS[code]()
+        return self._serializers[code]
+
+    def encode(self, shield):
+        data = self.serializer.serialize(shield)
+        header = HEADER_MARK | self.serializer.code
+        if (self.min_compress_size is not None and
+            len(data) >= self.min_compress_size):
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                data = compressed
+                header |= COMPRESSED
+        return chr(header) + data
+
+    def decode(self, value):
+        header = ord(value[0])
+        if header & 0xF0 != HEADER_MARK:
+            return self.decode_legacy(value)
+        data = value[1:]
+        if header & COMPRESSED:
+            data = zlib.decompress(data)
+        return self._get_serializer(header & SERIALIZER_BITS).deserialize(data)
+
+    def decode_legacy(self, value):
+        """Reads values written before codecs: plain JSON, or JSON compressed
+        with zlib.
+        """
+        if value[0] == '\x78':
+            value = zlib.decompress(value)
+        return json.loads(value)
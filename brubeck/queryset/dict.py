@@ -1,16 +1,85 @@
+from bisect import bisect_left, bisect_right, insort
+
+import ujson as json
+
 from brubeck.request_handling import FourOhFourException
-from brubeck.queryset.base import AbstractQueryset
+from brubeck.queryset.base import AbstractQueryset, parse_filters, matches
 
 class DictQueryset(AbstractQueryset):
     """This class exists as an example of how one could implement a Queryset.
     This model is an in-memory dictionary and uses the model's id as the key.
 
     The data stored is the result of calling model's `to_python()` function.
+
+    Ids are also kept in a sorted list, so pages are read by slicing it.
+
+    `indexes` maps field names to `'hash'` or `'sorted'`. A hash index finds
+    items with a field equal to a value. A sorted index also finds ranges of
+    values and can order pages, eg. by `created_at`. Indexes are kept up to
+    date on every write, and `read_page` can filter on indexed fields only.
     """
-    def __init__(self, **kw):
+    indexes = None
+
+    def __init__(self, indexes=None, **kw):
         """Set the db_conn to a dictionary.
         """
         super(DictQueryset, self).__init__(db_conn=dict(), **kw)
+        self._sorted_ids = list()
+        if indexes is not None:
+            self.indexes = indexes
+        self._hash_indexes = dict()
+        self._sorted_indexes = dict()
+        for field, kind in (self.indexes or {}).items():
+            if kind == 'hash':
+                self._hash_indexes[field] = dict()
+            elif kind == 'sorted':
+                ### Values and (value, id) pairs, in the same order
+                self._sorted_indexes[field] = (list(), list())
+            else:
+                raise ValueError('Unknown index type: %s' % kind)
+
+    ###
+    ### Index maintenance
+    ###
+
+    def _index(self, shield_key, datum):
+        for field, index in self._hash_indexes.iteritems():
+            index.setdefault(datum.get(field), set()).add(shield_key)
+        for field, (values, entries) in self._sorted_indexes.iteritems():
+            entry = (datum.get(field), shield_key)
+            i = bisect_right(entries, entry)
+            entries.insert(i, entry)
+            values.insert(i, entry[0])
+
+    def _unindex(self, shield_key, datum):
+        for field, index in self._hash_indexes.iteritems():
+            value = datum.get(field)
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(shield_key)
+                if not keys:
+                    del index[value]
+        for field, (values, entries) in self._sorted_indexes.iteritems():
+            entry = (datum.get(field), shield_key)
+            i = bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+                del values[i]
+
+    def _store(self, shield_key, datum):
+        old_datum = self.db_conn.get(shield_key)
+        if old_datum is None:
+            insort(self._sorted_ids, shield_key)
+        else:
+            self._unindex(shield_key, old_datum)
+        self.db_conn[shield_key] = datum
+        self._index(shield_key, datum)
+
+    def _forget(self, shield_key, datum):
+        i = bisect_left(self._sorted_ids, shield_key)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == shield_key:
+            del self._sorted_ids[i]
+        self._unindex(shield_key, datum)
 
     ### Create Functions
 
@@ -21,7 +90,7 @@ class DictQueryset(AbstractQueryset):
             status = self.MSG_CREATED
 
         shield_key = str(getattr(shield, self.api_id))
-        self.db_conn[shield_key] = shield.to_python()
+        self._store(shield_key, shield.to_python())
         return (status, shield)
 
     def create_many(self, shields):
@@ -44,10 +113,163 @@ class DictQueryset(AbstractQueryset):
     def read_many(self, ids):
         return [self.read_one(iid) for iid in ids]
 
+    def filterable_fields(self):
+        return self._hash_indexes.keys() + self._sorted_indexes.keys()
+
+    def _bounds(self, field, conditions):
+        """Returns the slice of a sorted index that satisfies the conditions
+        on `field`.
+        """
+        values = self._sorted_indexes[field][0]
+        (lo, hi) = (0, len(values))
+        for cond_field, op, value in conditions:
+            if cond_field != field:
+                continue
+            if op in ('eq', 'gte'):
+                lo = max(lo, bisect_left(values, value))
+            elif op == 'gt':
+                lo = max(lo, bisect_right(values, value))
+            if op in ('eq', 'lte'):
+                hi = min(hi, bisect_right(values, value))
+            elif op == 'lt':
+                hi = min(hi, bisect_left(values, value))
+        return (lo, hi)
+
+    def _candidate_ids(self, conditions):
+        """Returns the most ids the indexes allow and a function that returns
+        them sorted, or None if the conditions don't narrow anything down.
+        """
+        sets = [self._hash_indexes[field].get(value, set())
+                for field, op, value in conditions
+                if field in self._hash_indexes and op == 'eq']
+        if sets:
+            sets.sort(key=len)
+            return (len(sets[0]),
+                    lambda: sorted(sets[0].intersection(*sets[1:])))
+        for field, op, value in conditions:
+            if field in self._sorted_indexes:
+                (lo, hi) = self._bounds(field, conditions)
+                entries = self._sorted_indexes[field][1]
+                return (hi - lo,
+                        lambda: sorted(entries[i][1] for i in xrange(lo, hi)))
+        return None
+
+    def _ids_after(self, ids, descending, cursor):
+        """Yields the sorted `ids` that come after `cursor`.
+        """
+        (lo, hi) = (0, len(ids))
+        if cursor is not None and descending:
+            hi = bisect_left(ids, cursor)
+        elif cursor is not None:
+            lo = bisect_right(ids, cursor)
+        positions = xrange(lo, hi)
+        if descending:
+            positions = reversed(positions)
+        for i in positions:
+            yield ids[i]
+
+    def _ordered_ids(self, field, descending, cursor, conditions, needed):
+        """Yields the ids after `cursor` in the order of `field`. `needed` is
+        how many matching ids the page will use.
+        """
+        if field == self.api_id:
+            candidates = self._candidate_ids(conditions)
+            if candidates is None:
+                for iid in self._ids_after(self._sorted_ids, descending,
+                                           cursor):
+                    yield iid
+                return
+
+            ### A walk over every id finds `needed` matches after about
+            ### `needed * total / count` ids, while sorting the candidates
+            ### costs about `count`. Broad filters walk, but switch to the
+            ### sorted candidates once the walk has cost as much.
+            (count, sorted_candidates) = candidates
+            if needed * len(self._sorted_ids) > count * count:
+                count = 0
+            for iid in self._ids_after(self._sorted_ids, descending, cursor):
+                if count == 0:
+                    break
+                count -= 1
+                cursor = iid
+                yield iid
+            else:
+                return
+            for iid in self._ids_after(sorted_candidates(), descending,
+                                       cursor):
+                yield iid
+            return
+
+        entries = self._sorted_indexes[field][1]
+        (lo, hi) = self._bounds(field, conditions)
+        if cursor is not None:
+            try:
+                last = tuple(json.loads(cursor))
+            except TypeError:
+                raise ValueError('Invalid cursor: %s' % cursor)
+            if descending:
+                hi = min(hi, bisect_left(entries, last))
+            else:
+                lo = max(lo, bisect_right(entries, last))
+        positions = xrange(lo, hi)
+        if descending:
+            positions = reversed(positions)
+        for i in positions:
+            yield entries[i][1]
+
+    def read_page(self, limit, cursor=None, offset=0, order_by=None,
+                  filters=None):
+        """Pages through the items in order of their ids, or of a field with a
+        sorted index. Filters are answered from the indexes, so only matching
+        items are looked at.
+
+        The cursor is the last id on the page, or its sorted value and id, so
+        pages don't shift when items are added.
+        """
+        conditions = parse_filters(filters)
+        for field, op, value in conditions:
+            if field in self._sorted_indexes:
+                continue
+            if field in self._hash_indexes and op == 'eq':
+                continue
+            raise ValueError('No index for filtering on %s' % field)
+
+        field = self.api_id
+        descending = False
+        if order_by is not None:
+            descending = order_by.startswith('-')
+            field = order_by.lstrip('-')
+            if field != self.api_id and field not in self._sorted_indexes:
+                raise ValueError('Ordering by %s is not supported' % field)
+
+        items = list()
+        has_more = False
+        for iid in self._ordered_ids(field, descending, cursor, conditions,
+                                     offset + limit + 1):
+            datum = self.db_conn[iid]
+            if not matches(datum, conditions):
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            if len(items) == limit:
+                has_more = True
+                break
+            items.append((iid, datum))
+
+        next_cursor = None
+        if has_more and items:
+            (iid, datum) = items[-1]
+            if field == self.api_id:
+                next_cursor = iid
+            else:
+                next_cursor = json.dumps([datum.get(field), iid])
+        return ([(self.MSG_OK, datum) for iid, datum in items], next_cursor)
+
     ### Update Functions
     def update_one(self, shield):
         shield_key = str(getattr(shield, self.api_id))
-        self.db_conn[shield_key] = shield.to_python()
+        self._store(shield_key, shield.to_python())
         return (self.MSG_UPDATED, shield)
 
     def update_many(self, shields):
@@ -60,6 +282,7 @@ class DictQueryset(AbstractQueryset):
         try:
             datum = self.db_conn[item_id]
             del self.db_conn[item_id]
+            self._forget(item_id, datum)
         except KeyError:
             raise FourOhFourException
         return (self.MSG_UPDATED, datum)
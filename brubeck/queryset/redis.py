@@ -1,12 +1,36 @@
-from brubeck.queryset.base import AbstractQueryset
+from brubeck.queryset.base import AbstractQueryset, BatchLoader, parse_filters
+from brubeck.queryset.codecs import ValueCodec
+from brubeck.request_handling import coro_pool, coro_queue
+from bisect import bisect
+from collections import OrderedDict
 from itertools import imap
 import ujson as json
+import hashlib
 import zlib
 try:
     import redis
 except ImportError:
     pass
 
+
+### Reads and deletes items in one atomic step. KEYS are the hash followed
+### by the index sorted sets and ARGV are the ids. Returns the old values,
+### with nil for ids that weren't there.
+DESTROY_SCRIPT = """
+local values = {}
+for i, id in ipairs(ARGV) do
+    local value = redis.call('HGET', KEYS[1], id)
+    values[i] = value
+    if value then
+        redis.call('HDEL', KEYS[1], id)
+        for j = 2, #KEYS do
+            redis.call('ZREM', KEYS[j], id)
+        end
+    end
+end
+return values
+"""
+
 class RedisQueryset(AbstractQueryset):
     """This class uses redis to store the DictShield after 
     calling it's `to_json()` method. Upon reading from the Redis
@@ -14,35 +38,65 @@ class RedisQueryset(AbstractQueryset):
 
     Redis connection uses the redis-py api located here:
     https://github.com/andymccurdy/redis-py
+
+    `indexes` maps numeric fields to `'sorted'`, eg. the `created_at` and
+    `updated_at` fields of `StreamedModelMixin`. Each one is kept in a sorted
+    set next to the hash, written in the same pipeline as the item, so items
+    can be read by range or newest first without loading the whole hash.
+
+    With `batch_window` set, `read_one` calls from concurrent coroutines are
+    batched by a `BatchLoader` into one HMGET. 0 batches the calls made in the
+    same pass through the hub, a small number of seconds, eg. 0.0005, waits
+    that long for more.
+
+    `codec` is a `ValueCodec` that chooses how items are serialized and when
+    they're compressed. Without one, items are stored as JSON, compressed
+    with zlib if `compress` is set. Any of these formats can be read back, so
+    the settings can change on a collection that has data.
+
+    Every operation is a single round trip. Writes that touch indexes go in a
+    MULTI/EXEC pipeline, multi-reads use HMGET and deletes run
+    `DESTROY_SCRIPT`, so concurrent writers never see half an operation.
     """
+    indexes = None
+
     # TODO: - catch connection exceptions?
     #       - set Redis EXPIRE and self.expires
     #       - confirm that the correct status is being returned in 
     #         each circumstance
-    def __init__(self, compress=False, compress_level=1, **kw):
+    def __init__(self, compress=False, compress_level=1, codec=None,
+                 indexes=None, batch_window=None, max_batch_size=256, **kw):
         """The Redis connection wiil be passed in **kw and is used below
         as self.db_conn.
         """
         super(RedisQueryset, self).__init__(**kw)
         self.compress = compress
         self.compress_level = compress_level
-        
+        self.codec = codec
+        self._decoder = codec or ValueCodec()
+        if indexes is not None:
+            self.indexes = indexes
+        for field, kind in (self.indexes or {}).items():
+            if kind != 'sorted':
+                raise ValueError('Unknown index type: %s' % kind)
+        self._sorted_fields = tuple(sorted(self.indexes or ()))
+        self.loader = None
+        if batch_window is not None:
+            self.loader = BatchLoader(self._hmget, window=batch_window,
+                                      max_batch_size=max_batch_size)
+
     def _setvalue(self, shield):
+        if self.codec is not None:
+            return self.codec.encode(shield)
         if self.compress:
             return zlib.compress(shield.to_json(), self.compress_level)
         return shield.to_json()
 
     def _readvalue(self, value):
-        if self.compress:
-            try:
-                compressed_value = zlib.decompress(value)
-                return json.loads(zlib.decompress(value))
-            except Exception as e:
-                # value is 0 or None from a Redis return value
-                return value
-        if value:
-            return json.loads(value)
-        return None
+        if not value:
+            # value is 0 or None from a Redis return value
+            return None
+        return self._decoder.decode(value)
 
     def _message_factory(self, fail_status, success_status):
         """A Redis command often returns some value or 0 after the
@@ -50,12 +104,171 @@ class RedisQueryset(AbstractQueryset):
         """
         return lambda x: success_status if x else fail_status
 
+    ###
+    ### Sorted indexes
+    ###
+
+    def _index_key(self, field):
+        return '%s:%s' % (self.api_id, field)
+
+    def _index_writes(self, pipe, shield_key, shield):
+        """Adds the commands that move `shield_key` to the current values of
+        the indexed fields to `pipe`.
+        """
+        for field in self._sorted_fields:
+            score = getattr(shield, field, None)
+            if score is None:
+                pipe.zrem(self._index_key(field), shield_key)
+            else:
+                pipe.zadd(self._index_key(field), {shield_key: score})
+
+    def _write_one(self, shield_key, shield):
+        """Writes one item and its index entries, returning the result of
+        HSET. Without indexes this is a single HSET.
+        """
+        shield_value = self._setvalue(shield)
+        if not self._sorted_fields:
+            return self.db_conn.hset(self.api_id, shield_key, shield_value)
+        pipe = self.db_conn.pipeline()
+        pipe.hset(self.api_id, shield_key, shield_value)
+        self._index_writes(pipe, shield_key, shield)
+        results = pipe.execute()
+        pipe.reset()
+        return results[0]
+
+    def _queue_writes(self, pipe, shields):
+        """Adds an HSET and the index entries for each item to `pipe`.
+        """
+        for shield in shields:
+            shield_key = str(getattr(shield, self.api_id))
+            pipe.hset(self.api_id, shield_key, self._setvalue(shield))
+            self._index_writes(pipe, shield_key, shield)
+
+    def _item_results(self, results):
+        """Picks the results of the hash commands out of a pipeline that also
+        updated the indexes.
+        """
+        if not self._sorted_fields:
+            return results
+        return results[::len(self._sorted_fields) + 1]
+
+    def reindex(self, batch_size=500):
+        """Rebuilds the sorted indexes from the hash, eg. after adding an
+        index to a collection that already holds items.
+        """
+        scan_cursor = 0
+        while True:
+            (scan_cursor, values) = self.db_conn.hscan(self.api_id,
+                                                       scan_cursor,
+                                                       count=batch_size)
+            pipe = self.db_conn.pipeline()
+            for shield_key, value in values.iteritems():
+                datum = self._readvalue(value)
+                for field in self._sorted_fields:
+                    score = datum.get(field)
+                    if score is not None:
+                        pipe.zadd(self._index_key(field), {shield_key: score})
+            pipe.execute()
+            pipe.reset()
+            if not scan_cursor:
+                break
+
+    def _score_bounds(self, conditions):
+        """Turns filter conditions on one field into the lower and upper
+        bounds of a score range. Each bound is None or a tuple of the score
+        and whether it's excluded.
+        """
+        (lower, upper) = (None, None)
+        for field, op, value in conditions:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError('%s can only be filtered by number' % field)
+            if op in ('eq', 'gt', 'gte'):
+                bound = (value, op == 'gt')
+                if lower is None or bound > lower:
+                    lower = bound
+            if op in ('eq', 'lt', 'lte'):
+                bound = (value, op == 'lt')
+                if (upper is None or bound[0] < upper[0] or
+                    (bound[0] == upper[0] and bound[1])):
+                    upper = bound
+        return (lower, upper)
+
+    def _format_bound(self, bound, unbounded):
+        if bound is None:
+            return unbounded
+        (score, excluded) = bound
+        score = '%.17g' % score
+        if excluded:
+            return '(' + score
+        return score
+
+    def _scan_index(self, field, lower, upper, descending=False, after=None,
+                    offset=0, count=None):
+        """Returns up to `count` (id, score) pairs from the index on `field`,
+        within the bounds and in score order. `after` is a (score, id) pair
+        and skips everything up to and including that entry.
+
+        Each ZRANGEBYSCORE costs O(log n + k), so no more of the index is read
+        than the page needs, plus any entries tied with `after`.
+        """
+        if after is not None:
+            ### Start from the cursor's score and skip the ties already read
+            bound = (after[0], False)
+            if descending and (upper is None or bound[0] < upper[0]):
+                upper = bound
+            elif not descending and (lower is None or bound[0] > lower[0]):
+                lower = bound
+        key = self._index_key(field)
+        low = self._format_bound(lower, '-inf')
+        high = self._format_bound(upper, '+inf')
+
+        pairs = list()
+        limits = dict()
+        batch = None
+        if count is not None:
+            ### redis-py wants both or neither of `start` and `num`
+            batch = offset + count
+            limits = {'start': 0, 'num': batch}
+        while True:
+            if descending:
+                page = self.db_conn.zrevrangebyscore(key, high, low,
+                                                     withscores=True,
+                                                     **limits)
+            else:
+                page = self.db_conn.zrangebyscore(key, low, high,
+                                                  withscores=True, **limits)
+            for member, score in page:
+                if after is not None and score == after[0]:
+                    if descending and member >= after[1]:
+                        continue
+                    if not descending and member <= after[1]:
+                        continue
+                pairs.append((member, score))
+            if batch is None or len(page) < batch or len(pairs) >= batch:
+                break
+            limits['start'] += batch
+
+        if count is None:
+            return pairs[offset:]
+        return pairs[offset:offset + count]
+
+    def _read_ids(self, shield_ids):
+        """Reads the items for a list of ids with one HMGET, leaving out any
+        that are gone.
+        """
+        if not shield_ids:
+            return list()
+        values = self._hmget(shield_ids)
+        return [(self.MSG_OK, self._readvalue(value))
+                for value in values if value]
+
     ### Create Functions
 
     def create_one(self, shield):
-        shield_value = self._setvalue(shield)
-        shield_key = str(getattr(shield, self.api_id))        
-        result = self.db_conn.hset(self.api_id, shield_key, shield_value)
+        shield_key = str(getattr(shield, self.api_id))
+        result = self._write_one(shield_key, shield)
         if result:
             return (self.MSG_CREATED, shield)
         return (self.MSG_UPDATED, shield)
@@ -63,9 +276,8 @@ class RedisQueryset(AbstractQueryset):
     def create_many(self, shields):
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
         pipe = self.db_conn.pipeline()
-        for shield in shields:
-            pipe.hset(self.api_id, str(getattr(shield, self.api_id)), self._setvalue(shield))
-        results = zip(imap(message_handler, pipe.execute()), shields)
+        self._queue_writes(pipe, shields)
+        results = zip(imap(message_handler, self._item_results(pipe.execute())), shields)
         pipe.reset()
         return results
         
@@ -74,19 +286,140 @@ class RedisQueryset(AbstractQueryset):
     def read_all(self):
         return [(self.MSG_OK, self._readvalue(datum)) for datum in self.db_conn.hvals(self.api_id)]
 
+    def _index_query(self, cursor, order_by, filters):
+        """Works out which index a page is read from. Returns None if it
+        isn't read from an index, otherwise a tuple of the field, the bounds
+        from `_score_bounds`, whether it's descending and the (score, id)
+        pair from the cursor.
+        """
+        conditions = parse_filters(filters)
+        fields = set(field for field, op, value in conditions)
+        descending = False
+        field = None
+        if order_by is not None:
+            descending = order_by.startswith('-')
+            field = order_by.lstrip('-')
+        elif len(fields) == 1:
+            field = list(fields)[0]
+        elif not fields:
+            return None
+
+        if field not in self._sorted_fields or fields - set([field]):
+            raise ValueError('Can only order and filter by one of %s' %
+                             ', '.join(self._sorted_fields))
+        after = None
+        if cursor is not None:
+            try:
+                (score, shield_key) = json.loads(cursor)
+                after = (float(score), str(shield_key))
+            except (TypeError, ValueError):
+                raise ValueError('Invalid cursor: %s' % cursor)
+        (lower, upper) = self._score_bounds(conditions)
+        return (field, lower, upper, descending, after)
+
+    def _index_page(self, pairs, limit):
+        """Trims the `limit + 1` (id, score) pairs read for a page to `limit`
+        and returns them with the cursor for the next page.
+        """
+        next_cursor = None
+        if len(pairs) > limit:
+            pairs = pairs[:limit]
+            (shield_key, score) = pairs[-1]
+            if score == int(score):
+                score = int(score)
+            next_cursor = json.dumps([score, shield_key])
+        return (pairs, next_cursor)
+
+    def read_page(self, limit, cursor=None, offset=0, order_by=None,
+                  filters=None):
+        """Ordering by or filtering on an indexed field reads the page from
+        its sorted set, with a cursor of the last item's score and id.
+        Filters may only use one indexed field, the same one as `order_by`.
+
+        Otherwise the page comes from `_scan_page`.
+        """
+        query = self._index_query(cursor, order_by, filters)
+        if query is None:
+            return self._scan_page(limit, cursor, offset)
+        (field, lower, upper, descending, after) = query
+        pairs = self._scan_index(field, lower, upper, descending, after,
+                                 offset, limit + 1)
+        (pairs, next_cursor) = self._index_page(pairs, limit)
+        return (self._read_ids([key for key, score in pairs]), next_cursor)
+
+    def _scan_page(self, limit, cursor=None, offset=0):
+        """Pages through the hash with HSCAN, so only a page at a time is
+        sent. The cursor is Redis' scan cursor. Redis treats `limit` as a
+        hint, so a page may hold a few more items, and items come in no
+        particular order.
+        """
+        scan_cursor = 0
+        if cursor is not None:
+            scan_cursor = int(cursor)
+
+        items = list()
+        while True:
+            (scan_cursor, values) = self.db_conn.hscan(self.api_id,
+                                                       scan_cursor,
+                                                       count=limit)
+            for value in values.itervalues():
+                if offset > 0:
+                    offset -= 1
+                    continue
+                items.append((self.MSG_OK, self._readvalue(value)))
+            if not scan_cursor or len(items) >= limit:
+                break
+
+        next_cursor = None
+        if scan_cursor:
+            next_cursor = str(scan_cursor)
+        return (items, next_cursor)
+
+    def filterable_fields(self):
+        return self._sorted_fields
+
+    def read_range(self, field, lower=None, upper=None, limit=None, offset=0,
+                   descending=False):
+        """Reads the items whose indexed `field` is between `lower` and
+        `upper`, inclusive, in order of `field`. `descending` reads from the
+        top of the range, eg. a newest first feed by `created_at`.
+        """
+        if field not in self._sorted_fields:
+            raise ValueError('%s is not indexed' % field)
+        if lower is not None:
+            lower = (lower, False)
+        if upper is not None:
+            upper = (upper, False)
+        pairs = self._scan_index(field, lower, upper, descending,
+                                 offset=offset, count=limit)
+        return self._read_ids([key for key, score in pairs])
+
+    def read_since(self, since, field='created_at', limit=None):
+        """Reads the items whose indexed `field` is later than `since`,
+        oldest first. `since` is usually the value of `get_stream_offset()`.
+        """
+        if field not in self._sorted_fields:
+            raise ValueError('%s is not indexed' % field)
+        pairs = self._scan_index(field, (since, True), None, count=limit)
+        return self._read_ids([key for key, score in pairs])
+
+    def _hmget(self, shield_ids):
+        return self.db_conn.hmget(self.api_id, shield_ids)
+
     def read_one(self, shield_id):
-        result = self.db_conn.hget(self.api_id, shield_id)
+        if self.loader is not None:
+            result = self.loader.load(str(shield_id))
+        else:
+            result = self.db_conn.hget(self.api_id, shield_id)
         if result:
             return (self.MSG_OK, self._readvalue(result))
         return (self.MSG_FAILED, shield_id)
 
     def read_many(self, shield_ids):
+        if not shield_ids:
+            return list()
         message_handler = self._message_factory(self.MSG_FAILED, self.MSG_OK)
-        pipe = self.db_conn.pipeline()
-        for shield_id in shield_ids:
-            pipe.hget(self.api_id, str(shield_id))
-        results = pipe.execute()
-        pipe.reset()
+        results = self._hmget([str(shield_id) for shield_id in shield_ids])
         return zip(imap(message_handler, results), map(self._readvalue, results))
 
     ### Update Functions
@@ -94,40 +427,281 @@ class RedisQueryset(AbstractQueryset):
     def update_one(self, shield):
         shield_key = str(getattr(shield, self.api_id))
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
-        status = message_handler(self.db_conn.hset(self.api_id, shield_key, self._setvalue(shield)))
+        status = message_handler(self._write_one(shield_key, shield))
         return (status, shield)
 
     def update_many(self, shields):
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
         pipe = self.db_conn.pipeline()
-        for shield in shields:
-            pipe.hset(self.api_id, str(getattr(shield, self.api_id)), self._setvalue(shield))
-        results = pipe.execute()
+        self._queue_writes(pipe, shields)
+        results = self._item_results(pipe.execute())
         pipe.reset()
         return zip(imap(message_handler, results), shields)
 
     ### Destroy Functions
 
+    def _destroy(self, ids):
+        """Runs `DESTROY_SCRIPT` for `ids` and returns the deleted values.
+        redis-py sends it with EVALSHA and only sends the script body the
+        first time a server hasn't seen it.
+        """
+        if not hasattr(self, '_destroy_script'):
+            self._destroy_script = self.db_conn.register_script(DESTROY_SCRIPT)
+        keys = [self.api_id]
+        keys.extend(self._index_key(field) for field in self._sorted_fields)
+        return self._destroy_script(keys=keys, args=ids)
+
     def destroy_one(self, shield_id):
-        pipe = self.db_conn.pipeline()
-        pipe.hget(self.api_id, shield_id)
-        pipe.hdel(self.api_id, shield_id)
-        result = pipe.execute()
-        pipe.reset()
-        if result[1]:
-            return (self.MSG_UPDATED, self._readvalue(result[0]))
+        (value,) = self._destroy([shield_id])
+        if value:
+            return (self.MSG_UPDATED, self._readvalue(value))
         return self.MSG_NOTFOUND
 
     def destroy_many(self, ids):
         # TODO: how to handle missing fields, currently returning self.MSG_FAILED
+        if not ids:
+            return list()
         message_handler = self._message_factory(self.MSG_FAILED, self.MSG_UPDATED)
-        pipe = self.db_conn.pipeline()
-        for _id in ids:
-            pipe.hget(self.api_id, _id)
-        values_results = pipe.execute()
-        for _id in ids:
-            pipe.hdel(self.api_id, _id)
-        delete_results = pipe.execute()
-        pipe.reset()
-        return zip(imap(message_handler, delete_results), map(self._readvalue, values_results))
+        values = self._destroy(ids)
+        return zip(imap(message_handler, values), map(self._readvalue, values))
+
+
+###
+### Sharding
+###
+
+class HashRing(object):
+    """Consistent hashing of keys onto `node_count` nodes. Each node gets
+    `replicas` points on the ring and a key belongs to the node owning the
+    next point after the key's hash. Adding a node only moves the keys that
+    land on its points, about 1 / (node_count + 1) of them.
+    """
+    def __init__(self, node_count, replicas=160):
+        points = list()
+        for node in xrange(node_count):
+            for replica in xrange(replicas):
+                points.append((self._hash('%d-%d' % (node, replica)), node))
+        points.sort()
+        self._points = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        i = bisect(self._points, self._hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+class ShardedRedisQueryset(AbstractQueryset):
+    """Spreads a collection over several Redis servers. `db_conns` is a list
+    of connections and items are placed on them by a `HashRing` of their ids.
+    Keep the order of `db_conns` when restarting and add new servers to the
+    end, so items stay where they are.
+
+    Each server is used through its own `RedisQueryset`, created with the
+    rest of the keyword arguments. Operations on several items are split up
+    by server and the parts run at the same time on `pool`, one round trip
+    each.
+
+    Pages without an index walk the servers in turn. Pages from an index
+    read the top of each server's sorted set and merge them.
+    """
+    def __init__(self, db_conns, replicas=160, pool=None, api_id='id', **kw):
+        super(ShardedRedisQueryset, self).__init__(db_conn=None, api_id=api_id)
+        self.shards = [RedisQueryset(db_conn=db_conn, api_id=api_id, **kw)
+                       for db_conn in db_conns]
+        self.ring = HashRing(len(self.shards), replicas)
+        if pool is None:
+            pool = coro_pool()
+        self.pool = pool
+
+    def shard_for(self, shield_id):
+        return self.shards[self.ring.get_node(str(shield_id))]
+
+    def _run(self, calls):
+        """Runs each `(function, argument)` pair at the same time and returns
+        their results in order. If any of them fail, the first error is
+        raised once they've all finished.
+        """
+        if len(calls) == 1:
+            (function, argument) = calls[0]
+            return [function(argument)]
+        queue = coro_queue()
+
+        def run(i, function, argument):
+            try:
+                queue.put((i, True, function(argument)))
+            except Exception, e:
+                queue.put((i, False, e))
+
+        for i, (function, argument) in enumerate(calls):
+            self.pool.spawn(run, i, function, argument)
+        results = [None] * len(calls)
+        error = None
+        for n in xrange(len(calls)):
+            (i, ok, value) = queue.get()
+            if not ok and error is None:
+                error = value
+            results[i] = value
+        if error is not None:
+            raise error
+        return results
+
+    def _scatter(self, method, items, key=str):
+        """Calls `method` on each shard with its share of `items` and puts the
+        results back in the order of `items`.
+        """
+        if not items:
+            return list()
+        groups = OrderedDict()
+        for position, item in enumerate(items):
+            node = self.ring.get_node(str(key(item)))
+            groups.setdefault(node, list()).append(position)
+        calls = [(getattr(self.shards[node], method),
+                  [items[position] for position in positions])
+                 for node, positions in groups.iteritems()]
+        results = [None] * len(items)
+        for positions, shard_results in zip(groups.itervalues(),
+                                            self._run(calls)):
+            for position, result in zip(positions, shard_results):
+                results[position] = result
+        return results
+
+    def _shield_key(self, shield):
+        return getattr(shield, self.api_id)
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self.shard_for(self._shield_key(shield)).create_one(shield)
+
+    def create_many(self, shields):
+        return self._scatter('create_many', shields, self._shield_key)
 
+    ### Read Functions
+
+    def read_all(self):
+        calls = [(lambda shard: shard.read_all(), shard)
+                 for shard in self.shards]
+        return [item for items in self._run(calls) for item in items]
+
+    def read_one(self, shield_id):
+        return self.shard_for(shield_id).read_one(shield_id)
+
+    def read_many(self, shield_ids):
+        return self._scatter('read_many', shield_ids)
+
+    def _read_ids(self, shield_ids):
+        return [(status, datum) for status, datum
+                in self._scatter('read_many', shield_ids)
+                if status == self.MSG_OK]
+
+    def _merge_index(self, field, lower, upper, descending=False, after=None,
+                     offset=0, count=None):
+        """Reads the first `offset + count` entries of each shard's index and
+        merges them into one `_scan_index` result.
+        """
+        shard_count = None
+        if count is not None:
+            shard_count = offset + count
+        calls = [(lambda shard: shard._scan_index(field, lower, upper,
+                                                  descending, after,
+                                                  count=shard_count), shard)
+                 for shard in self.shards]
+        pairs = [pair for shard_pairs in self._run(calls)
+                 for pair in shard_pairs]
+        pairs.sort(key=lambda pair: (pair[1], pair[0]), reverse=descending)
+        if count is None:
+            return pairs[offset:]
+        return pairs[offset:offset + count]
+
+    def read_page(self, limit, cursor=None, offset=0, order_by=None,
+                  filters=None):
+        """See `RedisQueryset.read_page`. Unindexed pages have a cursor of
+        the shard number and its scan cursor.
+        """
+        query = self.shards[0]._index_query(cursor, order_by, filters)
+        if query is None:
+            return self._scan_page(limit, cursor, offset)
+        (field, lower, upper, descending, after) = query
+        pairs = self._merge_index(field, lower, upper, descending, after,
+                                  offset, limit + 1)
+        (pairs, next_cursor) = self.shards[0]._index_page(pairs, limit)
+        return (self._read_ids([key for key, score in pairs]), next_cursor)
+
+    def _scan_page(self, limit, cursor=None, offset=0):
+        (node, scan_cursor) = (0, None)
+        if cursor is not None:
+            try:
+                (node, scan_cursor) = cursor.split(':', 1)
+                node = int(node)
+            except ValueError:
+                raise ValueError('Invalid cursor: %s' % cursor)
+            if not 0 <= node < len(self.shards):
+                raise ValueError('Invalid cursor: %s' % cursor)
+            scan_cursor = scan_cursor or None
+
+        items = list()
+        while node < len(self.shards) and len(items) < limit:
+            (shard_items, scan_cursor) = self.shards[node]._scan_page(
+                limit - len(items), scan_cursor)
+            if offset:
+                skipped = min(offset, len(shard_items))
+                shard_items = shard_items[skipped:]
+                offset -= skipped
+            items.extend(shard_items)
+            if scan_cursor is None:
+                node += 1
+
+        next_cursor = None
+        if node < len(self.shards):
+            next_cursor = '%d:%s' % (node, scan_cursor or '')
+        return (items, next_cursor)
+
+    def filterable_fields(self):
+        return self.shards[0].filterable_fields()
+
+    def read_range(self, field, lower=None, upper=None, limit=None, offset=0,
+                   descending=False):
+        """See `RedisQueryset.read_range`.
+        """
+        if field not in self.filterable_fields():
+            raise ValueError('%s is not indexed' % field)
+        if lower is not None:
+            lower = (lower, False)
+        if upper is not None:
+            upper = (upper, False)
+        pairs = self._merge_index(field, lower, upper, descending,
+                                  offset=offset, count=limit)
+        return self._read_ids([key for key, score in pairs])
+
+    def read_since(self, since, field='created_at', limit=None):
+        """See `RedisQueryset.read_since`.
+        """
+        if field not in self.filterable_fields():
+            raise ValueError('%s is not indexed' % field)
+        pairs = self._merge_index(field, (since, True), None, count=limit)
+        return self._read_ids([key for key, score in pairs])
+
+    def reindex(self, batch_size=500):
+        self._run([(lambda shard: shard.reindex(batch_size), shard)
+                   for shard in self.shards])
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self.shard_for(self._shield_key(shield)).update_one(shield)
+
+    def update_many(self, shields):
+        return self._scatter('update_many', shields, self._shield_key)
+
+    ### Destroy Functions
+
+    def destroy_one(self, shield_id):
+        return self.shard_for(shield_id).destroy_one(shield_id)
+
+    def destroy_many(self, ids):
+        return self._scatter('destroy_many', ids)
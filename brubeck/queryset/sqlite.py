@@ -0,0 +1,301 @@
+import re
+import sqlite3
+import threading
+
+import ujson as json
+
+from brubeck.request_handling import FourOhFourException
+from brubeck.queryset.base import AbstractQueryset, parse_filters
+
+
+SQL_OPERATORS = {
+    'eq': '=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+}
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def load_thread_runner(size):
+    """Returns a function that runs a blocking call in a thread and waits
+    for it without blocking the other coroutines, using the thread pool of
+    whichever coroutine library Brubeck is running on.
+    """
+    from brubeck.request_handling import CORO_LIBRARY
+    if CORO_LIBRARY == 'gevent':
+        from gevent.threadpool import ThreadPool
+        pool = ThreadPool(size)
+        return lambda function, *args: pool.apply(function, args)
+    elif CORO_LIBRARY == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute
+
+
+class SQLiteQueryset(AbstractQueryset):
+    """Stores items as JSON in a SQLite table with one row per item, keyed
+    by the model's id. The database is in WAL mode, so reads don't wait for
+    writes.
+
+    `indexes` names fields to index, eg. `['owner', 'created_at']`. Each one
+    gets an index on the field's value in the JSON, so `read_page` can filter
+    on it and order by it without a table scan. Adding a field just creates
+    another index.
+
+    SQLite calls block, so every call runs on one of `threads` threads and
+    the calling coroutine waits without holding up the others. Each thread
+    has its own connection, which means `path` has to be a file rather than
+    `:memory:`.
+    """
+    indexes = None
+    MAX_VARIABLES = 500
+
+    def __init__(self, path, table='items', indexes=None, threads=4,
+                 timeout=30, **kw):
+        super(SQLiteQueryset, self).__init__(**kw)
+        if indexes is not None:
+            self.indexes = indexes
+        self.indexes = tuple(self.indexes or ())
+        for name in (table, self.api_id) + self.indexes:
+            if not _IDENTIFIER.match(name):
+                raise ValueError('Invalid name: %s' % name)
+        self.path = path
+        self.table = table
+        self.timeout = timeout
+        self._local = threading.local()
+        self._run = load_thread_runner(threads)
+        self._run(self._create_schema)
+
+    ###
+    ### Connections
+    ###
+
+    def _connection(self):
+        """Returns the current thread's connection, opening it first if
+        needed.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s ('
+                         '  id TEXT PRIMARY KEY,'
+                         '  data TEXT NOT NULL)' % self.table)
+            for field in self.indexes:
+                conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' %
+                             (self.table, field, self.table,
+                              self._column(field)))
+
+    def _column(self, field):
+        """Returns the SQL for a field's value. Indexed fields are read
+        from the JSON with the same expression their index was built on.
+        """
+        if field == self.api_id:
+            return 'id'
+        return "json_extract(data, '$.%s')" % field
+
+    def _chunks(self, items):
+        for i in xrange(0, len(items), self.MAX_VARIABLES):
+            yield items[i:i + self.MAX_VARIABLES]
+
+    def _existing(self, conn, ids):
+        """Returns a dict of the stored JSON for each of `ids` that exists.
+        """
+        rows = dict()
+        for chunk in self._chunks(ids):
+            rows.update(conn.execute(
+                'SELECT id, data FROM %s WHERE id IN (%s)' %
+                (self.table, ', '.join('?' * len(chunk))), chunk))
+        return rows
+
+    ###
+    ### Blocking implementations, run on the thread pool
+    ###
+
+    def _write(self, rows):
+        """Inserts or replaces `(id, json)` rows in one transaction and
+        returns which ids existed before.
+        """
+        conn = self._connection()
+        with conn:
+            existing = self._existing(conn, [row[0] for row in rows])
+            conn.executemany('INSERT OR REPLACE INTO %s (id, data) '
+                             'VALUES (?, ?)' % self.table, rows)
+        return existing
+
+    def _read(self, ids):
+        return self._existing(self._connection(), ids)
+
+    def _read_all(self):
+        return self._connection().execute(
+            'SELECT data FROM %s ORDER BY id' % self.table).fetchall()
+
+    def _delete(self, ids):
+        """Deletes `ids` in one transaction and returns the JSON of those
+        that existed.
+        """
+        conn = self._connection()
+        with conn:
+            existing = self._existing(conn, ids)
+            conn.executemany('DELETE FROM %s WHERE id = ?' % self.table,
+                             [(iid,) for iid in existing])
+        return existing
+
+    def _select(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    ###
+    ### CRUD Implementations
+    ###
+
+    def _rows(self, shields):
+        return [(str(getattr(shield, self.api_id)), shield.to_json())
+                for shield in shields]
+
+    def _write_statuses(self, shields):
+        rows = self._rows(shields)
+        existing = self._run(self._write, rows)
+        return [(self.MSG_UPDATED if row[0] in existing else self.MSG_CREATED,
+                 shield) for row, shield in zip(rows, shields)]
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        return self._write_statuses([shield])[0]
+
+    def create_many(self, shields):
+        return self._write_statuses(shields)
+
+    ### Read Functions
+
+    def read_all(self):
+        return [(self.MSG_OK, json.loads(data))
+                for (data,) in self._run(self._read_all)]
+
+    def read_one(self, iid):
+        return self.read_many([iid])[0]
+
+    def read_many(self, ids):
+        ids = [str(iid) for iid in ids]
+        rows = self._run(self._read, ids)
+        return [(self.MSG_OK, json.loads(rows[iid])) if iid in rows
+                else (self.MSG_FAILED, iid) for iid in ids]
+
+    def filterable_fields(self):
+        return self.indexes
+
+    def _after(self, column, value, shield_key, descending):
+        """Returns SQL and parameters for the rows after the cursor's row in
+        order of `column` then id. Items without a value for the field sort
+        before all the others.
+        """
+        if descending:
+            if value is None:
+                beyond = '0'
+                params = []
+            else:
+                beyond = '(%s < ? OR %s IS NULL)' % (column, column)
+                params = [value]
+            tie = '%s IS ? AND id < ?' % column
+        else:
+            if value is None:
+                beyond = '%s IS NOT NULL' % column
+                params = []
+            else:
+                beyond = '%s > ?' % column
+                params = [value]
+            tie = '%s IS ? AND id > ?' % column
+        return ('(%s OR (%s))' % (beyond, tie), params + [value, shield_key])
+
+    def read_page(self, limit, cursor=None, offset=0, order_by=None,
+                  filters=None):
+        """Pages through the items in order of their ids, or of an indexed
+        field. Filters may use any indexed field and are answered by SQLite
+        from the indexes.
+
+        The cursor is the last id on the page, or its field value and id, so
+        pages don't shift when items are added.
+        """
+        clauses = list()
+        params = list()
+        for field, op, value in parse_filters(filters):
+            if field not in self.indexes and field != self.api_id:
+                raise ValueError('No index for filtering on %s' % field)
+            clauses.append('%s %s ?' % (self._column(field),
+                                        SQL_OPERATORS[op]))
+            params.append(value)
+
+        field = self.api_id
+        descending = False
+        if order_by is not None:
+            descending = order_by.startswith('-')
+            field = order_by.lstrip('-')
+            if field != self.api_id and field not in self.indexes:
+                raise ValueError('Ordering by %s is not supported' % field)
+        column = self._column(field)
+        direction = descending and 'DESC' or 'ASC'
+
+        if cursor is not None and field == self.api_id:
+            clauses.append('id %s ?' % (descending and '<' or '>'))
+            params.append(cursor)
+        elif cursor is not None:
+            try:
+                (value, shield_key) = json.loads(cursor)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid cursor: %s' % cursor)
+            (clause, after_params) = self._after(column, value, shield_key,
+                                                 descending)
+            clauses.append(clause)
+            params.extend(after_params)
+
+        sql = 'SELECT id, data, %s FROM %s' % (column, self.table)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY %s %s' % (column, direction)
+        if field != self.api_id:
+            sql += ', id %s' % direction
+        sql += ' LIMIT ? OFFSET ?'
+        rows = self._run(self._select, sql, params + [limit + 1, offset])
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            (shield_key, data, value) = rows[-1]
+            if field == self.api_id:
+                next_cursor = shield_key
+            else:
+                next_cursor = json.dumps([value, shield_key])
+        return ([(self.MSG_OK, json.loads(data)) for shield_key, data, value
+                 in rows], next_cursor)
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        return self._write_statuses([shield])[0]
+
+    def update_many(self, shields):
+        return self._write_statuses(shields)
+
+    ### Destroy Functions
+
+    def destroy_one(self, item_id):
+        item_id = str(item_id)
+        rows = self._run(self._delete, [item_id])
+        if item_id not in rows:
+            raise FourOhFourException
+        return (self.MSG_UPDATED, json.loads(rows[item_id]))
+
+    def destroy_many(self, ids):
+        ids = [str(iid) for iid in ids]
+        rows = self._run(self._delete, ids)
+        return [(self.MSG_UPDATED, json.loads(rows[iid])) if iid in rows
+                else (self.MSG_FAILED, None) for iid in ids]
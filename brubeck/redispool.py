@@ -0,0 +1,236 @@
+"""Connection pooling and replica routing for Redis.
+
+A `RedisConnectionManager` can be passed anywhere a redis-py client is
+expected, eg. as the `db_conn` of a `RedisQueryset` or the connection of a
+`RedisCacheStore`:
+
+    redis_connection = RedisConnectionManager(
+        {'host': 'redis-primary'},
+        replicas=[{'host': 'redis-replica-1'}, {'host': 'redis-replica-2'}],
+        max_connections=32)
+    queries = RedisQueryset(db_conn=redis_connection)
+
+Read commands go to a replica and everything else, including pipelines and
+scripts, goes to the primary. Replicas lag behind the primary a little, so
+set `replica_reads=False` where a read has to see the write before it.
+
+Each server has a pool of at most `max_connections` connections. A
+coroutine that finds them all in use waits in a coroutine queue for up to
+`timeout` seconds. How long checkouts take is recorded per server and
+reported by `stats()`.
+"""
+
+import time
+import socket
+import random
+import logging
+import weakref
+
+from request_handling import coro_queue
+from caching import LatencyHistogram
+
+try:
+    import redis
+except ImportError:
+    pass
+
+
+### Commands that never write, and can be sent to a replica
+READ_COMMANDS = frozenset([
+    'exists', 'get', 'mget', 'ttl', 'pttl', 'type', 'strlen',
+    'hexists', 'hget', 'hgetall', 'hkeys', 'hlen', 'hmget', 'hscan', 'hvals',
+    'scard', 'sismember', 'smembers', 'sscan',
+    'zcard', 'zcount', 'zrange', 'zrangebyscore', 'zrank', 'zrevrange',
+    'zrevrangebyscore', 'zrevrank', 'zscan', 'zscore',
+    'lindex', 'llen', 'lrange',
+])
+
+
+###
+### Pools
+###
+
+### What `BlockingConnectionPool` raises when no connection frees up in time
+POOL_EXHAUSTED = 'No connection available.'
+
+
+class MeteredPool(object):
+    """Wraps a redis-py connection pool to time each checkout and count the
+    connections in use. Everything else is passed to the wrapped pool.
+
+    Checkouts that wait too long for a free connection, or for the server
+    to accept one, count as `timeouts`. Other connection failures count as
+    `errors`.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.wait_times = LatencyHistogram()
+        self.in_use = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            connection = self.pool.get_connection(command_name, *keys,
+                                                  **options)
+        except (redis.TimeoutError, socket.timeout):
+            self.timeouts += 1
+            raise
+        except redis.ConnectionError, e:
+            if str(e) == POOL_EXHAUSTED:
+                self.timeouts += 1
+            else:
+                self.errors += 1
+            raise
+        finally:
+            self.wait_times.record(time.time() - start)
+        self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        self.in_use -= 1
+        self.pool.release(connection)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+
+def make_pool(address, max_connections, timeout):
+    """Creates a blocking pool for `address`, a redis URL or a dict of
+    connection arguments, that waits for connections in a coroutine queue.
+    """
+    options = {'max_connections': max_connections, 'timeout': timeout,
+               'queue_class': coro_queue}
+    if isinstance(address, basestring):
+        return redis.BlockingConnectionPool.from_url(address, **options)
+    options.update(address)
+    return redis.BlockingConnectionPool(**options)
+
+
+###
+### Servers
+###
+
+class RedisNode(object):
+    """One Redis server: its client, its pool and whether it's healthy.
+
+    After `max_failures` connection errors in a row the node is ejected for
+    `eject_time` seconds. It's tried again once that has passed. Only
+    replicas record failures, so the primary is never ejected.
+    """
+    def __init__(self, name, address, max_connections=50, timeout=1.0,
+                 max_failures=3, eject_time=5.0):
+        self.name = name
+        self.pool = MeteredPool(make_pool(address, max_connections, timeout))
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+        self.max_connections = max_connections
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+
+    def is_healthy(self):
+        return time.time() >= self.ejected_until
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            logging.warning('Ejecting Redis server %s for %ss' %
+                            (self.name, self.eject_time))
+            self.ejected_until = time.time() + self.eject_time
+            self.ejections += 1
+            self.failures = 0
+
+    def stats(self):
+        return {
+            'healthy': self.is_healthy(),
+            'failures': self.failures,
+            'ejections': self.ejections,
+            'in_use': self.pool.in_use,
+            'max_connections': self.max_connections,
+            'timeouts': self.pool.timeouts,
+            'errors': self.pool.errors,
+            'wait': self.pool.wait_times.to_dict(),
+        }
+
+
+###
+### Connection manager
+###
+
+_connection_managers = weakref.WeakValueDictionary()
+
+
+def connection_managers():
+    """Returns a dict mapping names to every live `RedisConnectionManager`.
+    """
+    return dict(_connection_managers.items())
+
+
+class RedisConnectionManager(object):
+    """Acts like a redis-py client over a primary and any number of
+    replicas. `primary` and each of `replicas` are redis URLs or dicts of
+    connection arguments.
+
+    Reads go to the less busy of two random healthy replicas. If that
+    replica fails, or none are healthy, the read goes to the primary.
+
+    The primary is never ejected. Writes have no other server to go to, so
+    its errors are raised to the caller and show up in its pool's stats.
+
+    Managers are registered under `name` so `cachestats.CacheStatsHandler`
+    can report their pools.
+    """
+    node_class = RedisNode
+
+    def __init__(self, primary, replicas=(), max_connections=50, timeout=1.0,
+                 max_failures=3, eject_time=5.0, replica_reads=True,
+                 name='redis'):
+        options = {'max_connections': max_connections, 'timeout': timeout,
+                   'max_failures': max_failures, 'eject_time': eject_time}
+        self.primary = self.node_class('primary', primary, **options)
+        self.replicas = [self.node_class('replica%d' % i, replica, **options)
+                         for i, replica in enumerate(replicas)]
+        self.replica_reads = replica_reads
+        self.name = name
+        _connection_managers[name] = self
+
+    def choose_replica(self):
+        """Returns a healthy replica, or None if there isn't one.
+        """
+        healthy = [node for node in self.replicas if node.is_healthy()]
+        if len(healthy) < 2:
+            return healthy and healthy[0] or None
+        (a, b) = random.sample(healthy, 2)
+        if b.pool.in_use < a.pool.in_use:
+            return b
+        return a
+
+    def _read(self, name):
+        def read_command(*args, **kwargs):
+            node = self.choose_replica()
+            if node is not None:
+                try:
+                    result = getattr(node.client, name)(*args, **kwargs)
+                    node.record_success()
+                    return result
+                except (redis.ConnectionError, redis.TimeoutError):
+                    node.record_failure()
+            return getattr(self.primary.client, name)(*args, **kwargs)
+        return read_command
+
+    def __getattr__(self, name):
+        if name in READ_COMMANDS and self.replica_reads and self.replicas:
+            return self._read(name)
+        return getattr(self.primary.client, name)
+
+    def stats(self):
+        """Returns the stats of every server's pool, by server name.
+        """
+        nodes = [self.primary] + self.replicas
+        return dict((node.name, node.stats()) for node in nodes)
@@ -1,10 +1,11 @@
 import cgi
 import json
-import Cookie
 import logging
 import urlparse
 import re
 
+from cookies import RequestCookies
+
 def parse_netstring(ns):
     length, rest = ns.split(':', 1)
     length = int(length)
@@ -171,14 +172,10 @@ class Request(object):
     def cookies(self):
         """Lazy generation of cookies from request headers."""
         if not hasattr(self, "_cookies"):
-            self._cookies = Cookie.SimpleCookie()
-            if "cookie" in self.headers:
-                try:
-                    cookies = self.headers['cookie']
-                    self._cookies.load(to_bytes(cookies))
-                except Exception, e:
-                    logging.error('Failed to load cookies')
-                    self.clear_all_cookies()
+            cookies = self.headers.get('cookie')
+            if cookies is not None:
+                cookies = to_bytes(cookies)
+            self._cookies = RequestCookies(cookies)
         return self._cookies
 
     @property
@@ -18,6 +18,8 @@ try:
     from gevent import pool
 
     coro_pool = pool.Pool
+    from gevent.queue import Queue as coro_queue
+    from gevent import sleep as coro_sleep
 
     def coro_spawn(function, app, message, *a, **kw):
         app.pool.spawn(function, app, message, *a, **kw)
@@ -31,6 +33,8 @@ except ImportError:
         eventlet.patcher.monkey_patch(all=True)
 
         coro_pool = eventlet.GreenPool
+        from eventlet.queue import Queue as coro_queue
+        coro_sleep = eventlet.sleep
 
         def coro_spawn(function, app, message, *a, **kw):
             app.pool.spawn_n(function, app, message, *a, **kw)
@@ -47,14 +51,18 @@ import re
 import time
 import logging
 import inspect
-import Cookie
 import base64
 import hmac
+import hashlib
 import cPickle as pickle
 from itertools import chain
+from collections import OrderedDict
 import os, sys
 from dictshield.base import ShieldException
 from request import Request, to_bytes, to_unicode
+from cookies import ResponseCookies
+from caching import FragmentCache, ExpirySweeper
+from accesslog import AccessLog
 
 import ujson as json
 
@@ -67,6 +75,10 @@ HTTP_METHODS = ['get', 'post', 'put', 'delete',
 
 HTTP_FORMAT = "HTTP/1.1 %(code)s %(status)s\r\n%(headers)s\r\n\r\n%(body)s"
 
+HTTP_HEAD_FORMAT = "HTTP/1.1 %(code)s %(status)s\r\n%(headers)s\r\n\r\n"
+
+HTTP_LAST_CHUNK = "0\r\n\r\n"
+
 
 class FourOhFourException(Exception):
     pass
@@ -95,17 +107,110 @@ def http_response(body, code, status, headers):
         content_length = len(to_bytes(body))
 
     headers['Content-Length'] = content_length
-    payload['headers'] = "\r\n".join('%s: %s' % (k, v)
-                                     for k, v in headers.items())
+    payload['headers'] = "\r\n".join(header_lines(headers))
 
     return HTTP_FORMAT % payload
 
+
+def header_lines(headers):
+    """Renders a dict of headers as a list of `Name: value` lines. A list
+    value, like several `Set-Cookie`s, becomes one line per item.
+    """
+    lines = list()
+    for k, v in headers.items():
+        if isinstance(v, list):
+            lines.extend('%s: %s' % (k, item) for item in v)
+        else:
+            lines.append('%s: %s' % (k, v))
+    return lines
+
+
+def is_streamed(body):
+    """Returns True if `body` is an iterable of chunks instead of a string.
+    """
+    return (body is not None and not isinstance(body, basestring)
+            and hasattr(body, '__iter__'))
+
+
+def http_response_head(code, status, headers):
+    """Renders the status line and headers for a chunked HTTP response. The
+    body follows as a series of `http_chunk` calls and `HTTP_LAST_CHUNK`.
+    """
+    headers.pop('Content-Length', None)
+    headers['Transfer-Encoding'] = 'chunked'
+    payload = {'code': code, 'status': status}
+    payload['headers'] = "\r\n".join(header_lines(headers))
+    return HTTP_HEAD_FORMAT % payload
+
+
+def http_response_headers(code, status, headers):
+    """Renders the status line and headers of a response to a HEAD request.
+    `Content-Length` is left as the handler set it, since it describes the
+    body a GET would return.
+    """
+    payload = {'code': code, 'status': status}
+    payload['headers'] = "\r\n".join(header_lines(headers))
+    return HTTP_HEAD_FORMAT % payload
+
+
+def http_chunk(data):
+    """Frames `data` as a single chunk of a chunked HTTP response. Empty data
+    must not be sent, as a zero length chunk ends the response.
+    """
+    data = to_bytes(data)
+    return '%x\r\n%s\r\n' % (len(data), data)
+
+
+def coalesce_chunks(chunks, min_size=0):
+    """Joins the pieces yielded by `chunks` until at least `min_size` bytes
+    are collected. Empty pieces are dropped. A `min_size` of 0 passes every
+    piece through as soon as it's produced.
+    """
+    buffered = list()
+    buffered_size = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = to_bytes(chunk)
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= min_size:
+            yield ''.join(buffered)
+            buffered = list()
+            buffered_size = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def file_blocks(f, length=None, block_size=64 * 1024):
+    """Reads `length` bytes from file `f` in blocks of `block_size`, or until
+    the end of the file if `length` is None. The file is closed afterwards.
+    """
+    try:
+        while length is None or length > 0:
+            read_size = block_size
+            if length is not None:
+                read_size = min(block_size, length)
+            block = f.read(read_size)
+            if not block:
+                break
+            if length is not None:
+                length -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
 def _lscmp(a, b):
     """Compares two strings in a cryptographically safe way
     """
     return not sum(0 if x == y else 1
                    for x, y in zip(a, b)) and len(a) == len(b)
 
+### Python 2.7.7 and later have this built in, and it's much quicker
+if hasattr(hmac, 'compare_digest'):
+    _lscmp = hmac.compare_digest
+
 
 ###
 ### Me not *take* cookies, me *eat* the cookies.
@@ -113,6 +218,9 @@ def _lscmp(a, b):
 
 def cookie_encode(data, key):
     """Encode and sign a pickle-able object. Return a (byte) string
+
+    This is the original signed cookie format. `signed_cookie_encode` is used
+    for new cookies, but cookies in this format are still accepted.
     """
     msg = base64.b64encode(pickle.dumps(data, -1))
     sig = base64.b64encode(hmac.new(key, msg).digest())
@@ -134,6 +242,68 @@ def cookie_is_encoded(data):
     return bool(data.startswith(to_bytes('!')) and to_bytes('?') in data)
 
 
+### Signed cookies: `$<payload>.<signature>`, both urlsafe base64. The
+### payload is a JSON list of the data and an expiry timestamp (0 for none).
+
+SIGNED_COOKIE_PREFIX = '$'
+VERIFIED_COOKIES_MAX = 1024
+
+_verified_cookies = OrderedDict()
+
+
+def _b64encode(s):
+    return base64.urlsafe_b64encode(s).rstrip('=')
+
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+def signed_cookie_encode(data, key, expires=None):
+    """Encode and sign a JSON serializable object with HMAC-SHA256. Return a
+    (byte) string. If `expires` is a UNIX timestamp, decoding fails after it.
+    """
+    payload = _b64encode(json.dumps([data, expires or 0]))
+    sig = _b64encode(hmac.new(key, payload, hashlib.sha256).digest())
+    return SIGNED_COOKIE_PREFIX + payload + '.' + sig
+
+
+def signed_cookie_decode(data, key):
+    """Verify and decode a string from `signed_cookie_encode`. Return an
+    object or None if the signature is wrong or the cookie expired.
+
+    The last `VERIFIED_COOKIES_MAX` strings that passed verification are
+    remembered, so a returning cookie skips the HMAC.
+    """
+    data = to_bytes(data)
+    if not signed_cookie_is_encoded(data):
+        return None
+    payload, sig = data[1:].rsplit('.', 1)
+
+    cache_key = (key, data)
+    if _verified_cookies.pop(cache_key, None) is None:
+        expected = _b64encode(hmac.new(key, payload, hashlib.sha256).digest())
+        if not _lscmp(sig, expected):
+            return None
+        if len(_verified_cookies) >= VERIFIED_COOKIES_MAX:
+            _verified_cookies.popitem(last=False)
+    _verified_cookies[cache_key] = True
+
+    try:
+        (value, expires) = json.loads(_b64decode(payload))
+    except (TypeError, ValueError):
+        return None
+    if expires and expires < time.time():
+        return None
+    return value
+
+
+def signed_cookie_is_encoded(data):
+    """Return True if the argument looks like a signed cookie.
+    """
+    return bool(data.startswith(SIGNED_COOKIE_PREFIX) and '.' in data)
+
+
 ###
 ### Message handling
 ###
@@ -462,7 +632,11 @@ class WebMessageHandler(MessageHandler):
         if key in self.message.cookies:
             value = self.message.cookies[key].value
         if secret and value:
-            dec = cookie_decode(value, secret)
+            if signed_cookie_is_encoded(value):
+                dec = signed_cookie_decode(value, secret)
+            else:
+                ### Cookies signed before the switch to signed_cookie_encode
+                dec = cookie_decode(value, secret)
             return dec[1] if dec and dec[0] == key else None
         return value
 
@@ -472,7 +646,7 @@ class WebMessageHandler(MessageHandler):
     def cookies(self):
         """Lazy creation of response cookies."""
         if not hasattr(self, "_cookies"):
-            self._cookies = Cookie.SimpleCookie()
+            self._cookies = ResponseCookies()
         return self._cookies
 
     def set_cookie(self, key, value, secret=None, **kwargs):
@@ -491,9 +665,17 @@ class WebMessageHandler(MessageHandler):
 
         If neither `expires` nor `max_age` are set (default), the cookie
         lasts only as long as the browser is not closed.
+
+        Signed cookie values must be JSON serializable. A positive `max_age`
+        is also signed into the value, so the server rejects the cookie once
+        it expires.
         """
         if secret:
-            value = cookie_encode((key, value), secret)
+            expires = None
+            max_age = kwargs.get('max_age')
+            if max_age > 0:
+                expires = int(time.time() + max_age)
+            value = signed_cookie_encode((key, value), secret, expires=expires)
         elif not isinstance(value, basestring):
             raise TypeError('Secret missing for non-string Cookie.')
 
@@ -522,13 +704,25 @@ class WebMessageHandler(MessageHandler):
     ### Output generation
     ###
 
+    def log_access(self, status_code):
+        """Records the response in the application's access log, if it has
+        one.
+        """
+        access_log = self.application.access_log
+        if access_log is not None:
+            access_log.record(self, status_code)
+
     def convert_cookies(self):
-        """ Resolves cookies into multiline values.
+        """Resolves cookies into `Set-Cookie` headers. A single cookie is a
+        string, more than one is a list with a header value for each.
         """
-        cookie_vals = [c.OutputString() for c in self.cookies.values()]
-        if len(cookie_vals) > 0:
-            cookie_str = '\nSet-Cookie: '.join(cookie_vals)
-            self.headers['Set-Cookie'] = cookie_str
+        if not hasattr(self, '_cookies') or not self._cookies:
+            return
+        cookie_vals = self._cookies.output_headers()
+        if len(cookie_vals) == 1:
+            self.headers['Set-Cookie'] = cookie_vals[0]
+        else:
+            self.headers['Set-Cookie'] = cookie_vals
 
     def render(self, status_code=None, http_200=False, **kwargs):
         """Renders payload and prepares the payload for a successful HTTP
@@ -550,9 +744,7 @@ class WebMessageHandler(MessageHandler):
 
         response = render(self.body, status_code, self.status_msg, self.headers)
 
-        logging.info('%s %s %s (%s)' % (status_code, self.message.method,
-                                        self.message.path,
-                                        self.message.remote_addr))
+        self.log_access(status_code)
         return response
 
 
@@ -579,9 +771,7 @@ class JSONMessageHandler(WebMessageHandler):
         response = render(body, self.status_code, self.status_msg,
                           self.headers)
 
-        logging.info('%s %s %s (%s)' % (self.status_code, self.message.method,
-                                        self.message.path,
-                                        self.message.remote_addr))
+        self.log_access(self.status_code)
         return response
 
 
@@ -619,8 +809,8 @@ class Brubeck(object):
     def __init__(self, msg_conn=None, handler_tuples=None, pool=None,
                  no_handler=None, base_handler=None, template_loader=None,
                  log_level=logging.INFO, login_url=None, db_conn=None,
-                 cookie_secret=None, api_base_url=None,
-                 *args, **kwargs):
+                 cookie_secret=None, api_base_url=None, cache_store=None,
+                 access_log=None, cache_sweeper=None, *args, **kwargs):
         """Brubeck is a class for managing connections to webservers. It
         supports Mongrel2 and WSGI while providing an asynchronous system for
         managing message handling.
@@ -648,6 +838,16 @@ class Brubeck(object):
         `db_conn` is a database connection to be shared in this process
 
         `cookie_secret` is a string to use for signing secure cookies.
+
+        `cache_store` is a `caching.BaseCacheStore` shared by the handlers,
+        eg. for caching rendered template fragments.
+
+        `access_log` is an `accesslog.AccessLog`. One that logs every request
+        is used if it's not set. `False` turns access logging off.
+
+        `cache_sweeper` is a `caching.ExpirySweeper` that purges expired
+        cache entries in the background. `True` creates one for the app's
+        cache store. Nothing is swept by default.
         """
         # All output is sent via logging
         # (while i figure out how to do a good abstraction via zmq)
@@ -697,6 +897,23 @@ class Brubeck(object):
         # This must be set to use secure cookies
         self.cookie_secret = cookie_secret
 
+        # A cache store is optional. In memory caching is used if not set
+        self.cache_store = cache_store
+        self.fragment_cache = FragmentCache(cache_store)
+
+        # Expired entries are purged by a coroutine started in run()
+        if cache_sweeper is True:
+            cache_sweeper = ExpirySweeper(self.fragment_cache.cache_store)
+        self.cache_sweeper = cache_sweeper or None
+
+        # Access logs are buffered and written by a coroutine started in run()
+        if access_log is None:
+            self.access_log = AccessLog()
+        elif access_log is False:
+            self.access_log = None
+        else:
+            self.access_log = access_log
+
         # Any template engine can be used. Brubeck just needs a function that
         # loads the environment without arguments.
         #
@@ -862,4 +1079,16 @@ class Brubeck(object):
         greeting = 'Brubeck v%s online ]-----------------------------------'
         print greeting % version
 
-        self.recv_forever_ever()
+        if self.access_log is not None:
+            self.access_log.start(self.pool)
+        if self.cache_sweeper is not None:
+            self.cache_sweeper.start(self.pool)
+        if hasattr(self.cache_store, 'start'):
+            self.cache_store.start(self.pool)
+
+        try:
+            self.recv_forever_ever()
+        finally:
+            ### Don't lose what was logged since the writer's last flush
+            if self.access_log is not None:
+                self.access_log.flush()
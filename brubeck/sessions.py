@@ -0,0 +1,184 @@
+"""Sessions stored in a `caching` cache store.
+
+Mix `SessionMixin` into a handler to get `self.session`, a dict that is
+loaded the first time it's used. At the end of the request, just before the
+cookies are rendered, a session that changed is saved and a session that
+was only read has its expiration pushed back with the store's `touch`,
+which doesn't send the data again. Reads only touch once the expiration
+would move by `session_touch_ratio` of the TTL, so a busy session isn't
+touched on every request.
+
+    class CartHandler(SessionMixin, WebMessageHandler):
+        def post(self):
+            self.session.setdefault('items', []).append(self.get_argument('sku'))
+            self.session.mark_dirty()
+            ...
+
+Sessions are kept in `session_store`, or the app's cache store if that's not
+set, and serialized as compact JSON. The session id cookie is signed if
+the app has a `cookie_secret`.
+"""
+
+import time
+
+import ujson as json
+
+from caching import generate_session_id
+
+
+###
+### Session data
+###
+
+class Session(dict):
+    """Session data that notices when it's changed.
+
+    Changing a nested value in place, eg. appending to a list, can't be
+    noticed. Call `mark_dirty()` after doing that.
+    """
+    def __init__(self, session_id, data=None, is_new=False, expire=None):
+        super(Session, self).__init__(data or ())
+        self.session_id = session_id
+        self.is_new = is_new
+        self.expire = expire
+        self.dirty = False
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def _changes(method):
+        def wrapper(self, *args, **kwargs):
+            self.dirty = True
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    __setitem__ = _changes(dict.__setitem__)
+    __delitem__ = _changes(dict.__delitem__)
+    clear = _changes(dict.clear)
+    pop = _changes(dict.pop)
+    popitem = _changes(dict.popitem)
+    update = _changes(dict.update)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.dirty = True
+        return dict.setdefault(self, key, default)
+
+    del _changes
+
+
+def encode_session(session):
+    return json.dumps(session)
+
+
+def decode_session(data):
+    return json.loads(data)
+
+
+def encode_session_cookie(session_id, expire):
+    return '%s:%d' % (session_id, expire)
+
+
+def decode_session_cookie(value):
+    """Returns the session id and expiration time in a session cookie. The
+    expiration is None for cookies set without one.
+    """
+    (session_id, sep, expire) = value.partition(':')
+    try:
+        return (session_id, float(expire) if sep else None)
+    except ValueError:
+        return (session_id, None)
+
+
+###
+### Handler mixin
+###
+
+class SessionMixin(object):
+    """Adds a lazily loaded `session` to a `WebMessageHandler`.
+
+    The session cookie carries the session's expiration time next to its
+    id, so a read can tell whether a touch is due without asking the store.
+    """
+    session_store = None
+    session_cookie = 'session_id'
+    session_key_prefix = 'session:'
+    session_ttl = 14 * 24 * 3600
+    session_touch_ratio = 0.05
+
+    def get_session_store(self):
+        """Returns `session_store` or the store the app's fragment cache
+        uses, which is the app's `cache_store` if it has one.
+        """
+        if self.session_store is not None:
+            return self.session_store
+        return self.application.fragment_cache.cache_store
+
+    @property
+    def session(self):
+        """The session for this request, loaded on first access.
+        """
+        if not hasattr(self, '_session'):
+            self._session = self.load_session()
+        return self._session
+
+    def load_session(self):
+        """Returns the session named by the session cookie, or a new, empty
+        session if there isn't one.
+        """
+        value = self.get_cookie(self.session_cookie,
+                                secret=self.application.cookie_secret)
+        if value:
+            (session_id, expire) = decode_session_cookie(value)
+            store = self.get_session_store()
+            data = store.load(self.session_key_prefix + session_id)
+            if data is not None:
+                try:
+                    return Session(session_id, decode_session(data),
+                                   expire=expire)
+                except ValueError:
+                    pass
+        return Session(generate_session_id(), is_new=True)
+
+    def _set_session_cookie(self, session_id, expire):
+        self.set_cookie(self.session_cookie,
+                        encode_session_cookie(session_id, expire),
+                        secret=self.application.cookie_secret,
+                        max_age=self.session_ttl, path='/')
+
+    def save_session(self):
+        """Writes the session back if it changed and pushes its expiration
+        back if it didn't and a touch is due. Sessions that were never used
+        are left alone.
+        """
+        if not hasattr(self, '_session'):
+            return
+        session = self._session
+        if session.is_new and not (session.dirty and session):
+            return
+
+        store = self.get_session_store()
+        key = self.session_key_prefix + session.session_id
+        expire = time.time() + self.session_ttl
+        if not session.dirty:
+            if (session.expire is not None and expire - session.expire <
+                self.session_ttl * self.session_touch_ratio):
+                return
+            store.touch(key, expire=expire)
+        elif session:
+            store.save(key, encode_session(session), expire=expire)
+        else:
+            store.delete(key)
+            self.delete_cookie(self.session_cookie, path='/')
+            session.dirty = False
+            return
+
+        session.is_new = False
+        session.dirty = False
+        session.expire = expire
+        self._set_session_cookie(session.session_id, expire)
+
+    def convert_cookies(self):
+        self.save_session()
+        super(SessionMixin, self).convert_cookies()
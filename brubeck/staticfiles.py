@@ -0,0 +1,333 @@
+"""Static file serving for deployments without Mongrel2 in front, eg. WSGI.
+
+`StaticFileHandler` serves files below `static_dir`. Small files are kept in
+an in-memory LRU, large files are handed to the server in blocks, or through
+`wsgi.file_wrapper` when the WSGI server provides one. Responses carry
+`Last-Modified` and `ETag` validators, honor conditional requests and single
+byte ranges, and use a precompressed `.gz` sibling when the client accepts
+gzip.
+
+Route it like any other handler:
+
+    class MediaHandler(StaticFileHandler):
+        static_dir = './media'
+
+    handler_tuples = [(r'^/media/(?P<path>.+)$', MediaHandler)]
+"""
+
+import os
+import re
+import stat
+import time
+import mimetypes
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from request_handling import WebMessageHandler, file_blocks
+
+
+###
+### Helpers
+###
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def stat_file(path):
+    """Returns the `os.stat` result for `path` if it's a regular file, else
+    None. Paths `os.stat` rejects, eg. ones with a NUL byte, are treated as
+    missing.
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st
+
+
+_content_types = dict()
+_static_roots = dict()
+_header_keys = dict()
+
+
+def guess_content_type(path):
+    """Returns the mimetype for `path`, remembering the answer for each file.
+    Only files that exist get here, so the memo can't outgrow `static_dir`.
+    """
+    content_type = _content_types.get(path)
+    if content_type is None:
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        _content_types[path] = content_type
+    return content_type
+
+
+def parse_range(range_header, size):
+    """Parses a `Range` header for a file of `size` bytes into a tuple of
+    `(start, end)`, with `end` inclusive.
+
+    Returns None if the header is missing or asks for more than one range, in
+    which case the whole file is sent. Raises ValueError if the range can't be
+    satisfied.
+    """
+    if not range_header:
+        return None
+    match = _RANGE_RE.match(range_header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        ### Suffix range, eg. the last 500 bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        start = max(size - length, 0)
+        end = size - 1
+    else:
+        start = int(start)
+        end = int(end) if end else size - 1
+        end = min(end, size - 1)
+
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return (start, end)
+
+
+###
+### Handler
+###
+
+class StaticFileHandler(WebMessageHandler):
+    """Serves files below `static_dir`. Subclass it and set `static_dir`.
+
+    Files up to `cache_max_file_size` bytes are kept in memory, up to
+    `cache_max_entries` of them, with the least recently used evicted first.
+    A file is stat'ed again once `stat_interval` seconds have passed, and a
+    changed mtime or size replaces the cached copy. Set `stat_interval` to 0
+    to stat on every request.
+    """
+    static_dir = None
+    cache_max_file_size = 64 * 1024
+    cache_max_entries = 512
+    stat_interval = 1.0
+    block_size = 64 * 1024
+    max_age = None
+
+    _PARTIAL_CODE = 206
+    _NOT_MODIFIED = 304
+    _RANGE_NOT_SATISFIABLE = 416
+
+    _response_codes = dict(WebMessageHandler._response_codes)
+    _response_codes.update({
+        206: 'Partial Content',
+        304: 'Not Modified',
+        416: 'Requested Range Not Satisfiable',
+    })
+
+    _file_cache = OrderedDict()
+    _stat_cache = dict()
+
+    ###
+    ### Request helpers
+    ###
+
+    def get_header(self, name):
+        """Returns the request header `name`. Mongrel2 sends lower case names
+        while WSGI puts them in the environ as `HTTP_<NAME>`.
+        """
+        keys = _header_keys.get(name)
+        if keys is None:
+            keys = (name.lower(), 'HTTP_' + name.upper().replace('-', '_'))
+            _header_keys[name] = keys
+        headers = self.message.headers
+        value = headers.get(keys[0])
+        if value is None:
+            value = headers.get(keys[1])
+        return value
+
+    def resolve_path(self, path):
+        """Maps the requested path to a file below `static_dir`. Returns None
+        if the path escapes `static_dir`.
+        """
+        if self.static_dir is None:
+            return None
+        root = _static_roots.get(self.static_dir)
+        if root is None:
+            root = os.path.abspath(self.static_dir) + os.sep
+            _static_roots[self.static_dir] = root
+        full_path = root + path.lstrip('/')
+        ### Only a `..` component can climb out of the root
+        if '..' in path:
+            full_path = os.path.normpath(full_path)
+            if not full_path.startswith(root):
+                return None
+        return full_path
+
+    def accepts_gzip(self):
+        accept_encoding = self.get_header('Accept-Encoding') or ''
+        return 'gzip' in accept_encoding
+
+    def is_not_modified(self, mtime, etag):
+        """Checks `If-None-Match` and `If-Modified-Since` against the file.
+        """
+        if_none_match = self.get_header('If-None-Match')
+        if if_none_match:
+            etags = [e.strip() for e in if_none_match.split(',')]
+            return etag in etags or '*' in etags
+
+        if_modified_since = self.get_header('If-Modified-Since')
+        if if_modified_since:
+            parsed = parsedate_tz(if_modified_since)
+            if parsed is not None:
+                return mtime <= mktime_tz(parsed)
+        return False
+
+    ###
+    ### In memory cache
+    ###
+
+    def stat_cached(self, path, cache_missing=False):
+        """Returns `stat_file(path)`, trusting an earlier answer for up to
+        `stat_interval` seconds. Missing files are only remembered when
+        `cache_missing` is set, so requests for made up paths can't grow the
+        cache.
+        """
+        if not self.stat_interval:
+            return stat_file(path)
+        now = time.time()
+        cached = self._stat_cache.get(path)
+        if cached is not None and now < cached[0]:
+            return cached[1]
+        st = stat_file(path)
+        if st is not None or cache_missing:
+            self._stat_cache[path] = (now + self.stat_interval, st)
+        return st
+
+    def file_headers(self, path, mtime, size):
+        """Returns the headers that describe a version of the file at `path`.
+        Cached files keep theirs in the LRU, so a hit doesn't rebuild them.
+        """
+        headers = {
+            'Content-Type': guess_content_type(path),
+            'Last-Modified': formatdate(mtime, usegmt=True),
+            'ETag': '"%x-%x"' % (mtime, size),
+            'Accept-Ranges': 'bytes',
+        }
+        if self.max_age is not None:
+            headers['Cache-Control'] = 'max-age=%d' % self.max_age
+        return headers
+
+    def get_cached(self, path, mtime, size):
+        """Returns the LRU entry for `path`, a tuple of `(mtime, size, data,
+        headers)`, marking it recently used. Returns None if it isn't cached
+        or has changed since it was cached.
+        """
+        cache = self._file_cache
+        entry = cache.pop(path, None)
+        if entry is None or entry[0] != mtime or entry[1] != size:
+            return None
+        cache[path] = entry
+        return entry
+
+    def load_cached(self, path, mtime, size, headers):
+        """Reads `path` into the LRU along with its `headers` and returns the
+        contents.
+        """
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        cache = self._file_cache
+        cache[path] = (mtime, size, data, headers)
+        if len(cache) > self.cache_max_entries:
+            cache.popitem(last=False)
+        return data
+
+    ###
+    ### HTTP methods
+    ###
+
+    def get(self, path=''):
+        full_path = self.resolve_path(path)
+        st = full_path and self.stat_cached(full_path)
+        if not st:
+            return self.render_error(self._NOT_FOUND)
+
+        range_header = self.get_header('Range')
+        served_path = full_path
+
+        ### Prefer a precompressed sibling. Ranges always use the original.
+        if self.accepts_gzip():
+            gz_path = full_path + '.gz'
+            gz_st = self.stat_cached(gz_path, cache_missing=True)
+            if gz_st is not None:
+                self.headers['Vary'] = 'Accept-Encoding'
+                if not range_header and gz_st.st_mtime >= st.st_mtime:
+                    served_path = gz_path
+                    st = gz_st
+                    self.headers['Content-Encoding'] = 'gzip'
+
+        mtime = int(st.st_mtime)
+        size = st.st_size
+        cacheable = size <= self.cache_max_file_size
+        entry = cacheable and self.get_cached(served_path, mtime, size)
+        if entry:
+            file_headers = entry[3]
+        else:
+            file_headers = self.file_headers(full_path, mtime, size)
+        self.headers.update(file_headers)
+
+        ### Answer conditional requests before touching the file's contents
+        if self.is_not_modified(mtime, file_headers['ETag']):
+            self.set_body('', status_code=self._NOT_MODIFIED)
+            return self.render()
+
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            self.headers['Content-Range'] = 'bytes */%d' % size
+            self.set_body('', status_code=self._RANGE_NOT_SATISFIABLE)
+            return self.render()
+
+        if byte_range is None:
+            (start, end) = (0, size - 1)
+            status_code = self._SUCCESS_CODE
+        else:
+            (start, end) = byte_range
+            status_code = self._PARTIAL_CODE
+            self.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                                                                size)
+        length = end - start + 1
+        self.headers['Content-Length'] = str(length)
+
+        if self.message.method == 'HEAD':
+            body = ''
+        elif cacheable:
+            if entry:
+                body = entry[2]
+            else:
+                body = self.load_cached(served_path, mtime, size,
+                                        file_headers)
+            if byte_range is not None:
+                body = body[start:end + 1]
+        else:
+            f = open(served_path, 'rb')
+            if byte_range is None and getattr(self.message, 'is_wsgi', False):
+                ### The WSGI connection may hand this to `wsgi.file_wrapper`
+                body = f
+            else:
+                f.seek(start)
+                body = file_blocks(f, length, self.block_size)
+
+        self.set_body(body, status_code=status_code)
+        return self.render()
+
+    def head(self, path=''):
+        return self.get(path)
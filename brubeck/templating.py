@@ -1,4 +1,76 @@
-from request_handling import WebMessageHandler
+import os
+import time
+import logging
+
+from request_handling import WebMessageHandler, coalesce_chunks, coro_queue
+
+
+###
+### Template warmup
+###
+
+def list_templates(template_dir, extension=None):
+    """Walks `template_dir` and returns the path of every file found, relative
+    to `template_dir`. If `extension` is given, only files ending with it are
+    returned.
+    """
+    template_names = list()
+    for dirpath, dirnames, filenames in os.walk(template_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            if extension is not None and not filename.endswith(extension):
+                continue
+            full_path = os.path.join(dirpath, filename)
+            name = os.path.relpath(full_path, template_dir)
+            template_names.append(name.replace(os.sep, '/'))
+    return sorted(template_names)
+
+
+def precompile_templates(compile_fun, template_names):
+    """Calls `compile_fun` with each name in `template_names` so every template
+    is compiled before the first request asks for it.
+
+    Compile time is logged per template and returned as a dict mapping
+    template name => seconds. Templates that fail to compile are logged and
+    left out of the dict.
+    """
+    compile_times = dict()
+    for name in template_names:
+        start = time.time()
+        try:
+            compile_fun(name)
+        except Exception, e:
+            logging.error('Failed to precompile template %s: %s' % (name, e))
+            continue
+        compile_times[name] = time.time() - start
+        logging.info('Precompiled template %s (%.2fms)' %
+                     (name, compile_times[name] * 1000))
+    return compile_times
+
+
+###
+### Fragment caching
+###
+
+class FragmentCachingMixin(object):
+    """Adds `render_fragment` to a rendering handler. Fragments are rendered
+    with the application's template environment and cached in
+    `application.fragment_cache`, which reports hit rates and render times
+    per key.
+    """
+    def render_fragment(self, key, template_file, _ttl=None, **context):
+        """Renders `template_file` with `context` unless a fragment stored as
+        `key` is already cached. The result is cached for `_ttl` seconds.
+
+        The rendered fragment is returned, ready to be passed into the context
+        of a full page.
+        """
+        render_fun = lambda: self.application.render_template(template_file,
+                                                              **context)
+        return self.application.fragment_cache.get_or_render(key, render_fun,
+                                                             ttl=_ttl)
 
 
 ###
@@ -7,18 +79,81 @@ from request_handling import WebMessageHandler
 
 def load_mako_env(template_dir, *args, **kwargs):
     """Returns a function which loads a Mako templates environment.
+
+    `module_directory` is handed to Mako, which then writes compiled template
+    modules to disk and reuses them across restarts.
+
+    If `precompile=True` every template under `template_dir` is compiled when
+    the environment loads. Compile times are available as `compile_times` on
+    the returned lookup.
     """
+    precompile = kwargs.pop('precompile', False)
+
     def loader():
         from mako.lookup import TemplateLookup
         if template_dir is not None:
-            return TemplateLookup(directories=[template_dir or '.'],
-                                  *args, **kwargs)
+            lookup = TemplateLookup(directories=[template_dir or '.'],
+                                    *args, **kwargs)
+            if precompile:
+                compile_fun = lambda name: lookup.get_template('/' + name)
+                lookup.compile_times = precompile_templates(
+                    compile_fun, list_templates(template_dir))
+            return lookup
         else:
             return None
     return loader
 
 
-class MakoRendering(WebMessageHandler):
+class _MakoQueueWriter(object):
+    """Stands in for the output buffer of a Mako context. Every write is put
+    on a queue instead of being collected in memory.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        if data:
+            self.queue.put(data)
+
+
+def generate_mako(template, context, pool):
+    """Returns a generator that yields the output of a Mako template while it
+    renders. Mako can only write to a buffer, so rendering happens in a
+    coroutine from `pool` that hands each write over through a queue. The
+    queue holds one write at a time, so rendering never runs far ahead of the
+    consumer.
+    """
+    from mako.runtime import Context
+
+    end_of_template = object()
+
+    def chunks():
+        queue = coro_queue(maxsize=1)
+
+        def producer():
+            try:
+                mako_context = Context(_MakoQueueWriter(queue), **context)
+                template.render_context(mako_context)
+            except Exception, e:
+                queue.put(e)
+            queue.put(end_of_template)
+
+        coro = pool.spawn(producer)
+        try:
+            while True:
+                chunk = queue.get()
+                if chunk is end_of_template:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            coro.kill()
+
+    return chunks()
+
+
+class MakoRendering(WebMessageHandler, FragmentCachingMixin):
     def render_template(self, template_file,
                         _status_code=WebMessageHandler._SUCCESS_CODE,
                         **context):
@@ -26,6 +161,22 @@ class MakoRendering(WebMessageHandler):
         self.set_body(body, status_code=_status_code)
         return self.render()
 
+    def stream_template(self, template_file,
+                        _status_code=WebMessageHandler._SUCCESS_CODE,
+                        _chunk_size=0, **context):
+        """Renders payload as a mako template, sending the page out in chunks
+        as it renders. Chunks are at least `_chunk_size` bytes, except the
+        last one.
+
+        The status code is sent before rendering starts, so errors raised
+        while rendering end the response early instead of producing a 500.
+        """
+        template = self.application.template_env.get_template(template_file)
+        chunks = generate_mako(template, context, self.application.pool)
+        body = coalesce_chunks(chunks, _chunk_size)
+        self.set_body(body, status_code=_status_code)
+        return self.render()
+
     def render_error(self, error_code):
         return self.render_template('errors.html', _status_code=error_code,
                                     **{'error_code': error_code})
@@ -39,18 +190,38 @@ def load_jinja2_env(template_dir, *args, **kwargs):
     """Returns a function that loads a jinja template environment. Uses a
     closure to provide a namespace around module loading without loading
     anything until the caller is ready.
+
+    `bytecode_cache_dir` turns on Jinja2's `FileSystemBytecodeCache`, so
+    compiled templates are stored on disk and shared across restarts.
+
+    If `precompile=True` every template under `template_dir` is compiled when
+    the environment loads. Compile times are available as `compile_times` on
+    the returned environment.
     """
+    precompile = kwargs.pop('precompile', False)
+    bytecode_cache_dir = kwargs.pop('bytecode_cache_dir', None)
+
     def loader():
         from jinja2 import Environment, FileSystemLoader
         if template_dir is not None:
-            return Environment(loader=FileSystemLoader(template_dir or '.'),
-                               *args, **kwargs)
+            if bytecode_cache_dir is not None:
+                from jinja2 import FileSystemBytecodeCache
+                if not os.path.isdir(bytecode_cache_dir):
+                    os.makedirs(bytecode_cache_dir)
+                bcc = FileSystemBytecodeCache(bytecode_cache_dir)
+                kwargs['bytecode_cache'] = bcc
+            env = Environment(loader=FileSystemLoader(template_dir or '.'),
+                              *args, **kwargs)
+            if precompile:
+                env.compile_times = precompile_templates(
+                    env.get_template, list_templates(template_dir))
+            return env
         else:
             return None
     return loader
 
 
-class Jinja2Rendering(WebMessageHandler):
+class Jinja2Rendering(WebMessageHandler, FragmentCachingMixin):
     """Jinja2Rendering is a mixin for for loading a Jinja2 rendering
     environment.
 
@@ -66,6 +237,21 @@ class Jinja2Rendering(WebMessageHandler):
         self.set_body(body, status_code=_status_code)
         return self.render()
 
+    def stream_template(self, template_file,
+                        _status_code=WebMessageHandler._SUCCESS_CODE,
+                        _chunk_size=0, **context):
+        """Renders payload as a jinja template, sending the page out in chunks
+        as `Template.generate()` produces them. Chunks are at least
+        `_chunk_size` bytes, except the last one.
+
+        The status code is sent before rendering starts, so errors raised
+        while rendering end the response early instead of producing a 500.
+        """
+        template = self.application.template_env.get_template(template_file)
+        body = coalesce_chunks(template.generate(**context), _chunk_size)
+        self.set_body(body, status_code=_status_code)
+        return self.render()
+
     def render_error(self, error_code):
         """Receives error calls and sends them through a templated renderer
         call.
@@ -80,17 +266,26 @@ class Jinja2Rendering(WebMessageHandler):
 
 def load_tornado_env(template_dir, *args, **kwargs):
     """Returns a function that loads the Tornado template environment.
+
+    If `precompile=True` every template under `template_dir` is compiled when
+    the environment loads. Tornado keeps compiled templates in memory only.
     """
+    precompile = kwargs.pop('precompile', False)
+
     def loader():
         from tornado.template import Loader
         if template_dir is not None:
-            return Loader(template_dir or '.', *args, **kwargs)
+            t_loader = Loader(template_dir or '.', *args, **kwargs)
+            if precompile:
+                t_loader.compile_times = precompile_templates(
+                    t_loader.load, list_templates(template_dir))
+            return t_loader
         else:
             return None
     return loader
 
 
-class TornadoRendering(WebMessageHandler):
+class TornadoRendering(WebMessageHandler, FragmentCachingMixin):
     """TornadoRendering is a mixin for for loading a Tornado rendering
     environment.
 
@@ -125,11 +320,33 @@ def load_mustache_env(template_dir, *args, **kwargs):
     Returns a function that loads a mustache template environment. Uses a
     closure to provide a namespace around module loading without loading
     anything until the caller is ready.
+
+    Pystache has no compiled form to keep, so `precompile=True` reads every
+    `.mustache` file under `template_dir` up front and serves them from memory
+    afterwards.
     """
+    precompile = kwargs.pop('precompile', False)
+
     def loader():
         import pystache
 
-        return pystache.Renderer(search_dirs=[template_dir])
+        renderer = pystache.Renderer(search_dirs=[template_dir])
+        if precompile:
+            loaded = dict()
+            load_template = renderer.load_template
+
+            def cached_load_template(name):
+                if name not in loaded:
+                    loaded[name] = load_template(name)
+                return loaded[name]
+
+            extension = '.mustache'
+            names = [n[:-len(extension)]
+                     for n in list_templates(template_dir, extension)]
+            renderer.compile_times = precompile_templates(cached_load_template,
+                                                          names)
+            renderer.load_template = cached_load_template
+        return renderer
 
     return loader
 
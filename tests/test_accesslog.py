@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import unittest
+import gc
+import weakref
+
+import mock
+
+from brubeck.request_handling import Brubeck
+from brubeck.connections import Request, WSGIConnection
+from brubeck.accesslog import AccessLog, _flush_at_exit, _live_access_logs
+from handlers.object_handlers import SimpleWebHandlerObject
+from fixtures import request_handler_fixtures as FIXTURES
+
+
+###
+### Tests for buffered access logging
+###
+class TestAccessLog(unittest.TestCase):
+    """
+    a test class for brubeck's access log.
+    """
+
+    def setUp(self):
+        self.batches = list()
+        self.access_log = AccessLog(sink=self.batches.append, batch_size=2)
+        self.app = Brubeck(msg_conn=WSGIConnection(),
+                           access_log=self.access_log)
+        self.app.add_route_rule(r'^/$', SimpleWebHandlerObject)
+
+    def handle_request(self):
+        message = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        return self.app.route_message(message)()
+
+    def test_records_are_flushed_in_batches(self):
+        for i in range(3):
+            self.handle_request()
+        self.assertEqual([], self.batches)
+
+        self.access_log.flush()
+        self.assertEqual([2, 1], [len(batch) for batch in self.batches])
+        entry = self.batches[0][0]
+        self.assertEqual(200, entry['status_code'])
+        self.assertEqual('GET', entry['method'])
+        self.assertEqual('/', entry['path'])
+        self.assertTrue(entry['duration'] >= 0)
+
+    def test_sampling_keeps_errors(self):
+        self.access_log.sample_rate = 0.0
+        self.handle_request()
+        handler = self.app.base_handler(self.app,
+                                        Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
+        handler.render_error(404)
+        self.access_log.flush()
+        self.assertEqual([404], [e['status_code'] for e in self.batches[0]])
+
+    def test_full_buffer_drops_oldest(self):
+        access_log = AccessLog(sink=self.batches.append, buffer_size=2)
+        self.app.access_log = access_log
+        for i in range(3):
+            self.handle_request()
+        self.assertEqual(1, access_log.dropped)
+
+    def test_flushed_when_run_returns(self):
+        self.handle_request()
+        self.app.msg_conn = mock.Mock()
+        self.app.run()
+        self.assertEqual([1], [len(batch) for batch in self.batches])
+
+    def test_flushed_at_exit(self):
+        self.handle_request()
+        _flush_at_exit()
+        self.assertEqual([1], [len(batch) for batch in self.batches])
+
+    def test_exit_hook_doesnt_keep_logs_alive(self):
+        access_log = AccessLog()
+        self.assertTrue(access_log in _live_access_logs)
+        access_log = weakref.ref(access_log)
+        gc.collect()
+        self.assertEqual(None, access_log())
+
+    def test_access_log_off(self):
+        app = Brubeck(msg_conn=WSGIConnection(), access_log=False)
+        app.add_route_rule(r'^/$', SimpleWebHandlerObject)
+        result = app.route_message(Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))()
+        self.assertEqual(200, result['status_code'])
+        self.assertEqual(None, app.access_log)
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,762 @@
+#!/usr/bin/env python
+
+import unittest
+import time
+import os
+import shutil
+import tempfile
+import mock
+import ujson as json
+
+from brubeck.caching import (BaseCacheStore, LRUCacheStore, FragmentCache,
+                             ExpirySweeper, RedisCacheStore, TieredCacheStore,
+                             RedisInvalidator, Memoizer, memoize,
+                             LatencyHistogram, InstrumentedCacheStore,
+                             instrumented_stores,
+                             SQLiteCacheStore, SharedMemoryCacheStore)
+from brubeck.cachestats import CacheStatsHandler
+from brubeck.connections import Request
+from fixtures import request_handler_fixtures as FIXTURES
+from brubeck.request_handling import Brubeck, coro_pool, coro_sleep
+from brubeck.connections import WSGIConnection
+
+
+###
+### Tests for cache stores
+###
+class TestLRUCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's bounded in-memory cache store.
+    """
+
+    def test_save_and_load(self):
+        store = LRUCacheStore()
+        store.save('key', 'value')
+        self.assertEqual('value', store.load('key'))
+        store.delete('key')
+        self.assertEqual(None, store.load('key'))
+        self.assertEqual(0, store.size_bytes)
+
+    def test_evicts_least_recently_used(self):
+        store = LRUCacheStore(max_entries=2)
+        store.save('a', 1)
+        store.save('b', 2)
+        store.load('a')
+        store.save('c', 3)
+        self.assertEqual(None, store.load('b'))
+        self.assertEqual(1, store.load('a'))
+        self.assertEqual(3, store.load('c'))
+        self.assertEqual(1, store.evictions)
+
+    def test_byte_budget(self):
+        store = LRUCacheStore(max_bytes=25)
+        store.save('a', 'x' * 10)
+        store.save('b', 'x' * 10)
+        store.save('c', 'x' * 10)
+        self.assertEqual(2, len(store))
+        self.assertEqual(22, store.size_bytes)
+        self.assertEqual(None, store.load('a'))
+
+    def test_oversized_values_are_rejected(self):
+        store = LRUCacheStore(max_bytes=1000)
+        for i in range(50):
+            store.save('key%d' % i, 'x')
+        store.save('big', 'x' * 5000)
+        self.assertEqual(50, len(store))
+        self.assertEqual(0, store.evictions)
+        self.assertEqual(1, store.rejected)
+        self.assertEqual(None, store.load('big'))
+
+        store.save('key0', 'x' * 5000)
+        self.assertEqual(None, store.load('key0'))
+        self.assertEqual(2, store.stats()['rejected'])
+
+    def test_expired_entries_are_not_loaded(self):
+        store = LRUCacheStore()
+        store.save('key', 'value', expire=time.time() - 1)
+        self.assertEqual(None, store.load('key'))
+        self.assertEqual(1, store.expirations)
+
+    def test_delete_expired_incrementally(self):
+        store = LRUCacheStore()
+        now = time.time()
+        for i in range(5):
+            store.save('old%d' % i, i, expire=now - 10 + i)
+        store.save('fresh', 'value', expire=now + 60)
+        store.save('forever', 'value')
+
+        self.assertEqual(2, store.delete_expired(max_items=2))
+        self.assertEqual(3, store.delete_expired())
+        self.assertEqual(2, len(store))
+        self.assertEqual(5, store.expirations)
+
+    def test_resaved_keys_are_not_expired_early(self):
+        store = LRUCacheStore()
+        store.save('key', 'old', expire=time.time() - 1)
+        store.save('key', 'new', expire=time.time() + 60)
+        self.assertEqual(0, store.delete_expired())
+        self.assertEqual('new', store.load('key'))
+
+
+class TestBaseCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's in-memory cache store.
+    """
+
+    def test_delete_expired_incrementally(self):
+        store = BaseCacheStore()
+        now = time.time()
+        for i in range(5):
+            store.save('old%d' % i, i, expire=now - 10 + i)
+        store.save('fresh', 'value', expire=now + 60)
+        store.save('forever', 'value')
+        store.delete('old0')
+
+        self.assertEqual(1, store.delete_expired(max_items=2))
+        self.assertEqual(3, store.delete_expired())
+        self.assertEqual(['forever', 'fresh'], sorted(store._cache_store))
+
+    def test_touch_keeps_heap_bounded(self):
+        for store in (BaseCacheStore(), LRUCacheStore()):
+            now = time.time()
+            store.save('key', 'value', expire=now + 60)
+            for i in range(1000):
+                store.touch('key', expire=now + 60 + i)
+            self.assertTrue(len(store._expire_heap) <= 2 * 1 + 64)
+            self.assertEqual('value', store.load('key'))
+
+    def test_bulk_operations(self):
+        for store in (BaseCacheStore(), LRUCacheStore()):
+            store.save_many({'a': 1, 'b': 2})
+            store.save('old', 3, expire=time.time() - 1)
+            self.assertEqual([1, None, 2, None],
+                             store.load_many(['a', 'missing', 'b', 'old']))
+            store.delete_many(['a', 'missing'])
+            self.assertEqual([None, 2], store.load_many(['a', 'b']))
+
+
+class TestSQLiteCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's disk-backed cache store.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_and_load(self):
+        store = SQLiteCacheStore(self.path)
+        store.save('bytes', '\xff\x00')
+        store.save('text', u'caf\xe9')
+        self.assertEqual('\xff\x00', store.load('bytes'))
+        self.assertEqual(u'caf\xe9', store.load('text'))
+        store.delete('bytes')
+        self.assertEqual([None, u'caf\xe9'], store.load_many(['bytes', 'text']))
+
+    def test_survives_restarts(self):
+        store = SQLiteCacheStore(self.path)
+        store.save_many({'a': '1', 'b': '22'})
+        store.close()
+        store = SQLiteCacheStore(self.path)
+        self.assertEqual(['1', '22'], store.load_many(['a', 'b']))
+        self.assertEqual(3, store.size_bytes)
+
+    def test_evicts_least_recently_used(self):
+        store = SQLiteCacheStore(self.path, max_bytes=30, evict_ratio=1.0,
+                                 access_batch_size=1)
+        store.save('a', 'x' * 10)
+        time.sleep(0.01)
+        store.save('b', 'x' * 10)
+        time.sleep(0.01)
+        store.save('c', 'x' * 10)
+        time.sleep(0.01)
+        store.load('a')
+        store.save('d', 'x' * 10)
+        self.assertEqual(['x' * 10, None, 'x' * 10, 'x' * 10],
+                         store.load_many(['a', 'b', 'c', 'd']))
+        self.assertEqual(1, store.evictions)
+        self.assertEqual(30, store.size_bytes)
+
+    def test_unicode_is_sized_as_utf8(self):
+        store = SQLiteCacheStore(self.path)
+        store.save('text', u'\xe9' * 10)
+        self.assertEqual(20, store.size_bytes)
+
+    def test_eviction_shrinks_the_file(self):
+        store = SQLiteCacheStore(self.path, max_bytes=1024 * 1024,
+                                 evict_ratio=0.1)
+        for i in xrange(200):
+            store.save('key%d' % i, 'x' * 4096)
+        peak = store.disk_footprint()
+        store.save_many(dict(('big%d' % i, 'x' * 4096) for i in xrange(100)))
+        self.assertTrue(store.evictions > 0)
+        self.assertEqual(2, store._conn.execute(
+            'PRAGMA auto_vacuum').fetchone()[0])
+        self.assertEqual(0, store._conn.execute(
+            'PRAGMA freelist_count').fetchone()[0])
+        store._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.assertTrue(store.disk_footprint() < peak)
+
+    def test_expiration(self):
+        store = SQLiteCacheStore(self.path)
+        now = time.time()
+        for i in range(5):
+            store.save('old%d' % i, 'x', expire=now - 1)
+        store.save('fresh', 'x', expire=now + 60)
+        store.touch('old4', expire=now + 60)
+        self.assertEqual(None, store.load('old0'))
+        self.assertEqual(2, store.delete_expired(max_items=2))
+        self.assertEqual(1, store.delete_expired())
+        self.assertEqual(2, store.stats()['entries'])
+
+
+class TestSharedMemoryCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's shared memory cache store.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache.shm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_and_load(self):
+        store = SharedMemoryCacheStore(self.path, slot_count=64)
+        store.save('bytes', '\xff\x00')
+        store.save(u'text', u'caf\xe9')
+        store.save('bytes', 'new')
+        self.assertEqual('new', store.load('bytes'))
+        self.assertEqual(u'caf\xe9', store.load('text'))
+        store.delete('bytes')
+        self.assertEqual(None, store.load('bytes'))
+        self.assertEqual(1, store.stats()['entries'])
+
+    def test_shared_between_processes(self):
+        store = SharedMemoryCacheStore(self.path, slot_count=64)
+        pid = os.fork()
+        if pid == 0:
+            child = SharedMemoryCacheStore(self.path, slot_count=64)
+            child.save('from_child', 'hello')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual('hello', store.load('from_child'))
+
+    def test_bounded(self):
+        store = SharedMemoryCacheStore(self.path, slot_count=4, slot_size=64,
+                                       max_probes=4)
+        for i in range(10):
+            store.save('key%d' % i, 'value')
+        self.assertEqual(4, store.stats()['entries'])
+        self.assertEqual(6, store.evictions)
+        self.assertEqual('value', store.load('key9'))
+
+        store.save('big', 'x' * 64)
+        self.assertEqual(None, store.load('big'))
+        self.assertEqual(1, store.rejected)
+
+    def test_expiration(self):
+        store = SharedMemoryCacheStore(self.path, slot_count=64)
+        store.save('old', 'x', expire=time.time() - 1)
+        store.save('older', 'x', expire=time.time() - 1)
+        store.save('fresh', 'x', expire=time.time() + 60)
+        store.touch('older', expire=time.time() + 60)
+        self.assertEqual(1, store.delete_expired())
+        self.assertEqual(['x', 'x'], store.load_many(['older', 'fresh']))
+
+    def test_mismatched_layout(self):
+        SharedMemoryCacheStore(self.path, slot_count=64)
+        self.assertRaises(ValueError, SharedMemoryCacheStore, self.path,
+                          slot_count=128)
+
+
+class TestRedisCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's Redis cache store, against a mock connection.
+    """
+
+    def setUp(self):
+        self.redis_connection = mock.Mock()
+        self.store = RedisCacheStore(self.redis_connection)
+
+    def test_load_many_uses_mget(self):
+        self.redis_connection.mget.return_value = ['1', None]
+        self.assertEqual(['1', None], self.store.load_many(['a', 'b']))
+        self.redis_connection.mget.assert_called_once_with(['a', 'b'])
+
+    def test_save_many_uses_one_pipeline(self):
+        pipe = self.redis_connection.pipeline.return_value
+        self.store.save_many({'a': '1', 'b': '2'}, expire=time.time() + 60)
+        self.assertEqual(1, self.redis_connection.pipeline.call_count)
+        self.assertEqual(2, pipe.set.call_count)
+        self.assertEqual(2, pipe.expire.call_count)
+        pipe.execute.assert_called_once_with()
+
+    def test_delete_many(self):
+        self.store.delete_many(['a', 'b'])
+        self.redis_connection.delete.assert_called_once_with('a', 'b')
+
+
+class FakeInvalidator(object):
+    """Delivers invalidations to every store on the same fake bus.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+
+    def publish(self, message):
+        for callback in self.bus:
+            callback(message)
+
+    def listen(self, callback):
+        self.bus.append(callback)
+
+
+class TestTieredCacheStore(unittest.TestCase):
+    """
+    a test class for brubeck's two-tier cache store.
+    """
+
+    def setUp(self):
+        self.l2_store = BaseCacheStore()
+        bus = list()
+        self.stores = list()
+        for i in range(2):
+            invalidator = FakeInvalidator(bus)
+            store = TieredCacheStore(self.l2_store, invalidator=invalidator)
+            invalidator.listen(store.handle_invalidation)
+            self.stores.append(store)
+
+    def test_loads_are_kept_in_l1(self):
+        (first, second) = self.stores
+        first.save('key', 'value')
+        self.assertEqual('value', second.load('key'))
+        self.l2_store.delete('key')
+        self.assertEqual('value', second.load('key'))
+        self.assertEqual(1, second.l1_hits)
+        self.assertEqual(1, second.l2_hits)
+
+    def test_l1_ttl(self):
+        (first, second) = self.stores
+        second.l1_ttl = -1
+        first.save('key', 'value')
+        second.load('key')
+        self.l2_store.save('key', 'changed')
+        self.assertEqual('changed', second.load('key'))
+
+    def test_writes_invalidate_other_processes(self):
+        (first, second) = self.stores
+        first.save('key', 'old')
+        self.assertEqual('old', second.load('key'))
+        first.save('key', 'new')
+        self.assertEqual('new', second.load('key'))
+        self.assertEqual('new', first.load('key'))
+        self.assertEqual(1, first.l1_hits)
+
+        first.delete('key')
+        self.assertEqual(None, second.load('key'))
+        self.assertEqual(1, second.misses)
+
+    def test_bulk_operations(self):
+        (first, second) = self.stores
+        first.save_many({'a': 1, 'b': 2})
+        self.assertEqual([1, 2], second.load_many(['a', 'b']))
+        self.assertEqual([1, 2, None], second.load_many(['a', 'b', 'c']))
+        self.assertEqual(2, second.l1_hits)
+        self.assertEqual(2, second.l2_hits)
+
+        first.delete_many(['a', 'b'])
+        self.assertEqual([None, None], second.load_many(['a', 'b']))
+
+    def test_redis_invalidator(self):
+        redis_connection = mock.Mock()
+        pubsub = redis_connection.pubsub.return_value
+        pubsub.listen.return_value = [
+            {'type': 'subscribe', 'data': 1},
+            {'type': 'message', 'data': 'origin key'},
+        ]
+        invalidator = RedisInvalidator(redis_connection, channel='chan')
+        invalidator.publish('origin key')
+        redis_connection.publish.assert_called_once_with('chan', 'origin key')
+
+        messages = list()
+        invalidator.listen(messages.append)
+        pubsub.subscribe.assert_called_once_with('chan')
+        self.assertEqual(['origin key'], messages)
+
+
+###
+### Tests for instrumentation
+###
+class TestInstrumentation(unittest.TestCase):
+    """
+    a test class for cache stats.
+    """
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for seconds in [0.000001] * 98 + [0.001, 30]:
+            histogram.record(seconds)
+        stats = histogram.to_dict()
+        self.assertEqual(100, stats['count'])
+        self.assertEqual(30, stats['max'])
+        self.assertEqual(0.000002, stats['p50'])
+        self.assertEqual(0.001024, stats['p99'])
+
+    def test_store_stats(self):
+        store = LRUCacheStore(max_entries=1)
+        store.save('a', 'x' * 1000)
+        store.save('b', 'x' * 1000)
+        stats = store.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertTrue(stats['memory_bytes'] > 1000)
+        self.assertEqual(0, BaseCacheStore().stats()['entries'])
+
+    def test_instrumented_store(self):
+        store = InstrumentedCacheStore(LRUCacheStore(), name='sessions')
+        store.save('a', 1)
+        store.load('a')
+        store.load_many(['a', 'b'])
+        stats = store.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual('LRUCacheStore', stats['store'])
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(['load', 'load_many', 'save'],
+                         sorted(stats['latency']))
+        store.close()
+
+    def test_instrumented_names_are_unique(self):
+        lru_store = LRUCacheStore()
+        store = InstrumentedCacheStore(lru_store, name='memo')
+        self.assertRaises(ValueError, InstrumentedCacheStore,
+                          LRUCacheStore(), name='memo')
+        again = InstrumentedCacheStore(lru_store, name='memo')
+        self.assertTrue(instrumented_stores()['memo'] is again)
+        again.close()
+        self.assertFalse('memo' in instrumented_stores())
+        InstrumentedCacheStore(LRUCacheStore(), name='memo').close()
+
+    def test_stats_handler(self):
+        store = InstrumentedCacheStore(LRUCacheStore(), name='fragments')
+        app = Brubeck(msg_conn=WSGIConnection(), cache_store=store)
+        app.fragment_cache.get_or_render('nav', lambda: '<nav/>')
+        handler = CacheStatsHandler(app,
+                                    Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
+        body = json.loads(handler.get()['body'])
+        self.assertEqual(1, body['cache_stores']['fragments']['misses'])
+        self.assertEqual(1, body['fragments']['nav']['misses'])
+        store.close()
+
+
+###
+### Tests for expiry sweeping
+###
+class TestExpirySweeper(unittest.TestCase):
+    """
+    a test class for brubeck's background expiry sweeper.
+    """
+
+    def fill(self, store, count):
+        expire = time.time() - 1
+        for i in xrange(count):
+            store.save('key%d' % i, i, expire=expire)
+        store.save('fresh', 'value', expire=time.time() + 60)
+
+    def test_sweep_purges_everything_expired(self):
+        stores = [BaseCacheStore(), LRUCacheStore()]
+        for store in stores:
+            self.fill(store, 250)
+        sweeper = ExpirySweeper(stores, batch_size=10)
+        self.assertEqual(500, sweeper.sweep())
+        self.assertEqual(500, sweeper.purged)
+        self.assertEqual(['fresh'], stores[0]._cache_store.keys())
+        self.assertEqual(1, len(stores[1]))
+
+    def test_stale_heap_entries_dont_end_the_pass(self):
+        stores = [BaseCacheStore(), LRUCacheStore()]
+        for store in stores:
+            self.fill(store, 1000)
+            for i in xrange(0, 1000, 2):
+                store.touch('key%d' % i, expire=time.time() - 2)
+        sweeper = ExpirySweeper(stores, batch_size=100)
+        self.assertEqual(2000, sweeper.sweep())
+        self.assertEqual(['fresh'], stores[0]._cache_store.keys())
+        self.assertEqual(1, len(stores[1]))
+
+    def test_shared_memory_segment_is_swept_whole(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store = SharedMemoryCacheStore(os.path.join(tmp_dir, 'cache'),
+                                           slot_count=1024)
+            expire = time.time() - 1
+            for i in xrange(300):
+                store.save('key%d' % i, 'value', expire=expire)
+            store.save('fresh', 'value', expire=time.time() + 60)
+            sweeper = ExpirySweeper(store, batch_size=100)
+            self.assertEqual(300, sweeper.sweep())
+            self.assertEqual(1, store.stats()['entries'])
+            self.assertEqual(0, sweeper.sweep())
+            store.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_max_rate_limits_each_pass(self):
+        store = LRUCacheStore()
+        self.fill(store, 250)
+        sweeper = ExpirySweeper(store, interval=0.5, batch_size=30,
+                                max_rate=200)
+        self.assertEqual(100, sweeper.sweep())
+        self.assertEqual(100, sweeper.sweep())
+        self.assertEqual(50, sweeper.sweep())
+
+    def test_unsweepable_stores_are_dropped(self):
+        sweeper = ExpirySweeper(RedisCacheStore())
+        self.assertEqual(0, sweeper.sweep())
+        self.assertEqual([], sweeper.cache_stores)
+
+    def test_brubeck_creates_sweeper(self):
+        store = LRUCacheStore()
+        app = Brubeck(msg_conn=WSGIConnection(), cache_store=store,
+                      cache_sweeper=True)
+        self.assertEqual([store], app.cache_sweeper.cache_stores)
+        app = Brubeck(msg_conn=WSGIConnection())
+        self.assertEqual(None, app.cache_sweeper)
+
+
+###
+### Tests for memoization
+###
+class StringCacheStore(BaseCacheStore):
+    stores_objects = False
+
+
+class TestMemoizer(unittest.TestCase):
+    """
+    a test class for brubeck's single-flight memoization.
+    """
+
+    def setUp(self):
+        self.calls = 0
+
+    def slow_read(self, item_id):
+        self.calls += 1
+        coro_sleep(0.01)
+        return {'id': item_id, 'calls': self.calls}
+
+    def test_memoize_decorator(self):
+        @memoize(ttl=60)
+        def double(x):
+            self.calls += 1
+            return x * 2
+
+        self.assertEqual(4, double(2))
+        self.assertEqual(4, double(2))
+        self.assertEqual(6, double(3))
+        self.assertEqual(2, self.calls)
+        double.invalidate(2)
+        double(2)
+        self.assertEqual(3, self.calls)
+
+    def test_methods_are_keyed_without_self(self):
+        memoizer = Memoizer()
+
+        class Queryset(object):
+            @memoizer.memoize()
+            def read(qs, item_id):
+                self.calls += 1
+                return item_id
+
+        Queryset().read(1)
+        Queryset().read(1)
+        self.assertEqual(1, self.calls)
+
+    def test_concurrent_misses_compute_once(self):
+        memoizer = Memoizer(early_refresh=0)
+        pool = coro_pool()
+        results = list()
+        for i in range(10):
+            pool.spawn(lambda: results.append(
+                memoizer.get('item:1', self.slow_read, (1,))))
+        pool.join()
+        self.assertEqual(1, self.calls)
+        self.assertEqual(10, len(results))
+        self.assertEqual(9, memoizer.waits)
+
+    def test_errors_reach_every_waiter(self):
+        memoizer = Memoizer()
+        pool = coro_pool()
+        errors = list()
+
+        def fail():
+            coro_sleep(0.01)
+            raise ValueError('nope')
+
+        def call():
+            try:
+                memoizer.get('key', fail)
+            except ValueError, e:
+                errors.append(e)
+
+        for i in range(3):
+            pool.spawn(call)
+        pool.join()
+        self.assertEqual(3, len(errors))
+        self.assertEqual({}, memoizer._in_flight)
+
+    def test_interrupted_computation_releases_waiters(self):
+        memoizer = Memoizer(early_refresh=0)
+        pool = coro_pool()
+        errors = list()
+
+        def call():
+            try:
+                memoizer.get('item:1', self.slow_read, (1,))
+            except RuntimeError, e:
+                errors.append(e)
+
+        leader = pool.spawn(call)
+        pool.spawn(call)
+        coro_sleep(0)
+        leader.kill()
+        pool.join()
+        self.assertEqual(1, len(errors))
+        self.assertEqual({}, memoizer._in_flight)
+        self.assertEqual(1, memoizer.get('item:1', self.slow_read, (1,))['id'])
+
+    def test_interrupted_get_many_releases_waiters(self):
+        memoizer = Memoizer(early_refresh=0)
+        pool = coro_pool()
+        errors = list()
+
+        def read_many(keys):
+            return [self.slow_read(key) for key in keys]
+
+        def call():
+            try:
+                memoizer.get_many(['1', '2'], read_many)
+            except RuntimeError, e:
+                errors.append(e)
+
+        leader = pool.spawn(call)
+        pool.spawn(call)
+        coro_sleep(0)
+        leader.kill()
+        pool.join()
+        self.assertEqual(1, len(errors))
+        self.assertEqual({}, memoizer._in_flight)
+
+    def test_stale_while_revalidate(self):
+        memoizer = Memoizer(ttl=60, stale_ttl=60, early_refresh=0,
+                            pool=coro_pool())
+        memoizer.get('item:1', self.slow_read, (1,))
+        item = memoizer.cache_store._cache_store['memo:item:1']
+        (value, fresh_until, delta) = item['data']
+        item['data'] = (value, time.time() - 1, delta)
+
+        stale = memoizer.get('item:1', self.slow_read, (1,))
+        self.assertEqual(1, stale['calls'])
+        self.assertEqual(1, memoizer.stale_hits)
+        memoizer.pool.join()
+        fresh = memoizer.get('item:1', self.slow_read, (1,))
+        self.assertEqual(2, fresh['calls'])
+
+    def test_early_refresh(self):
+        memoizer = Memoizer(ttl=60, early_refresh=1e9)
+        memoizer.get('item:1', self.slow_read, (1,))
+        refreshed = memoizer.get('item:1', self.slow_read, (1,))
+        self.assertEqual(2, refreshed['calls'])
+        self.assertEqual(1, memoizer.early_refreshes)
+
+    def test_get_many_computes_missing_keys_together(self):
+        memoizer = Memoizer(StringCacheStore())
+        batches = list()
+
+        def read_many(keys):
+            batches.append(keys)
+            return [key.upper() for key in keys]
+
+        memoizer.get('b', lambda: 'B')
+        values = memoizer.get_many(['a', 'b', 'c', 'a'], read_many)
+        self.assertEqual(['A', 'B', 'C', 'A'], values)
+        self.assertEqual([['a', 'c']], batches)
+        self.assertEqual(['A', 'B', 'C'], memoizer.get_many(['a', 'b', 'c'],
+                                                            read_many))
+        self.assertEqual(1, len(batches))
+
+    def test_get_many_waits_for_keys_in_flight(self):
+        memoizer = Memoizer(early_refresh=0)
+        pool = coro_pool()
+        results = list()
+        pool.spawn(lambda: memoizer.get('1', self.slow_read, (1,)))
+        pool.spawn(lambda: results.append(memoizer.get_many(
+            ['1', '2'], lambda keys: [self.slow_read(k) for k in keys])))
+        pool.join()
+        self.assertEqual(2, self.calls)
+        self.assertEqual([1, '2'], [item['id'] for item in results[0]])
+
+    def test_string_stores_get_pickles(self):
+        memoizer = Memoizer(StringCacheStore())
+        memoizer.get('item:1', self.slow_read, (1,))
+        self.assertTrue(isinstance(
+            memoizer.cache_store.load('memo:item:1'), str))
+        self.assertEqual(1, memoizer.get('item:1', self.slow_read, (1,))['id'])
+        self.assertEqual(1, self.calls)
+
+
+###
+### Tests for fragment caching
+###
+class TestFragmentCache(unittest.TestCase):
+    """
+    a test class for brubeck's fragment cache.
+    """
+
+    def setUp(self):
+        self.cache_store = BaseCacheStore()
+        self.fragment_cache = FragmentCache(self.cache_store)
+        self.renders = 0
+
+    def render_nav(self):
+        self.renders += 1
+        return '<nav>%s</nav>' % self.renders
+
+    def test_get_or_render_caches(self):
+        first = self.fragment_cache.get_or_render('nav', self.render_nav)
+        second = self.fragment_cache.get_or_render('nav', self.render_nav)
+        self.assertEqual('<nav>1</nav>', first)
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.renders)
+        self.assertEqual(first, self.cache_store.load('fragment:nav'))
+
+    def test_ttl_expires_fragment(self):
+        self.fragment_cache.get_or_render('nav', self.render_nav, ttl=60)
+        item = self.cache_store._cache_store['fragment:nav']
+        item['expire'] = time.time() - 1
+        fragment = self.fragment_cache.get_or_render('nav', self.render_nav)
+        self.assertEqual('<nav>2</nav>', fragment)
+
+    def test_invalidate(self):
+        self.fragment_cache.get_or_render('nav', self.render_nav)
+        self.fragment_cache.invalidate('nav')
+        self.fragment_cache.get_or_render('nav', self.render_nav)
+        self.assertEqual(2, self.renders)
+
+    def test_stats(self):
+        for i in range(4):
+            self.fragment_cache.get_or_render('nav', self.render_nav)
+        stats = self.fragment_cache.stats()['nav']
+        self.assertEqual(3, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.75, stats['hit_rate'])
+        self.assertTrue(stats['avg_render_time'] >= 0)
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
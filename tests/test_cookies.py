@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import unittest
+import Cookie
+
+from brubeck.cookies import RequestCookies, ResponseCookies, CookieMorsel
+from brubeck.request_handling import Brubeck, WebMessageHandler, http_response
+from brubeck.connections import Request, WSGIConnection
+from fixtures import request_handler_fixtures as FIXTURES
+
+
+###
+### Tests for cookie parsing and serializing
+###
+class TestRequestCookies(unittest.TestCase):
+    """
+    a test class for parsing the Cookie header.
+    """
+
+    def test_lookup(self):
+        cookies = RequestCookies('key=value; other_key="a b"; akey=nope')
+        self.assertTrue('key' in cookies)
+        self.assertEqual('value', cookies['key'].value)
+        self.assertEqual('a b', cookies['other_key'].value)
+        self.assertFalse('missing' in cookies)
+        self.assertEqual(None, cookies.get('missing'))
+        self.assertRaises(KeyError, lambda: cookies['missing'])
+
+    def test_name_boundaries(self):
+        cookies = RequestCookies('akey=1; keyb=2')
+        self.assertFalse('key' in cookies)
+
+    def test_names_inside_quoted_values(self):
+        header = 'session=good; note="x\\073 session=evil"'
+        self.assertEqual('good', RequestCookies(header)['session'].value)
+        cookies = RequestCookies(header)
+        cookies.keys()
+        self.assertEqual('good', cookies['session'].value)
+
+    def test_last_value_wins(self):
+        cookies = RequestCookies('key=first; key=second')
+        self.assertEqual('second', cookies['key'].value)
+        self.assertEqual(['key'], cookies.keys())
+
+    def test_matches_simple_cookie(self):
+        header = 'a=1; b="quoted \\"value\\""; c=$x.y-z_'
+        simple = Cookie.SimpleCookie()
+        simple.load(header)
+        cookies = RequestCookies(header)
+        self.assertEqual(sorted(simple.keys()), sorted(cookies.keys()))
+        for key in simple.keys():
+            self.assertEqual(simple[key].value, cookies[key].value)
+
+    def test_empty_header(self):
+        cookies = RequestCookies(None)
+        self.assertEqual(0, len(cookies))
+        self.assertFalse('key' in cookies)
+
+
+class TestResponseCookies(unittest.TestCase):
+    """
+    a test class for rendering Set-Cookie headers.
+    """
+
+    def test_output_string(self):
+        cookies = ResponseCookies()
+        cookies['key'] = 'value'
+        cookies['key']['path'] = '/'
+        cookies['key']['max-age'] = 60
+        cookies['key']['httponly'] = True
+        self.assertEqual('key=value; Path=/; Max-Age=60; httponly',
+                         cookies['key'].OutputString())
+
+    def test_quotes_illegal_values(self):
+        morsel = CookieMorsel('key', 'a b')
+        self.assertEqual('key="a b"', morsel.OutputString())
+
+    def test_invalid_attribute(self):
+        morsel = CookieMorsel('key', 'value')
+        self.assertRaises(Cookie.CookieError, morsel.__setitem__, 'bogus', 1)
+
+    def test_multiple_set_cookie_headers(self):
+        app = Brubeck(msg_conn=WSGIConnection())
+        handler = WebMessageHandler(app, Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
+        handler.set_cookie('a', '1')
+        handler.set_cookie('b', '2')
+        result = handler.render(status_code=200)
+        self.assertEqual(['a=1', 'b=2'], sorted(result['headers']['Set-Cookie']))
+
+        response = http_response('', 200, 'OK', result['headers'])
+        self.assertTrue('\r\nSet-Cookie: a=1\r\n' in response)
+        self.assertTrue('\r\nSet-Cookie: b=2\r\n' in response)
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,14 @@
 
 import unittest
 
+import os
 import mock
+import redis
+import time
+import zlib
+import shutil
+import tempfile
+import ujson as json
 
 import brubeck
 from handlers.method_handlers import simple_handler_method
@@ -21,10 +28,14 @@ from fixtures import request_handler_fixtures as FIXTURES
 
 from brubeck.autoapi import AutoAPIBase
 from brubeck.queryset import DictQueryset, AbstractQueryset, RedisQueryset
+from brubeck.queryset import SQLiteQueryset
+from brubeck.queryset.redis import DESTROY_SCRIPT, HashRing, ShardedRedisQueryset
+from brubeck.queryset.codecs import ValueCodec, MsgpackSerializer
+from brubeck.queryset.base import BatchLoader
 
 from dictshield.document import Document
-from dictshield.fields import StringField
-from brubeck.request_handling import FourOhFourException
+from dictshield.fields import StringField, LongField
+from brubeck.request_handling import FourOhFourException, coro_pool, coro_sleep
 
 ##TestDocument
 class TestDoc(Document):
@@ -32,6 +43,13 @@ class TestDoc(Document):
     class Meta:
         id_field = StringField
 
+
+class TestPost(Document):
+    owner = StringField()
+    created_at = LongField()
+    class Meta:
+        id_field = StringField
+
 ###
 ### Tests for ensuring that the autoapi returns good data
 ###
@@ -131,6 +149,29 @@ class TestDictQueryset(unittest.TestCase):
         status, iid = self.queryset.read_many(bad_ids)[-1]
         self.assertEqual(self.queryset.MSG_FAILED, status)
 
+    def test_read_page(self):
+        self.seed_reads()
+        (items, cursor) = self.queryset.read_page(2)
+        self.assertEqual(['bar', 'baz'], [datum['id'] for s, datum in items])
+        self.assertEqual('baz', cursor)
+
+        self.queryset.create_one(TestDoc(id="bat"))
+        (items, cursor) = self.queryset.read_page(2, cursor=cursor)
+        self.assertEqual(['foo'], [datum['id'] for s, datum in items])
+        self.assertEqual(None, cursor)
+
+    def test_read_page_descending(self):
+        self.seed_reads()
+        self.queryset.destroy_one('baz')
+        (items, cursor) = self.queryset.read_page(1, order_by='-id')
+        self.assertEqual(['foo'], [datum['id'] for s, datum in items])
+        (items, cursor) = self.queryset.read_page(1, cursor=cursor,
+                                                  order_by='-id')
+        self.assertEqual(['bar'], [datum['id'] for s, datum in items])
+        self.assertEqual(None, cursor)
+        self.assertRaises(ValueError, self.queryset.read_page, 1,
+                          order_by='data')
+
 
     def test_update_one(self):
         shields = self.seed_reads()
@@ -184,6 +225,176 @@ class TestDictQueryset(unittest.TestCase):
         self.assertEqual(shield_to_keep.to_python(), datum)
 
 
+class TestDictQuerysetIndexes(unittest.TestCase):
+    """
+    a test class for secondary indexes in the dictqueryset.
+    """
+
+    def setUp(self):
+        self.queryset = DictQueryset(indexes={'owner': 'hash',
+                                              'created_at': 'sorted'})
+        self.queryset.create_many([
+            TestPost(id='a', owner='ann', created_at=30),
+            TestPost(id='b', owner='bob', created_at=10),
+            TestPost(id='c', owner='ann', created_at=20),
+            TestPost(id='d', owner='ann', created_at=40),
+        ])
+
+    def ids(self, **kwargs):
+        (items, cursor) = self.queryset.read_page(10, **kwargs)
+        return [datum['id'] for status, datum in items]
+
+    def test_hash_index(self):
+        self.assertEqual(['a', 'c', 'd'], self.ids(filters={'owner': 'ann'}))
+        self.assertEqual([], self.ids(filters={'owner': 'nobody'}))
+
+    def test_sorted_index(self):
+        self.assertEqual(['b', 'c', 'a', 'd'], self.ids(order_by='created_at'))
+        self.assertEqual(['a', 'c'],
+                         self.ids(filters={'created_at__gte': 20,
+                                           'created_at__lt': 40}))
+        self.assertEqual(['d', 'a', 'c'],
+                         self.ids(order_by='-created_at',
+                                  filters={'owner': 'ann'}))
+
+    def test_filtered_pages_in_id_order(self):
+        self.queryset.create_many([TestPost(id='x%03d' % i, owner='ann',
+                                            created_at=100 + i)
+                                   for i in range(200)])
+        filters = {'created_at__gte': 20, 'owner': 'ann'}
+        (items, cursor) = self.queryset.read_page(2, filters=filters)
+        self.assertEqual(['a', 'c'], [datum['id'] for s, datum in items])
+        (items, cursor) = self.queryset.read_page(2, cursor=cursor,
+                                                  filters=filters)
+        self.assertEqual(['d', 'x000'], [datum['id'] for s, datum in items])
+
+        ### Matches are all near the end, so the walk gives up and sorts
+        filters = {'created_at__gte': 250}
+        (items, cursor) = self.queryset.read_page(2, filters=filters)
+        self.assertEqual(['x150', 'x151'], [datum['id'] for s, datum in items])
+        (items, cursor) = self.queryset.read_page(2, cursor='x198',
+                                                  filters=filters)
+        self.assertEqual(['x199'], [datum['id'] for s, datum in items])
+
+        self.assertEqual(['b', 'c'], self.ids(filters={'created_at__lt': 30}))
+
+    def test_sorted_cursor(self):
+        (items, cursor) = self.queryset.read_page(2, order_by='created_at')
+        (items, cursor) = self.queryset.read_page(2, order_by='created_at',
+                                                  cursor=cursor)
+        self.assertEqual(['a', 'd'], [datum['id'] for s, datum in items])
+        self.assertEqual(None, cursor)
+
+    def test_indexes_follow_writes(self):
+        self.queryset.update_one(TestPost(id='b', owner='ann', created_at=50))
+        self.queryset.destroy_one('a')
+        self.assertEqual(['c', 'd', 'b'],
+                         self.ids(order_by='created_at',
+                                  filters={'owner': 'ann'}))
+        self.assertEqual([], self.ids(filters={'owner': 'bob'}))
+        self.assertEqual(3, len(self.queryset._sorted_indexes['created_at'][0]))
+
+    def test_unindexed_filters(self):
+        self.assertRaises(ValueError, self.queryset.read_page, 10,
+                          filters={'data': 'x'})
+        self.assertRaises(ValueError, self.queryset.read_page, 10,
+                          filters={'owner__gt': 'a'})
+
+
+class ListQueryset(AbstractQueryset):
+    def read_all(self):
+        return [(self.MSG_OK, i) for i in range(5)]
+
+
+class TestPagingFallback(unittest.TestCase):
+    """
+    a test class for the default `read_page`.
+    """
+
+    def test_read_page(self):
+        queryset = ListQueryset()
+        (items, cursor) = queryset.read_page(2, offset=1)
+        self.assertEqual([1, 2], [datum for status, datum in items])
+        (items, cursor) = queryset.read_page(2, cursor=cursor)
+        self.assertEqual([3, 4], [datum for status, datum in items])
+        self.assertEqual(None, cursor)
+
+
+class TodosAPI(AutoAPIBase):
+    model = TestDoc
+    default_count = 2
+
+
+class TestAutoAPIPaging(unittest.TestCase):
+    """
+    a test class for paging through an AutoAPI collection.
+    """
+
+    def setUp(self):
+        self.app = Brubeck(msg_conn=brubeck.connections.WSGIConnection())
+        TodosAPI.queries = DictQueryset()
+        TodosAPI.queries.create_many([TestDoc(id=i) for i in 'abc'])
+
+    def get(self, **arguments):
+        message = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        message.arguments = dict((k, [v]) for k, v in arguments.items())
+        response = TodosAPI(self.app, message)()
+        return (response['status_code'], json.loads(response['body']))
+
+    def test_pages(self):
+        (status, body) = self.get()
+        self.assertEqual(200, status)
+        self.assertEqual(2, len(body['data']))
+        self.assertEqual('b', body['cursor'])
+
+        (status, body) = self.get(cursor=body['cursor'])
+        self.assertEqual(1, len(body['data']))
+        self.assertEqual(None, body['cursor'])
+
+        (status, body) = self.get(count='1', skip='1')
+        self.assertEqual(1, len(body['data']))
+        self.assertEqual('b', body['cursor'])
+
+    def test_bad_paging_arguments(self):
+        (status, body) = self.get(order_by='data')
+        self.assertEqual(400, status)
+
+
+class PostsAPI(AutoAPIBase):
+    model = TestPost
+
+
+class TestAutoAPIFilters(unittest.TestCase):
+    """
+    a test class for filtering an AutoAPI collection.
+    """
+
+    def setUp(self):
+        self.app = Brubeck(msg_conn=brubeck.connections.WSGIConnection())
+        PostsAPI.queries = DictQueryset(indexes={'owner': 'hash',
+                                                 'created_at': 'sorted'})
+        PostsAPI.queries.create_many([
+            TestPost(id='a', owner='ann', created_at=30),
+            TestPost(id='b', owner='bob', created_at=10),
+            TestPost(id='c', owner='ann', created_at=20),
+        ])
+
+    def get(self, **arguments):
+        message = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        message.arguments = dict((k, [v]) for k, v in arguments.items())
+        response = PostsAPI(self.app, message)()
+        return (response['status_code'], json.loads(response['body']))
+
+    def test_filters(self):
+        (status, body) = self.get(owner='ann', created_at__gt='25')
+        self.assertEqual(200, status)
+        self.assertEqual([30], [item['created_at'] for item in body['data']])
+
+    def test_bad_filter_value(self):
+        (status, body) = self.get(created_at__gt='soon')
+        self.assertEqual(400, status)
+
+
 class TestRedisQueryset(TestQuerySetPrimitives):
     """
     Test RedisQueryset operations.
@@ -258,21 +469,13 @@ class TestRedisQueryset(TestQuerySetPrimitives):
         with mock.patch('redis.StrictRedis') as patchedRedis:
             redis_connection = patchedRedis(host='localhost', port=6379, db=0)
             queryset = RedisQueryset(db_conn=redis_connection)
-            queryset.read_many(['foo', 'bar', 'baz', 'laser', 'beams'])
-            expected = [('pipeline', (), {}),
-                        ('pipeline().hget', (queryset.api_id, 'foo'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'bar'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'baz'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'laser'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'beams'), {}),
-                        ('pipeline().execute', (), {}),
-                        ('pipeline().reset', (), {}),
-                        ('pipeline().execute().__iter__', (), {}),
-                        ('pipeline().execute().__iter__', (), {}),
-                        ('pipeline().execute().__len__', (), {}),
-                        ]
-            for call in zip(expected, redis_connection.mock_calls):
-                assert call[0] == call[1]
+            redis_connection.hmget.return_value = ['{"id": "foo"}', None]
+            results = queryset.read_many(['foo', 'laser'])
+            self.assertEqual([(queryset.MSG_OK, {'id': 'foo'}),
+                              (queryset.MSG_FAILED, None)], results)
+            self.assertEqual([mock.call.hmget(queryset.api_id,
+                                              ['foo', 'laser'])],
+                             redis_connection.mock_calls)
 
     def test_update_one(self):
         with mock.patch('redis.StrictRedis') as patchedRedis:
@@ -313,52 +516,592 @@ class TestRedisQueryset(TestQuerySetPrimitives):
     def test_destroy_one(self):
         with mock.patch('redis.StrictRedis') as patchedRedis:
             instance = patchedRedis.return_value
-            instance.pipeline = mock.Mock()
-            pipe_instance = instance.pipeline.return_value
-            pipe_instance.execute.return_value = ('{"success": "hget"}', 1)
+            script = instance.register_script.return_value
+            script.return_value = ['{"success": "hget"}']
 
             redis_connection = patchedRedis(host='localhost', port=6379, db=0)
             queryset = RedisQueryset(db_conn=redis_connection)
-            queryset.destroy_one('bar')
+            result = queryset.destroy_one('bar')
 
+            self.assertEqual((queryset.MSG_UPDATED, {'success': 'hget'}), result)
             expected = [
-                ('pipeline', (), {}),
-                ('pipeline().hget', ('id', 'bar'), {}),
-                ('pipeline().hdel', ('id', 'bar'), {}),
-                ('pipeline().execute', (), {})
+                mock.call.register_script(DESTROY_SCRIPT),
+                mock.call.register_script()(keys=['id'], args=['bar']),
                 ]
-            for call in zip(expected, redis_connection.mock_calls):
-                self.assertEqual(call[0], call[1])
+            self.assertEqual(expected, redis_connection.mock_calls)
+
+            script.return_value = [None]
+            self.assertEqual(queryset.MSG_NOTFOUND, queryset.destroy_one('bar'))
 
     def test_destroy_many(self):
         with mock.patch('redis.StrictRedis') as patchedRedis:
             instance = patchedRedis.return_value
-            instance.pipeline = mock.Mock()
-            pipe_instance = instance.pipeline.return_value
             shields = self.seed_reads()
             json_shields = [shield.to_json() for shield in shields]
-            results = json_shields
-            pipe_instance.execute.return_value = results
-            
+            instance.register_script.return_value.return_value = json_shields[:2] + [None]
+
             redis_connection = patchedRedis(host='localhost', port=6379, db=0)
-            
+
+            queryset = RedisQueryset(db_conn=redis_connection,
+                                     indexes={'created_at': 'sorted'})
+
+            results = queryset.destroy_many([shield.id for shield in shields])
+
+            self.assertEqual([queryset.MSG_UPDATED, queryset.MSG_UPDATED,
+                              queryset.MSG_FAILED],
+                             [status for status, datum in results])
+            expected = [mock.call.register_script(DESTROY_SCRIPT),
+                        mock.call.register_script()(
+                            keys=[queryset.api_id, 'id:created_at'],
+                            args=['foo', 'bar', 'baz'])]
+            self.assertEqual(expected, redis_connection.mock_calls)
+
+    def test_read_page(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            shields = self.seed_reads()
+            redis_connection.hscan.side_effect = [
+                (7, {'foo': shields[0].to_json()}),
+                (0, {'bar': shields[1].to_json(),
+                     'baz': shields[2].to_json()}),
+            ]
             queryset = RedisQueryset(db_conn=redis_connection)
 
-            queryset.destroy_many([shield.id for shield in shields])
-
-            expected = [('pipeline', (), {}),
-                        ('pipeline().hget', (queryset.api_id, 'foo'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'bar'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'baz'), {}),
-                        ('pipeline().execute', (), {}),
-                        ('pipeline().hdel', (queryset.api_id, 'foo'), {}),
-                        ('pipeline().hdel', (queryset.api_id, 'bar'), {}),
-                        ('pipeline().hdel', (queryset.api_id, 'baz'), {}),
-                        ('pipeline().execute', (), {}),
-                        ('pipeline().reset', (), {})
-                        ]
-            for call in zip(expected, redis_connection.mock_calls):
-                self.assertEqual(call[0], call[1])
+            (items, cursor) = queryset.read_page(2, offset=1)
+            self.assertEqual(['bar', 'baz'],
+                             sorted(datum['id'] for s, datum in items))
+            self.assertEqual(None, cursor)
+            self.assertEqual([mock.call(queryset.api_id, 0, count=2),
+                              mock.call(queryset.api_id, 7, count=2)],
+                             redis_connection.hscan.call_args_list)
+
+
+class FakePipeline(object):
+    """Queues commands for a `FakeRedis` and runs them on `execute`.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = list()
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.commands.append((method, args, kwargs))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        results = [method(*args, **kwargs)
+                   for method, args, kwargs in self.commands]
+        self.commands = list()
+        return results
+
+    def reset(self):
+        self.commands = list()
+
+
+def parse_score(bound):
+    if bound in ('-inf', '+inf'):
+        return (float(bound), False)
+    if bound.startswith('('):
+        return (float(bound[1:]), True)
+    return (float(bound), False)
+
+
+class FakeRedis(object):
+    """Just enough of redis-py's `StrictRedis` for the queryset, in memory.
+    """
+    def __init__(self):
+        self.hashes = dict()
+        self.zsets = dict()
+        self.round_trips = 0
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        assert script == DESTROY_SCRIPT
+        return self.destroy
+
+    def destroy(self, keys, args):
+        """Does what `DESTROY_SCRIPT` does.
+        """
+        self.round_trips += 1
+        values = list()
+        for shield_id in args:
+            values.append(self.hget(keys[0], shield_id))
+            if values[-1] is not None:
+                self.hdel(keys[0], shield_id)
+                for key in keys[1:]:
+                    self.zrem(key, shield_id)
+        return values
+
+    def hset(self, name, key, value):
+        h = self.hashes.setdefault(name, dict())
+        created = key not in h
+        h[key] = value
+        return int(created)
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hmget(self, name, keys):
+        self.round_trips += 1
+        h = self.hashes.get(name, {})
+        return [h.get(key) for key in keys]
+
+    def hdel(self, name, *keys):
+        h = self.hashes.get(name, {})
+        return len([h.pop(key) for key in keys if key in h])
+
+    def hvals(self, name):
+        return self.hashes.get(name, {}).values()
+
+    def hscan(self, name, cursor=0, count=None):
+        return (0, dict(self.hashes.get(name, {})))
+
+    def zadd(self, name, mapping):
+        z = self.zsets.setdefault(name, dict())
+        added = len([key for key in mapping if key not in z])
+        z.update((key, float(score)) for key, score in mapping.items())
+        return added
+
+    def zrem(self, name, *keys):
+        z = self.zsets.get(name, {})
+        return len([z.pop(key) for key in keys if key in z])
+
+    def _zrange(self, name, low, high, start, num, reverse):
+        (low, low_excluded) = parse_score(low)
+        (high, high_excluded) = parse_score(high)
+        pairs = sorted(((key, score) for key, score
+                        in self.zsets.get(name, {}).items()
+                        if (low < score or (low == score and not low_excluded))
+                        and (score < high or
+                             (score == high and not high_excluded))),
+                       key=lambda pair: (pair[1], pair[0]), reverse=reverse)
+        if start is not None:
+            pairs = pairs[start:start + num]
+        return pairs
+
+    def zrangebyscore(self, name, low, high, start=None, num=None,
+                      withscores=False):
+        self.round_trips += 1
+        return self._zrange(name, low, high, start, num, False)
+
+    def zrevrangebyscore(self, name, high, low, start=None, num=None,
+                         withscores=False):
+        self.round_trips += 1
+        return self._zrange(name, low, high, start, num, True)
+
+
+class TestRedisQuerysetIndexes(unittest.TestCase):
+    """
+    Test the sorted set indexes of RedisQueryset, against a fake connection.
+    """
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.queryset = RedisQueryset(db_conn=self.redis,
+                                      indexes={'created_at': 'sorted'})
+        self.queryset.create_many([
+            TestPost(id='a', owner='ann', created_at=30),
+            TestPost(id='b', owner='bob', created_at=10),
+            TestPost(id='c', owner='ann', created_at=20),
+            TestPost(id='d', owner='ann', created_at=20),
+        ])
+
+    def ids(self, items):
+        return [datum['id'] for status, datum in items]
+
+    def test_writes_keep_index(self):
+        self.assertEqual({'a': 30, 'b': 10, 'c': 20, 'd': 20},
+                         self.redis.zsets['id:created_at'])
+        self.queryset.update_one(TestPost(id='b', created_at=50))
+        self.queryset.destroy_one('a')
+        self.queryset.destroy_many(['c'])
+        self.assertEqual({'b': 50, 'd': 20}, self.redis.zsets['id:created_at'])
+
+    def test_read_range(self):
+        self.assertEqual(['c', 'd', 'a'],
+                         self.ids(self.queryset.read_range('created_at', 15)))
+        self.assertEqual(['a', 'd'],
+                         self.ids(self.queryset.read_range('created_at',
+                                                           limit=2,
+                                                           descending=True)))
+        self.assertEqual(['a'], self.ids(self.queryset.read_since(20)))
+
+    def test_read_page_by_index(self):
+        pages = list()
+        cursor = None
+        while True:
+            (items, cursor) = self.queryset.read_page(1, cursor=cursor,
+                                                      order_by='-created_at')
+            pages.append(self.ids(items))
+            if cursor is None:
+                break
+        self.assertEqual([['a'], ['d'], ['c'], ['b']], pages)
+
+        (items, cursor) = self.queryset.read_page(10, filters={
+            'created_at__gte': 20, 'created_at__lt': 30})
+        self.assertEqual(['c', 'd'], self.ids(items))
+
+        ### Filters from a query string arrive as strings
+        (items, cursor) = self.queryset.read_page(10, filters={
+            'created_at__gte': '5', 'created_at__lt': '20'})
+        self.assertEqual(['b'], self.ids(items))
+
+    def test_unindexed_reads(self):
+        self.assertRaises(ValueError, self.queryset.read_page, 10,
+                          order_by='owner')
+        self.assertRaises(ValueError, self.queryset.read_page, 10,
+                          filters={'owner': 'ann'})
+        self.assertRaises(ValueError, self.queryset.read_range, 'owner')
+
+    def test_one_round_trip_each(self):
+        queryset = self.queryset
+        operations = [
+            lambda: queryset.create_one(TestPost(id='e', created_at=5)),
+            lambda: queryset.update_many([TestPost(id='e', created_at=6)]),
+            lambda: queryset.read_many(['a', 'e']),
+            lambda: queryset.destroy_one('e'),
+            lambda: queryset.destroy_many(['a', 'b']),
+        ]
+        for operation in operations:
+            self.redis.round_trips = 0
+            operation()
+            self.assertEqual(1, self.redis.round_trips)
+        self.assertEqual({'c': 20, 'd': 20}, self.redis.zsets['id:created_at'])
+
+    def test_reindex(self):
+        self.redis.zsets.clear()
+        self.queryset.reindex()
+        self.assertEqual({'a': 30, 'b': 10, 'c': 20, 'd': 20},
+                         self.redis.zsets['id:created_at'])
+
+class TestBatchLoader(unittest.TestCase):
+    """
+    Test batching read_one calls from concurrent coroutines.
+    """
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.queryset = RedisQueryset(db_conn=self.redis, batch_window=0)
+        self.queryset.create_many([TestDoc(id='foo'), TestDoc(id='bar')])
+        self.redis.round_trips = 0
+
+    def read_concurrently(self, ids):
+        pool = coro_pool()
+        results = dict()
+
+        def read(i, _id):
+            try:
+                results[i] = self.queryset.read_one(_id)
+            except redis.ConnectionError, e:
+                results[i] = e
+
+        for i, _id in enumerate(ids):
+            pool.spawn(read, i, _id)
+        pool.join()
+        return [results[i] for i in range(len(ids))]
+
+    def test_reads_share_one_round_trip(self):
+        results = self.read_concurrently(['foo', 'bar', 'foo', 'nope'])
+        self.assertEqual(1, self.redis.round_trips)
+        self.assertEqual(['foo', 'bar', 'foo'],
+                         [datum['id'] for status, datum in results[:3]])
+        self.assertEqual((RedisQueryset.MSG_FAILED, 'nope'), results[3])
+        self.assertEqual({'loads': 4, 'batches': 1, 'mean_batch_size': 4.0},
+                         self.queryset.loader.stats())
+
+    def test_full_batches_load_right_away(self):
+        self.queryset.loader.max_batch_size = 2
+        self.read_concurrently(['foo', 'bar', 'foo', 'bar', 'foo'])
+        self.assertEqual(3, self.redis.round_trips)
+
+    def test_errors_reach_every_reader(self):
+        def fail(name, keys):
+            raise redis.ConnectionError('down')
+        self.redis.hmget = fail
+        results = self.read_concurrently(['foo', 'bar'])
+        self.assertEqual([redis.ConnectionError] * 2, map(type, results))
+
+    def test_single_read(self):
+        (status, datum) = self.queryset.read_one('foo')
+        self.assertEqual('foo', datum['id'])
+
+    def load_concurrently(self, loader, keys, kill_first=False):
+        pool = coro_pool()
+        results = dict()
+
+        def load(key):
+            try:
+                results[key] = loader.load(key)
+            except ValueError, e:
+                results[key] = e
+
+        coros = [pool.spawn(load, key) for key in keys]
+        coro_sleep(0)
+        if kill_first:
+            coros[0].kill()
+        pool.join()
+        return results
+
+    def test_killed_leader_hands_off_the_batch(self):
+        loader = BatchLoader(lambda keys: [key.upper() for key in keys],
+                             window=0.01)
+        results = self.load_concurrently(loader, ['a', 'b', 'c'],
+                                         kill_first=True)
+        self.assertEqual({'b': 'B', 'c': 'C'}, results)
+        self.assertEqual(None, loader._batch)
+        self.assertEqual('D', loader.load('d'))
+
+    def test_missing_values_fail_their_readers(self):
+        loader = BatchLoader(lambda keys: ['first'])
+        results = self.load_concurrently(loader, ['a', 'b'])
+        self.assertEqual(['first'], [v for v in results.values()
+                                     if not isinstance(v, ValueError)])
+        self.assertEqual(1, len([v for v in results.values()
+                                 if isinstance(v, ValueError)]))
+
+
+class TestValueCodec(unittest.TestCase):
+    """
+    Test encoding items with a ValueCodec and reading mixed formats.
+    """
+    def setUp(self):
+        self.small = TestDoc(id='foo', data='bar')
+        self.large = TestDoc(id='foo', data='bar ' * 500)
+
+    def test_small_values_skip_compression(self):
+        codec = ValueCodec(min_compress_size=512)
+        value = codec.encode(self.small)
+        self.assertEqual('\xf0' + self.small.to_json(), value)
+        self.assertEqual('bar', codec.decode(value)['data'])
+
+    def test_large_values_are_compressed(self):
+        codec = ValueCodec(min_compress_size=512)
+        value = codec.encode(self.large)
+        self.assertEqual('\xf4', value[0])
+        self.assertTrue(len(value) < len(self.large.to_json()))
+        self.assertEqual('bar ' * 500, codec.decode(value)['data'])
+
+    def test_compression_must_pay_off(self):
+        codec = ValueCodec(min_compress_size=0)
+        tiny = mock.Mock()
+        tiny.to_json.return_value = '{"id":"x"}'
+        self.assertEqual('\xf0{"id":"x"}', codec.encode(tiny))
+
+    def test_reads_legacy_values(self):
+        codec = ValueCodec()
+        json_value = self.small.to_json()
+        self.assertEqual('foo', codec.decode(json_value)['id'])
+        self.assertEqual('foo', codec.decode(zlib.compress(json_value))['id'])
+
+    def test_other_serializers(self):
+        serializer = mock.Mock(code=1)
+        serializer.serialize.return_value = 'packed'
+        serializer.deserialize.return_value = {'id': 'foo'}
+        codec = ValueCodec(serializer=serializer)
+        value = codec.encode(self.small)
+        self.assertEqual('\xf1packed', value)
+        self.assertEqual({'id': 'foo'}, codec.decode(value))
+
+    def test_msgpack(self):
+        try:
+            codec = ValueCodec(serializer=MsgpackSerializer())
+        except ImportError:
+            return
+        self.assertEqual('bar', codec.decode(codec.encode(self.small))['data'])
+
+    def test_redis_queryset_codec(self):
+        redis_connection = FakeRedis()
+        legacy = RedisQueryset(db_conn=redis_connection, compress=True)
+        legacy.create_one(TestDoc(id='old', data='x'))
+        queryset = RedisQueryset(db_conn=redis_connection,
+                                 codec=ValueCodec(min_compress_size=0))
+        queryset.create_one(self.large)
+        self.assertEqual('\xf4', redis_connection.hashes['id']['foo'][0])
+        with mock.patch('zlib.decompress', wraps=zlib.decompress) as decompress:
+            results = queryset.read_many(['old', 'foo'])
+            self.assertEqual(2, decompress.call_count)
+        self.assertEqual(['x', 'bar ' * 500],
+                         [datum['data'] for status, datum in results])
+
+
+class SlowFakeRedis(FakeRedis):
+    """A `FakeRedis` whose pipelines take a while to come back.
+    """
+    def pipeline(self):
+        pipe = FakeRedis.pipeline(self)
+        execute = pipe.execute
+
+        def slow_execute():
+            coro_sleep(0.05)
+            return execute()
+        pipe.execute = slow_execute
+        return pipe
+
+
+class TestShardedRedisQueryset(unittest.TestCase):
+    """
+    Test spreading a collection over several fake Redis servers.
+    """
+    def setUp(self):
+        self.servers = [FakeRedis() for i in range(3)]
+        self.queryset = ShardedRedisQueryset(self.servers,
+                                             indexes={'created_at': 'sorted'})
+        self.ids = ['item%d' % i for i in range(30)]
+        self.queryset.create_many([TestPost(id=_id, created_at=i)
+                                   for i, _id in enumerate(self.ids)])
+        for server in self.servers:
+            server.round_trips = 0
+
+    def server_for(self, _id):
+        return self.servers[self.queryset.ring.get_node(_id)]
+
+    def test_items_are_spread_out(self):
+        for _id in self.ids:
+            self.assertTrue(_id in self.server_for(_id).hashes['id'])
+        self.assertEqual(30, sum(len(server.hashes['id'])
+                                 for server in self.servers))
+        self.assertTrue(all(server.hashes['id'] for server in self.servers))
+
+    def test_many_operations_keep_order(self):
+        ids = ['item7', 'nope', 'item3', 'item21']
+        results = self.queryset.read_many(ids)
+        self.assertEqual([RedisQueryset.MSG_OK, RedisQueryset.MSG_FAILED,
+                          RedisQueryset.MSG_OK, RedisQueryset.MSG_OK],
+                         [status for status, datum in results])
+        self.assertEqual('item21', results[3][1]['id'])
+        self.assertTrue(all(server.round_trips <= 1
+                            for server in self.servers))
+
+        results = self.queryset.destroy_many(['item3', 'item3x'])
+        self.assertEqual([RedisQueryset.MSG_UPDATED, RedisQueryset.MSG_FAILED],
+                         [status for status, datum in results])
+        self.assertEqual(RedisQueryset.MSG_FAILED,
+                         self.queryset.read_one('item3')[0])
+
+    def test_shards_run_at_the_same_time(self):
+        queryset = ShardedRedisQueryset([SlowFakeRedis() for i in range(3)])
+        shields = [TestDoc(id=_id) for _id in self.ids]
+        start = time.time()
+        queryset.create_many(shields)
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_scan_pages(self):
+        seen = list()
+        cursor = None
+        while True:
+            (items, cursor) = self.queryset.read_page(7, cursor=cursor)
+            seen.extend(datum['id'] for status, datum in items)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(self.ids), sorted(seen))
+        (items, cursor) = self.queryset.read_page(100, offset=25)
+        self.assertEqual(5, len(items))
+
+    def test_index_pages_are_merged(self):
+        (items, cursor) = self.queryset.read_page(4, order_by='-created_at')
+        self.assertEqual(['item29', 'item28', 'item27', 'item26'],
+                         [datum['id'] for status, datum in items])
+        (items, cursor) = self.queryset.read_page(4, cursor=cursor,
+                                                  order_by='-created_at')
+        self.assertEqual(['item25', 'item24', 'item23', 'item22'],
+                         [datum['id'] for status, datum in items])
+        self.assertEqual(['item11', 'item12'],
+                         [datum['id'] for status, datum
+                          in self.queryset.read_since(10, limit=2)])
+
+    def test_ring_is_stable(self):
+        keys = ['key%d' % i for i in range(1000)]
+        before = HashRing(3)
+        after = HashRing(4)
+        moved = [key for key in keys
+                 if before.get_node(key) != after.get_node(key)]
+        self.assertTrue(all(after.get_node(key) == 3 for key in moved))
+        self.assertTrue(150 < len(moved) < 350)
+
+
+class TestSQLiteQueryset(unittest.TestCase):
+    """
+    Test SQLiteQueryset against a database in a temporary directory.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queryset = SQLiteQueryset(os.path.join(self.tmpdir, 'test.db'),
+                                       indexes=['owner', 'created_at'])
+        self.queryset.create_many([
+            TestPost(id='a', owner='ann', created_at=30),
+            TestPost(id='b', owner='bob', created_at=10),
+            TestPost(id='c', owner='ann', created_at=20),
+            TestPost(id='d', owner='ann'),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def ids(self, items):
+        return [datum['id'] for status, datum in items]
+
+    def test_create_and_update(self):
+        results = self.queryset.create_many([TestPost(id='a', owner='amy'),
+                                             TestPost(id='e', owner='eve')])
+        self.assertEqual([SQLiteQueryset.MSG_UPDATED, SQLiteQueryset.MSG_CREATED],
+                         [status for status, shield in results])
+        (status, shield) = self.queryset.update_one(TestPost(id='f'))
+        self.assertEqual(SQLiteQueryset.MSG_CREATED, status)
+        self.assertEqual('amy', self.queryset.read_one('a')[1]['owner'])
+
+    def test_reads(self):
+        self.assertEqual(['a', 'b', 'c', 'd'], self.ids(self.queryset.read_all()))
+        [(status, datum), missing] = self.queryset.read_many(['c', 'x'])
+        self.assertEqual((SQLiteQueryset.MSG_OK, 'c'), (status, datum['id']))
+        self.assertEqual((SQLiteQueryset.MSG_FAILED, 'x'), missing)
+
+    def test_destroy(self):
+        (status, datum) = self.queryset.destroy_one('a')
+        self.assertEqual('ann', datum['owner'])
+        self.assertRaises(FourOhFourException, self.queryset.destroy_one, 'a')
+        results = self.queryset.destroy_many(['b', 'x'])
+        self.assertEqual([SQLiteQueryset.MSG_UPDATED, SQLiteQueryset.MSG_FAILED],
+                         [status for status, datum in results])
+        self.assertEqual(['c', 'd'], self.ids(self.queryset.read_all()))
+
+    def test_pages(self):
+        (items, cursor) = self.queryset.read_page(3)
+        self.assertEqual(['a', 'b', 'c'], self.ids(items))
+        (items, cursor) = self.queryset.read_page(3, cursor=cursor)
+        self.assertEqual((['d'], None), (self.ids(items), cursor))
+
+    def test_indexed_pages(self):
+        seen = list()
+        cursor = None
+        while True:
+            (items, cursor) = self.queryset.read_page(
+                1, cursor=cursor, order_by='-created_at',
+                filters={'owner': 'ann'})
+            seen.extend(self.ids(items))
+            if cursor is None:
+                break
+        self.assertEqual(['a', 'c', 'd'], seen)
+
+        (items, cursor) = self.queryset.read_page(10, filters={
+            'created_at__gte': 15, 'created_at__lt': 30})
+        self.assertEqual(['c'], self.ids(items))
+        self.assertRaises(ValueError, self.queryset.read_page, 10,
+                          filters={'data': 'x'})
+
+    def test_queries_use_indexes(self):
+        conn = self.queryset._connection()
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM items "
+            "WHERE json_extract(data, '$.owner') = ?", ('ann',)).fetchall()
+        self.assertTrue('items_owner' in str(plan))
+
+    def test_calls_run_in_threads(self):
+        pool = coro_pool()
+        for i in range(20):
+            pool.spawn(self.queryset.create_one, TestPost(id='t%d' % i))
+        pool.join()
+        self.assertEqual(24, len(self.queryset.read_all()))
+
 
 ##
 ## This will run our tests
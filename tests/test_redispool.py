@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+import mock
+import redis
+import ujson as json
+
+from brubeck.request_handling import Brubeck, coro_pool, coro_sleep
+from brubeck.connections import Request, WSGIConnection
+from brubeck.cachestats import CacheStatsHandler
+from brubeck.redispool import RedisConnectionManager, make_pool, MeteredPool
+from fixtures import request_handler_fixtures as FIXTURES
+
+
+class StubConnection(object):
+    """Stands in for a redis-py connection that never talks to a server.
+    """
+    connect_error = None
+
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+
+    def connect(self):
+        if self.connect_error is not None:
+            raise self.connect_error
+
+    def can_read(self):
+        return False
+
+    def disconnect(self):
+        pass
+
+
+###
+### Tests for pools
+###
+class TestMeteredPool(unittest.TestCase):
+    """
+    a test class for the coroutine aware, metered connection pool.
+    """
+
+    def make_pool(self, timeout=1.0, connection_class=StubConnection):
+        return MeteredPool(make_pool({'connection_class': connection_class},
+                                     max_connections=1, timeout=timeout))
+
+    def test_checkouts_wait_for_a_connection(self):
+        pool = self.make_pool()
+        coros = coro_pool()
+
+        def hold():
+            connection = pool.get_connection('GET')
+            coro_sleep(0.05)
+            pool.release(connection)
+
+        def wait():
+            pool.release(pool.get_connection('GET'))
+
+        coros.spawn(hold)
+        coros.spawn(wait)
+        coros.join()
+        self.assertEqual(0, pool.in_use)
+        self.assertEqual(2, pool.wait_times.count)
+        self.assertTrue(pool.wait_times.max >= 0.04)
+
+    def test_checkout_timeout(self):
+        pool = self.make_pool(timeout=0.01)
+        pool.get_connection('GET')
+        self.assertRaises(redis.ConnectionError, pool.get_connection, 'GET')
+        self.assertEqual(1, pool.timeouts)
+        self.assertEqual(0, pool.errors)
+        self.assertEqual(1, pool.in_use)
+
+    def test_connection_errors_are_not_timeouts(self):
+        class RefusedConnection(StubConnection):
+            connect_error = redis.ConnectionError('refused')
+
+        class SlowConnection(StubConnection):
+            connect_error = redis.TimeoutError('timed out')
+
+        pool = self.make_pool(connection_class=RefusedConnection)
+        self.assertRaises(redis.ConnectionError, pool.get_connection, 'GET')
+        self.assertEqual((0, 1), (pool.timeouts, pool.errors))
+
+        pool = self.make_pool(connection_class=SlowConnection)
+        self.assertRaises(redis.TimeoutError, pool.get_connection, 'GET')
+        self.assertEqual((1, 0), (pool.timeouts, pool.errors))
+        self.assertEqual(0, pool.in_use)
+
+
+###
+### Tests for routing
+###
+class TestRedisConnectionManager(unittest.TestCase):
+    """
+    a test class for sending reads to replicas and writes to the primary.
+    """
+
+    def setUp(self):
+        self.manager = RedisConnectionManager(
+            {'host': 'primary'}, replicas=[{'host': 'r0'}, {'host': 'r1'}],
+            max_failures=2, eject_time=60, name='test')
+        for node in [self.manager.primary] + self.manager.replicas:
+            node.client = mock.Mock()
+
+    def test_reads_go_to_replicas(self):
+        self.manager.hget('id', 'foo')
+        self.manager.hset('id', 'foo', 'bar')
+        self.manager.pipeline()
+        primary = self.manager.primary.client
+        self.assertEqual(['hset', 'pipeline'],
+                         [name for name, args, kwargs in primary.mock_calls])
+        self.assertEqual(1, sum(len(node.client.mock_calls)
+                                for node in self.manager.replicas))
+
+    def test_replica_reads_off(self):
+        self.manager.replica_reads = False
+        self.manager.hget('id', 'foo')
+        self.assertEqual([mock.call.hget('id', 'foo')],
+                         self.manager.primary.client.mock_calls)
+
+    def test_failing_replicas_are_ejected(self):
+        broken = self.manager.replicas[0]
+        broken.client.get.side_effect = redis.ConnectionError('down')
+        self.manager.primary.client.get.return_value = 'value'
+        self.manager.replicas[1].client.get.return_value = 'value'
+        for i in range(10):
+            self.assertEqual('value', self.manager.get('key'))
+        self.assertFalse(broken.is_healthy())
+        self.assertEqual(1, broken.ejections)
+        self.assertEqual(self.manager.replicas[1],
+                         self.manager.choose_replica())
+
+        broken.ejected_until = 0
+        self.assertTrue(broken.is_healthy())
+
+    def test_no_healthy_replicas(self):
+        for node in self.manager.replicas:
+            node.ejected_until = float('inf')
+        self.manager.get('key')
+        self.assertEqual([mock.call.get('key')],
+                         self.manager.primary.client.mock_calls)
+
+    def test_stats_handler(self):
+        app = Brubeck(msg_conn=WSGIConnection())
+        handler = CacheStatsHandler(app,
+                                    Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
+        body = json.loads(handler.get()['body'])
+        stats = body['connections']['test']
+        self.assertEqual(['primary', 'replica0', 'replica1'], sorted(stats))
+        self.assertEqual(0, stats['primary']['wait']['count'])
+        self.assertEqual(0, stats['primary']['errors'])
+        self.assertTrue(stats['replica1']['healthy'])
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
@@ -5,11 +5,15 @@ import sys
 import brubeck
 from handlers.method_handlers import simple_handler_method
 from brubeck.request_handling import Brubeck, WebMessageHandler, JSONMessageHandler
-from brubeck.connections import to_bytes, Request, WSGIConnection
+from brubeck.connections import (to_bytes, Request, WSGIConnection,
+                                 Mongrel2Connection)
 from brubeck.request_handling import(
     cookie_encode, cookie_decode,
-    cookie_is_encoded, http_response
+    cookie_is_encoded, http_response,
+    http_response_head, http_chunk, coalesce_chunks,
+    signed_cookie_encode, signed_cookie_decode, signed_cookie_is_encoded
 )
+import time
 from handlers.object_handlers import(
     SimpleWebHandlerObject, CookieWebHandlerObject,
     SimpleJSONHandlerObject, CookieAddWebHandlerObject,
@@ -28,6 +32,12 @@ def request_handler(application, message, handler):
     if callable(handler):
         return handler()
 
+def mock_morsel(value):
+    """ just enough of a Cookie.Morsel to read a value from """
+    morsel = type('Morsel', (object,), {})()
+    morsel.value = value
+    return morsel
+
 class MockMessage(object):
     """ we are enough of a message to test routing rules message """
     def __init__(self, path = '/', msg = FIXTURES.HTTP_REQUEST_ROOT):
@@ -146,6 +156,37 @@ class TestRequestHandling(unittest.TestCase):
         decoded_cookie_value = cookie_decode(encoded_cookie, cookie_key)
         self.assertEqual(decoded_cookie_value, cookie_value)
     
+    def test_signed_cookie_handling(self):
+        secret = 'my_key'
+        encoded_cookie = signed_cookie_encode(['name', {'id': 5}], secret)
+        self.assertEqual(True, signed_cookie_is_encoded(encoded_cookie))
+        self.assertEqual(False, cookie_is_encoded(encoded_cookie))
+
+        # Twice, to go through the cache of verified cookies
+        for i in range(2):
+            decoded = signed_cookie_decode(encoded_cookie, secret)
+            self.assertEqual(['name', {'id': 5}], decoded)
+
+        self.assertEqual(None, signed_cookie_decode(encoded_cookie, 'wrong'))
+        tampered = encoded_cookie[:-2] + 'xx'
+        self.assertEqual(None, signed_cookie_decode(tampered, secret))
+
+    def test_signed_cookie_expiry(self):
+        expired = signed_cookie_encode('value', 'my_key', expires=time.time() - 1)
+        self.assertEqual(None, signed_cookie_decode(expired, 'my_key'))
+        fresh = signed_cookie_encode('value', 'my_key', expires=time.time() + 60)
+        self.assertEqual('value', signed_cookie_decode(fresh, 'my_key'))
+
+    def test_get_cookie_reads_both_formats(self):
+        handler = WebMessageHandler(self.app, Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
+        handler.set_cookie('key', 'value', secret='my_key', max_age=60)
+        new_style = handler.cookies['key'].value
+        old_style = cookie_encode(('key', 'value'), 'my_key')
+
+        for cookie in [new_style, old_style]:
+            handler.message._cookies = {'key': mock_morsel(cookie)}
+            self.assertEqual('value', handler.get_cookie('key', secret='my_key'))
+
     ##
     ## test a bunch of very simple requests making sure we get the expected results
     ##
@@ -188,6 +229,57 @@ class TestRequestHandling(unittest.TestCase):
         response = http_response(FIXTURES.TEST_BODY_OBJECT_HANDLER, 200, 'OK', dict())
         self.assertEqual(FIXTURES.HTTP_RESPONSE_OBJECT_ROOT, response)
 
+    def test_build_chunked_http_response(self):
+        head = http_response_head(200, 'OK', {'Content-Length': 10})
+        self.assertEqual('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n', head)
+        self.assertEqual('b\r\nTake five!!\r\n', http_chunk('Take five!!'))
+
+    def test_coalesce_chunks(self):
+        pieces = ['<head>', '', '</head>', '<body>', '</body>']
+        self.assertEqual(['<head>', '</head>', '<body>', '</body>'],
+                         list(coalesce_chunks(pieces)))
+        self.assertEqual(['<head></head>', '<body></body>'],
+                         list(coalesce_chunks(pieces, 10)))
+
+    def send_reply(self, body, version='HTTP/1.1', headers=None,
+                  method='reply_streamed'):
+        conn = Mongrel2Connection.__new__(Mongrel2Connection)
+        sent = list()
+        conn.reply = lambda req, msg: sent.append(msg)
+        request = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        request.headers['VERSION'] = version
+        getattr(conn, method)(request, {'status_code': 200,
+                                        'status_msg': 'OK',
+                                        'headers': headers or {},
+                                        'body': body})
+        return sent
+
+    def test_head_reply_keeps_content_length(self):
+        sent = self.send_reply('', headers={'Content-Length': '1234'},
+                               method='reply_head')
+        self.assertEqual(['HTTP/1.1 200 OK\r\nContent-Length: 1234\r\n\r\n'],
+                         sent)
+
+        sent = self.send_reply('Take five', method='reply_head')
+        self.assertEqual(['HTTP/1.1 200 OK\r\nContent-Length: 9\r\n\r\n'],
+                         sent)
+
+    def test_streamed_reply(self):
+        sent = self.send_reply(iter(['Take', ' five']))
+        self.assertEqual([http_chunk('Take'), http_chunk(' five'), '0\r\n\r\n'],
+                         sent[1:])
+
+    def test_failed_streamed_reply_closes(self):
+        def body():
+            yield 'Take'
+            raise ValueError('nope')
+        sent = self.send_reply(body())
+        self.assertEqual([http_chunk('Take'), ''], sent[1:])
+
+    def test_streamed_reply_to_http_10(self):
+        sent = self.send_reply(iter(['Take', ' five']), 'HTTP/1.0')
+        self.assertEqual([http_response('Take five', 200, 'OK', {})], sent)
+
     def test_handler_initialize_hook(self):
         ## create a handler that sets the expected body(and headers) in the initialize hook
         handler = InitializeHookWebHandlerObject(self.app, Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import unittest
+import time
+import mock
+
+from brubeck.request_handling import Brubeck, WebMessageHandler
+from brubeck.connections import Request, WSGIConnection
+from brubeck.caching import LRUCacheStore, InstrumentedCacheStore
+from brubeck.sessions import Session, SessionMixin
+from fixtures import request_handler_fixtures as FIXTURES
+
+
+class SessionHandler(SessionMixin, WebMessageHandler):
+    def get(self):
+        self.set_body('visits: %s' % self.session.get('visits', 0))
+        return self.render()
+
+    def post(self):
+        self.session['visits'] = self.session.get('visits', 0) + 1
+        return self.render()
+
+    def delete(self):
+        self.session.clear()
+        return self.render()
+
+
+class HomeHandler(SessionMixin, WebMessageHandler):
+    def get(self):
+        return self.render()
+
+
+###
+### Tests for sessions
+###
+class TestSession(unittest.TestCase):
+    """
+    a test class for session change tracking.
+    """
+
+    def test_changes_are_tracked(self):
+        session = Session('id', {'a': 1})
+        self.assertFalse(session.dirty)
+        session.get('a')
+        session.setdefault('a', 2)
+        self.assertFalse(session.dirty)
+        session['b'] = 2
+        self.assertTrue(session.dirty)
+
+        for change in (lambda s: s.pop('a'), lambda s: s.update(c=3),
+                       lambda s: s.clear(), lambda s: s.setdefault('d', 4)):
+            session = Session('id', {'a': 1})
+            change(session)
+            self.assertTrue(session.dirty)
+
+
+class TestSessionMixin(unittest.TestCase):
+    """
+    a test class for the session handler mixin.
+    """
+
+    def setUp(self):
+        self.store = InstrumentedCacheStore(LRUCacheStore(), name='sessions')
+        self.app = Brubeck(msg_conn=WSGIConnection(), cache_store=self.store,
+                           cookie_secret='secret')
+        self.cookie = None
+
+    def tearDown(self):
+        self.store.close()
+
+    def request(self, handler_cls, method='GET'):
+        msg = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        msg.headers['METHOD'] = method
+        if self.cookie:
+            msg.headers['cookie'] = self.cookie
+        handler = handler_cls(self.app, msg)
+        response = handler()
+        cookie = response['headers'].get('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';')[0]
+        return response
+
+    def test_unused_sessions_are_not_loaded_or_saved(self):
+        response = self.request(HomeHandler)
+        self.assertFalse('Set-Cookie' in response['headers'])
+        self.assertEqual(0, self.store.latencies['load'].count)
+        self.assertEqual(0, self.store.latencies['save'].count)
+
+    def test_new_sessions_are_saved_once_written(self):
+        response = self.request(SessionHandler)
+        self.assertFalse('Set-Cookie' in response['headers'])
+        self.assertEqual(0, len(self.store.cache_store))
+
+        self.request(SessionHandler, 'POST')
+        self.assertEqual(1, len(self.store.cache_store))
+        self.assertEqual('visits: 1', self.request(SessionHandler)['body'])
+
+    def test_reads_touch_instead_of_saving(self):
+        self.request(SessionHandler, 'POST')
+        later = time.time() + SessionHandler.session_ttl / 2
+        with mock.patch('time.time', return_value=later):
+            self.request(SessionHandler)
+        self.assertEqual(1, self.store.latencies['save'].count)
+        self.assertEqual(1, self.store.latencies['touch'].count)
+
+        (data, expire, size) = self.store.cache_store._cache_store.values()[0]
+        self.assertTrue(expire > later + SessionHandler.session_ttl - 5)
+
+    def test_recent_sessions_are_not_touched(self):
+        self.request(SessionHandler, 'POST')
+        for i in xrange(10):
+            response = self.request(SessionHandler)
+        self.assertEqual('visits: 1', response['body'])
+        self.assertFalse('Set-Cookie' in response['headers'])
+        self.assertEqual(0, self.store.latencies['touch'].count)
+
+    def test_cleared_sessions_are_deleted(self):
+        self.request(SessionHandler, 'POST')
+        self.request(SessionHandler, 'DELETE')
+        self.assertEqual(0, len(self.store.cache_store))
+        self.assertEqual('visits: 0', self.request(SessionHandler)['body'])
+
+    def test_forged_session_ids_are_ignored(self):
+        self.request(SessionHandler, 'POST')
+        session_id = self.store.cache_store._cache_store.keys()[0]
+        self.cookie = 'session_id=%s:%d' % (session_id.split(':')[1],
+                                            time.time())
+        self.assertEqual('visits: 0', self.request(SessionHandler)['body'])
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
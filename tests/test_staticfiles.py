@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import gzip
+import os
+
+from brubeck.request_handling import Brubeck
+from brubeck.connections import Request, WSGIConnection
+from brubeck.staticfiles import StaticFileHandler, parse_range
+
+
+###
+### Tests for serving static files
+###
+class TestParseRange(unittest.TestCase):
+    """
+    a test class for parsing the Range header.
+    """
+
+    def test_parse_range(self):
+        self.assertEqual(None, parse_range(None, 100))
+        self.assertEqual(None, parse_range('bytes=0-1,5-6', 100))
+        self.assertEqual((0, 9), parse_range('bytes=0-9', 100))
+        self.assertEqual((90, 99), parse_range('bytes=90-', 100))
+        self.assertEqual((90, 99), parse_range('bytes=-10', 100))
+        self.assertEqual((90, 99), parse_range('bytes=90-500', 100))
+        self.assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=9-1', 100)
+
+
+class TestStaticFileHandler(unittest.TestCase):
+    """
+    a test class for brubeck's static file handler.
+    """
+
+    def setUp(self):
+        self.static_dir = tempfile.mkdtemp()
+        self.write_file('style.css', 'body { color: red; }')
+        self.app = Brubeck(msg_conn=WSGIConnection())
+
+        class MediaHandler(StaticFileHandler):
+            static_dir = self.static_dir
+        MediaHandler._file_cache.clear()
+        MediaHandler._stat_cache.clear()
+        self.handler_class = MediaHandler
+
+    def tearDown(self):
+        shutil.rmtree(self.static_dir)
+
+    def write_file(self, name, data):
+        f = open(os.path.join(self.static_dir, name), 'wb')
+        f.write(data)
+        f.close()
+
+    def request(self, path, **headers):
+        environ = {
+            'PATH_INFO': '/media/' + path,
+            'REQUEST_METHOD': 'GET',
+            'wsgi.url_scheme': 'http',
+            'HTTP_HOST': 'localhost',
+        }
+        environ.update(headers)
+        message = Request.parse_wsgi_request(environ)
+        handler = self.handler_class(self.app, message)
+        handler._url_args = {'path': path}
+        return handler()
+
+    def test_serves_file_with_validators(self):
+        result = self.request('style.css')
+        self.assertEqual(200, result['status_code'])
+        self.assertEqual('body { color: red; }', result['body'])
+        self.assertEqual('text/css', result['headers']['Content-Type'])
+        self.assertEqual('20', result['headers']['Content-Length'])
+        self.assertTrue('ETag' in result['headers'])
+        self.assertTrue('Last-Modified' in result['headers'])
+
+    def test_not_modified(self):
+        headers = self.request('style.css')['headers']
+        self.handler_class._file_cache.clear()
+        result = self.request('style.css', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(304, result['status_code'])
+        self.assertEqual('', result['body'])
+        self.assertEqual(0, len(self.handler_class._file_cache))
+
+        result = self.request('style.css',
+                              HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])
+        self.assertEqual(304, result['status_code'])
+
+    def test_range_requests(self):
+        result = self.request('style.css', HTTP_RANGE='bytes=0-3')
+        self.assertEqual(206, result['status_code'])
+        self.assertEqual('body', result['body'])
+        self.assertEqual('bytes 0-3/20', result['headers']['Content-Range'])
+
+        result = self.request('style.css', HTTP_RANGE='bytes=50-')
+        self.assertEqual(416, result['status_code'])
+
+    def test_missing_and_escaping_paths(self):
+        self.assertEqual(404, self.request('nope.css')['status_code'])
+        self.assertEqual(404, self.request('../etc/passwd')['status_code'])
+        self.assertEqual(404, self.request('style.css\x00')['status_code'])
+
+    def test_precompressed_sibling(self):
+        gz_path = os.path.join(self.static_dir, 'style.css.gz')
+        f = gzip.open(gz_path, 'wb')
+        f.write('body { color: red; }')
+        f.close()
+
+        result = self.request('style.css', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', result['headers']['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', result['headers']['Vary'])
+        self.assertEqual(open(gz_path, 'rb').read(), result['body'])
+
+        result = self.request('style.css')
+        self.assertFalse('Content-Encoding' in result['headers'])
+        self.assertEqual('body { color: red; }', result['body'])
+
+    def test_changed_files_are_stat_again(self):
+        self.request('style.css')
+        self.write_file('style.css', 'body { color: blue; }')
+        self.assertEqual('body { color: red; }',
+                         self.request('style.css')['body'])
+
+        self.handler_class.stat_interval = 0
+        self.assertEqual('body { color: blue; }',
+                         self.request('style.css')['body'])
+
+    def test_lru_eviction(self):
+        self.handler_class.cache_max_entries = 1
+        self.write_file('app.js', 'alert(1);')
+        self.request('style.css')
+        self.request('app.js')
+        cached = self.handler_class._file_cache.keys()
+        self.assertEqual([os.path.join(self.static_dir, 'app.js')], cached)
+
+    def test_large_files_are_not_cached(self):
+        self.handler_class.cache_max_file_size = 4
+        result = self.request('style.css')
+        self.assertTrue(hasattr(result['body'], 'read'))
+        result['body'].close()
+
+        result = self.request('style.css', HTTP_RANGE='bytes=5-')
+        self.assertEqual('{ color: red; }', ''.join(result['body']))
+        self.assertEqual(0, len(self.handler_class._file_cache))
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from brubeck.request_handling import Brubeck
+from brubeck.connections import Request, WSGIConnection
+from brubeck.templating import (
+    list_templates, precompile_templates, generate_mako,
+    load_jinja2_env, load_mako_env, Jinja2Rendering
+)
+from fixtures import request_handler_fixtures as FIXTURES
+
+
+###
+### Tests for template loading and warmup
+###
+class TestTemplateWarmup(unittest.TestCase):
+    """
+    a test class for brubeck's template precompilation.
+    """
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.template_dir, 'partials'))
+        templates = {
+            'success.html': 'Take five, ${name}!',
+            'partials/nav.html': '<nav>${name}</nav>',
+            '.hidden.swp': 'not a template',
+        }
+        for name, body in templates.items():
+            f = open(os.path.join(self.template_dir, name), 'w')
+            f.write(body)
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_list_templates(self):
+        names = list_templates(self.template_dir)
+        self.assertEqual(['partials/nav.html', 'success.html'], names)
+
+        names = list_templates(self.template_dir, extension='.txt')
+        self.assertEqual([], names)
+
+    def test_precompile_templates_skips_failures(self):
+        def compile_fun(name):
+            if name == 'broken.html':
+                raise ValueError('bad template')
+
+        compile_times = precompile_templates(compile_fun,
+                                             ['ok.html', 'broken.html'])
+        self.assertEqual(['ok.html'], compile_times.keys())
+        self.assertTrue(compile_times['ok.html'] >= 0)
+
+    def test_jinja2_precompile_with_bytecode_cache(self):
+        loader = load_jinja2_env(self.template_dir, precompile=True,
+                                 bytecode_cache_dir=self.cache_dir)
+        env = loader()
+        self.assertEqual(sorted(env.compile_times.keys()),
+                         ['partials/nav.html', 'success.html'])
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_mako_precompile_with_module_directory(self):
+        loader = load_mako_env(self.template_dir, precompile=True,
+                               module_directory=self.cache_dir)
+        lookup = loader()
+        self.assertEqual(sorted(lookup.compile_times.keys()),
+                         ['partials/nav.html', 'success.html'])
+        body = lookup.get_template('/success.html').render(name='dude')
+        self.assertEqual('Take five, dude!', body)
+
+
+class TestFragmentRendering(unittest.TestCase):
+    """
+    a test class for fragment caching in the rendering handlers.
+    """
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        f = open(os.path.join(self.template_dir, 'nav.html'), 'w')
+        f.write('<nav>{{ name }}</nav>')
+        f.close()
+        self.app = Brubeck(msg_conn=WSGIConnection(),
+                           template_loader=load_jinja2_env(self.template_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_render_fragment(self):
+        message = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        handler = Jinja2Rendering(self.app, message)
+        first = handler.render_fragment('nav', 'nav.html', name='dude')
+        second = handler.render_fragment('nav', 'nav.html', name='other')
+        self.assertEqual('<nav>dude</nav>', first)
+        self.assertEqual(first, second)
+
+        stats = self.app.fragment_cache.stats()['nav']
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+
+class TestStreamedRendering(unittest.TestCase):
+    """
+    a test class for streamed template rendering.
+    """
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        f = open(os.path.join(self.template_dir, 'report.html'), 'w')
+        f.write('<head></head>{% for row in rows %}<p>{{ row }}</p>{% endfor %}')
+        f.close()
+        self.app = Brubeck(msg_conn=WSGIConnection(),
+                           template_loader=load_jinja2_env(self.template_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_jinja2_stream_template(self):
+        class ReportHandler(Jinja2Rendering):
+            def get(self):
+                return self.stream_template('report.html', rows=[1, 2])
+
+        self.app.add_route_rule(r'^/$', ReportHandler)
+        environ = {
+            'PATH_INFO': '/',
+            'REQUEST_METHOD': 'GET',
+            'wsgi.url_scheme': 'http',
+            'HTTP_HOST': 'localhost',
+        }
+        started = list()
+        callback = lambda status, headers: started.append((status, headers))
+        body = self.app.msg_conn.process_message(self.app, environ, callback)
+
+        self.assertEqual('200 OK', started[0][0])
+        chunks = list(body)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual('<head></head><p>1</p><p>2</p>', ''.join(chunks))
+
+    def test_generate_mako(self):
+        from mako.template import Template
+        template = Template('<head></head>\n% for row in rows:\n<p>${row}</p>\n% endfor\n')
+        chunks = list(generate_mako(template, {'rows': [1, 2]}, self.app.pool))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual('<head></head>\n<p>1</p>\n<p>2</p>\n', ''.join(chunks))
+
+    def test_generate_mako_raises_errors(self):
+        from mako.template import Template
+        template = Template('<head></head>${1 / 0}')
+        chunks = generate_mako(template, {}, self.app.pool)
+        self.assertEqual('<head></head>', chunks.next())
+        self.assertRaises(ZeroDivisionError, chunks.next)
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()